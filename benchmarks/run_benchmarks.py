@@ -0,0 +1,272 @@
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Nothing is written to MongoDB, but the entities are imported through the 'mongo' package
+os.environ.setdefault("MONGO_DB", "benchmarks")
+
+BENCHMARK_DATETIME = "2024_12_02_10_00_00"
+
+
+def measure(function, setup=None, repeat=5):
+    """ Time a stage and get its peak memory (the setup, that prepares the arguments of every run, is not measured)
+    Args:
+        function: The stage
+        setup: Function that returns the tuple of arguments of a run (no arguments if None)
+        repeat: The amount of timed runs
+    Returns:
+        A dictionary with the median and minimum seconds and the peak of allocated bytes"""
+    times = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        gc.collect()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+
+    # The memory is traced in its own run, tracemalloc slows down the stage
+    arguments = setup() if setup is not None else ()
+    gc.collect()
+    tracemalloc.start()
+    function(*arguments)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'median': statistics.median(times), 'min': min(times), 'peak_memory': peak}
+
+
+def benchmark_zone(zone_id, zones_dir="zonas", density=1.0, seed=0, repeat=5, stages=None):
+    """ Benchmark every stage of the pipeline on its own, and the whole pipeline, with synthetic tiles of a zone
+    Args:
+        zone_id: The zone
+        zones_dir: The folder with the zones
+        density: The amount of lines per edge of the synthetic tiles
+        seed: The seed of the synthetic tiles
+        repeat: The amount of timed runs of every stage
+        stages: The names of the stages to run (all if None)
+    Returns:
+        A dictionary with the results by stage and a dictionary with the sizes of the data"""
+    import mapbox_vector_tile
+
+    from benchmarks.synthetic_tiles import encode_synthetic_tile, generate_synthetic_tiles
+    from mongo.entity import Graph, Snapshot
+    from pipeline import match_segments, process_snapshot, translate_tiles
+    from translation import add_info_to_features, add_info_to_file, add_traffic_level_from_file, \
+        apply_traffic_level, interpolate_traffic_level, split_feature_collection, split_features, \
+        translate_file_pairs_into_geojson, translate_tile_into_segments
+    from utils.utils_match_cache import MatchCache
+    from utils.utils_pbf import RawTile
+    from utils.utils_zone import load_zone
+
+    zone = load_zone(zone_id, zones_dir=zones_dir, compiled_cache=True)
+    graph, tiles, dt = zone['graph'], zone['tiles'], BENCHMARK_DATETIME
+    decoded_tiles = generate_synthetic_tiles(graph, tiles, density=density, seed=seed)
+    raw_tiles = {name: encode_synthetic_tile(decoded_tile) for name, decoded_tile in decoded_tiles.items()}
+
+    # The files of the legacy stages are removed with the folder at the end
+    with tempfile.TemporaryDirectory(prefix=f"benchmark_{zone_id}_") as work_dir:
+        for stage_dir in ("tiles", "mixed", "informed"):
+            os.makedirs(f"{work_dir}/{stage_dir}")
+        for name, decoded_tile in decoded_tiles.items():
+            with open(f"{work_dir}/tiles/{name}.pbf.json", "w") as file:
+                json.dump(decoded_tile, file)
+
+        # Inputs of every stage, computed once with the stage before
+        def get_outs(tile):
+            return (tile['corners_2'][0], tile['corners_0'][1]), (tile['corners_0'][0], tile['corners_1'][1])
+
+        mixed = translate_tiles(dt, tiles, decoded_tiles=decoded_tiles).to_geojson()
+        with open(f"{work_dir}/mixed/{dt}.pbf.json", "w") as file:
+            json.dump(mixed, file)
+        informed = add_info_to_features(copy.deepcopy(mixed), graph, splits=15, edge_index=zone['edge_index'])
+        with open(f"{work_dir}/informed/{dt}.pbf.json", "w") as file:
+            json.dump(informed, file)
+        split = split_feature_collection(copy.deepcopy(informed))
+        with open(f"{work_dir}/split.pbf.json", "w") as file:
+            json.dump(split, file)
+        warm_cache = MatchCache()
+        matches = match_segments(translate_tiles(dt, tiles, decoded_tiles=decoded_tiles),
+                                 dict(zone, match_cache=warm_cache), dt)
+
+        def with_matches():
+            return apply_traffic_level(graph, matches, dt, fill_empty_edges=False),
+
+        def interpolated():
+            traffic_state = with_matches()[0]
+            interpolate_traffic_level(graph, traffic_state, dt, interpolator=zone['interpolator'])
+            return traffic_state,
+
+        def interpolated_graph():
+            return interpolated()[0].to_graph(graph.copy()),
+
+        def translate_legacy():
+            for tile in tiles:
+                translate_file_pairs_into_geojson(f"{work_dir}/tiles/{tile['name']}.pbf.json", *get_outs(tile))
+
+        def split_legacy():
+            with open(f"{work_dir}/informed/{dt}.pbf.json") as file:
+                split_features(file)
+
+        def add_traffic_level_legacy(graph_copy):
+            with open(f"{work_dir}/split.pbf.json") as file:
+                add_traffic_level_from_file(graph_copy, file, dt, neighbours_dictionary=zone['neightbours'],
+                                            precision=3)
+
+        def end_to_end(zone_copy):
+            traffic_state = process_snapshot(dt, zone_copy,
+                                             decoded_tiles={name: RawTile(data) for name, data in raw_tiles.items()},
+                                             precision=3)
+            Snapshot.generate_snapshot(traffic_state, dt, zone['edge_table'], zone['graph_signature'])
+
+        benchmarks = {
+            'decode_tile': (lambda: [mapbox_vector_tile.decode(data) for data in raw_tiles.values()], None),
+            'translate_file_pairs_into_geojson': (translate_legacy, None),
+            'translate_tile_into_segments': (
+                lambda: [translate_tile_into_segments(decoded_tiles[tile['name']], *get_outs(tile)) for tile in tiles],
+                None),
+            'add_info_to_file': (
+                lambda: add_info_to_file(dt, f"{work_dir}/mixed", f"{work_dir}/informed", graph, splits=15,
+                                         edge_index=zone['edge_index']), None),
+            'add_info_to_features': (
+                lambda data: add_info_to_features(data, graph, splits=15, edge_index=zone['edge_index']),
+                lambda: (copy.deepcopy(mixed),)),
+            'split_features': (split_legacy, None),
+            'split_feature_collection': (split_feature_collection, lambda: (copy.deepcopy(informed),)),
+            'add_traffic_level_from_file': (add_traffic_level_legacy, lambda: (graph.copy(),)),
+            'match_segments': (
+                lambda segments, zone_copy: match_segments(segments, zone_copy, dt),
+                lambda: (translate_tiles(dt, tiles, decoded_tiles=decoded_tiles),
+                         dict(zone, match_cache=MatchCache()))),
+            'apply_traffic_level': (
+                lambda traffic_state: apply_traffic_level(graph, matches, dt, fill_empty_edges=False,
+                                                          traffic_state=traffic_state),
+                lambda: (zone['traffic_state'],)),
+            'interpolate_traffic_level': (
+                lambda traffic_state: interpolate_traffic_level(graph, traffic_state, dt,
+                                                                interpolator=zone['interpolator'], precision=3),
+                with_matches),
+            'Graph.generate_graph': (lambda graph_copy: Graph.generate_graph(graph_copy, dt), interpolated_graph),
+            'Snapshot.generate_snapshot': (
+                lambda traffic_state: Snapshot.generate_snapshot(traffic_state, dt, zone['edge_table'],
+                                                                 zone['graph_signature']),
+                interpolated),
+            'end_to_end_cold': (end_to_end, lambda: (dict(zone, match_cache=MatchCache()),)),
+            'end_to_end_warm': (end_to_end, lambda: (dict(zone, match_cache=warm_cache),)),
+        }
+
+        results = {}
+        for stage, (function, setup) in benchmarks.items():
+            if stages is not None and stage not in stages:
+                continue
+            results[stage] = measure(function, setup=setup, repeat=repeat)
+            logging.warning(f"{zone_id} {stage}: {results[stage]['median'] * 1000:.1f} ms")
+
+        sizes = {
+            'edges': len(zone['edge_table']),
+            'tile_features': sum(len(tile['Traffic flow']['features']) for tile in decoded_tiles.values()),
+            'raw_bytes': sum(len(data) for data in raw_tiles.values()),
+            'segments': len(mixed['features']),
+            'split_features': len(split['features']),
+            'matches': len(matches)
+        }
+        return results, sizes
+
+
+def compare_with_baseline(report, baseline, tolerance=0.25, min_seconds=0.005):
+    """ Get the stages slower (or using more memory) than in the baseline
+    Args:
+        report: The report of the current run
+        baseline: The report of the baseline
+        tolerance: The allowed relative increase (0.25 = 25 %)
+        min_seconds: The stages faster than this in the baseline are not compared (their timings are noise)
+    Returns:
+        A list with the regressions (zone, stage, metric, baseline value, current value)"""
+    regressions = []
+    for zone_id, stages in report['results'].items():
+        for stage, result in stages.items():
+            baseline_result = baseline['results'].get(zone_id, {}).get(stage)
+            if baseline_result is None:
+                continue
+            if baseline_result['median'] >= min_seconds and \
+                    result['median'] > baseline_result['median'] * (1 + tolerance):
+                regressions.append((zone_id, stage, 'median', baseline_result['median'], result['median']))
+            if result['peak_memory'] > baseline_result['peak_memory'] * (1 + tolerance):
+                regressions.append((zone_id, stage, 'peak_memory', baseline_result['peak_memory'],
+                                    result['peak_memory']))
+    return regressions
+
+
+def print_report(report, baseline=None):
+    for zone_id, stages in report['results'].items():
+        print(f"\n{zone_id} ({', '.join(f'{key} {value}' for key, value in report['sizes'][zone_id].items())})")
+        print(f"{'stage':<36}{'median ms':>12}{'min ms':>12}{'peak MB':>12}{'baseline ms':>14}{'ratio':>8}")
+        for stage, result in stages.items():
+            line = f"{stage:<36}{result['median'] * 1000:>12.1f}{result['min'] * 1000:>12.1f}" \
+                   f"{result['peak_memory'] / 2 ** 20:>12.2f}"
+            baseline_result = (baseline or {}).get('results', {}).get(zone_id, {}).get(stage)
+            if baseline_result is not None:
+                line += f"{baseline_result['median'] * 1000:>14.1f}{result['median'] / baseline_result['median']:>8.2f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    logging.basicConfig(encoding='utf-8', level=logging.WARNING, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the pipeline with synthetic TomTom tiles")
+    parser.add_argument("--zones", nargs="+", default=["teatinos", "soho"], help="The zones to benchmark")
+    parser.add_argument("--zones-dir", default="zonas", help="The folder with the zones")
+    parser.add_argument("--density", type=float, default=1.0, help="The amount of lines per edge of the tiles")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic tiles")
+    parser.add_argument("--repeat", type=int, default=5, help="The amount of timed runs of every stage")
+    parser.add_argument("--stages", nargs="+", default=None, help="The stages to run (all if not given)")
+    parser.add_argument("--save", default=None, help="Save the report as a baseline in this file")
+    parser.add_argument("--compare", default=None, help="Compare with the baseline of this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="The allowed relative regression")
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'density': args.density,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': {},
+        'sizes': {}
+    }
+    for zone_id in args.zones:
+        report['results'][zone_id], report['sizes'][zone_id] = benchmark_zone(
+            zone_id, zones_dir=args.zones_dir, density=args.density, seed=args.seed, repeat=args.repeat,
+            stages=args.stages)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if (baseline['density'], baseline['seed']) != (args.density, args.seed):
+            print(f"WARNING: the baseline was run with density {baseline['density']} and seed {baseline['seed']}")
+
+    print_report(report, baseline)
+
+    if args.save is not None:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nBaseline saved to {args.save}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(report, baseline, tolerance=args.tolerance)
+        for zone_id, stage, metric, baseline_value, value in regressions:
+            print(f"REGRESSION {zone_id} {stage} {metric}: {baseline_value:.4g} -> {value:.4g}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,106 @@
+import mapbox_vector_tile
+import numpy as np
+import osmnx as ox
+import shapely
+
+# Extent of the synthetic tiles (the one of the TomTom flow tiles)
+SYNTHETIC_TILE_EXTENT = 4096
+
+ROAD_TYPES = ('Motorway', 'International road', 'Major road', 'Secondary road', 'Connecting road',
+              'Major local road', 'Local road', 'Minor local road')
+
+
+def lonlat_to_tile_coordinates(coordinates, tile, extent=SYNTHETIC_TILE_EXTENT):
+    """ Get the tile coordinates of longitude, latitude points (the inverse of the scaling of the translation)
+    Args:
+        coordinates: Array (n, 2) with the longitude and latitude of the points
+        tile: The tile dictionary (with its corners)
+        extent: The extent of the tile
+    Returns:
+        An array (n, 2) with the tile coordinates"""
+    outmin = np.array([tile['corners_2'][0], tile['corners_0'][1]], dtype=float)
+    outmax = np.array([tile['corners_0'][0], tile['corners_1'][1]], dtype=float)
+    return (coordinates - outmax) / (outmin - outmax) * extent
+
+
+def generate_synthetic_tile(edge_geometries, tile, density=1.0, seed=0, extent=SYNTHETIC_TILE_EXTENT,
+                            layer_name="Traffic flow"):
+    """ Generate a decoded flow tile (as returned by mapbox_vector_tile.decode) with lines along the edges of a graph
+    Args:
+        edge_geometries: Array with the geometries (longitude, latitude) of the edges of the graph
+        tile: The tile dictionary (with its corners)
+        density: The amount of lines per edge (e.g. 0.5 draws half of the edges, 2 draws every edge twice, as the
+            overlapping lines of the TomTom tiles)
+        seed: The seed of the random generator
+        extent: The extent of the tile
+        layer_name: The layer with the traffic flow
+    Returns:
+        The decoded tile"""
+    rng = np.random.default_rng(seed)
+
+    # The lines are clipped to the tile and snapped to its integer grid (removing the repeated points)
+    lines = shapely.transform(edge_geometries, lambda points: lonlat_to_tile_coordinates(points, tile, extent))
+    lines = shapely.set_precision(shapely.clip_by_rect(lines, 0, 0, extent, extent), 1.0)
+    lines = lines[~shapely.is_empty(lines)]
+
+    counts = np.floor(density).astype(int) + (rng.random(len(lines)) < density % 1)
+    lines = np.repeat(lines, counts)
+
+    features = []
+    for line, traffic_level, road_type in zip(lines, rng.integers(0, 101, len(lines)),
+                                              rng.integers(0, len(ROAD_TYPES), len(lines))):
+        if isinstance(line, shapely.MultiLineString):
+            geometry = {'type': 'MultiLineString',
+                        'coordinates': [shapely.get_coordinates(part).astype(int).tolist() for part in line.geoms]}
+        elif isinstance(line, shapely.LineString):
+            geometry = {'type': 'LineString', 'coordinates': shapely.get_coordinates(line).astype(int).tolist()}
+        else:
+            continue
+
+        features.append({
+            'geometry': geometry,
+            'properties': {
+                'road_type': ROAD_TYPES[road_type],
+                'traffic_level': traffic_level / 100,
+                'traffic_road_coverage': 'one_side',
+                'left_hand_traffic': False,
+                'road_closure': False
+            },
+            'id': 0,
+            'type': 'Feature'
+        })
+
+    return {layer_name: {'extent': extent, 'version': 2, 'type': 'FeatureCollection', 'features': features}}
+
+
+def generate_synthetic_tiles(graph, tiles, density=1.0, seed=0, extent=SYNTHETIC_TILE_EXTENT):
+    """ Generate a decoded flow tile for every tile of a zone
+    Args:
+        graph: The graph of the zone
+        tiles: The list of tile dictionaries of the zone
+        density: The amount of lines per edge
+        seed: The seed of the random generator (every tile uses the next one)
+        extent: The extent of the tiles
+    Returns:
+        A dictionary with the decoded tiles by tile name"""
+    edge_geometries = ox.convert.graph_to_gdfs(graph, nodes=False)["geometry"].to_numpy()
+    return {tile['name']: generate_synthetic_tile(edge_geometries, tile, density=density, seed=seed + i,
+                                                  extent=extent)
+            for i, tile in enumerate(tiles)}
+
+
+def encode_synthetic_tile(decoded_tile):
+    """ Encode a decoded tile as the raw .pbf of the TomTom API
+    Args:
+        decoded_tile: The decoded tile
+    Returns:
+        The raw bytes of the tile"""
+    layers = []
+    for layer_name, layer in decoded_tile.items():
+        layers.append({
+            'name': layer_name,
+            'features': [{'geometry': shapely.geometry.shape(feature['geometry']).wkt,
+                          'properties': feature['properties']} for feature in layer['features']]
+        })
+        extent = layer['extent']
+    return mapbox_vector_tile.encode(layers, default_options={'extents': extent, 'quantize_bounds': None})
@@ -0,0 +1,203 @@
+import argparse
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from utils.utils_archive import TileArchive, is_datetime_string
+from utils.utils_zone_cache import ensure_compiled_zone
+
+load_dotenv()
+
+# State of every process of the pool
+_worker_zone = None
+_worker_options = None
+
+
+def find_archived_snapshots(tiles, data_dir="data", start=None, end=None):
+    """ Get the snapshots archived for the tiles of a zone (in the TileArchive or in the old data/<tile>/<datetime>.pbf
+    or .pbf.json files)
+    Args:
+        tiles: The list of tile dictionaries of the zone
+        data_dir: The folder where the tiles are archived
+        start: The first datetime string to include (all if None)
+        end: The last datetime string to include (all if None)
+    Returns:
+        The sorted list of datetime strings with at least one archived tile"""
+    archive = TileArchive(data_dir)
+    snapshots = set()
+    for tile in tiles:
+        snapshots.update(archive.datetimes(tile['name'], start=start, end=end))
+
+        tile_dir = f"{data_dir}/{tile['name']}"
+        if not os.path.isdir(tile_dir):
+            continue
+        for filename in os.listdir(tile_dir):
+            datetime_str = filename.split(".")[0]
+            if (filename.endswith(".pbf") or filename.endswith(".pbf.json")) and is_datetime_string(datetime_str):
+                snapshots.add(datetime_str)
+
+    # The datetime strings sort chronologically
+    return sorted(x for x in snapshots if (start is None or x >= start) and (end is None or x <= end))
+
+
+def load_checkpoint(checkpoint_path):
+    """ Get the snapshots already saved by a previous run
+    Args:
+        checkpoint_path: The checkpoint file (one datetime string per line)
+    Returns:
+        A set with the datetime strings"""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def append_checkpoint(checkpoint_path, datetime_strings):
+    with open(checkpoint_path, "a") as file:
+        file.writelines(f"{x}\n" for x in datetime_strings)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _init_worker(zone_id, zones_dir, data_dir, splits, precision, allow_partial):
+    """ Load the zone once in every process of the pool"""
+    global _worker_zone, _worker_options
+    from utils.utils_zone import load_zone
+
+    # Only the errors of the workers are logged
+    logging.getLogger().setLevel(logging.WARNING)
+    _worker_zone = load_zone(zone_id, zones_dir=zones_dir, compiled_cache=True)
+    _worker_options = (TileArchive(data_dir), data_dir, splits, precision, allow_partial)
+
+
+def _backfill_snapshot(datetime_str):
+    """ Process an archived snapshot on a copy of the state of the zone
+    Args:
+        datetime_str: The datetime string of the snapshot
+    Returns:
+        The datetime string, the document of the snapshot (None if it failed or some tile is missing and partial
+        snapshots are not allowed) and the error"""
+    from mongo.entity import Snapshot
+    from pipeline import load_decoded_tile, process_snapshot
+
+    archive, data_dir, splits, precision, allow_partial = _worker_options
+    try:
+        decoded_tiles, missing_tiles = {}, []
+        for tile in _worker_zone['tiles']:
+            try:
+                decoded_tiles[tile['name']] = load_decoded_tile(tile, datetime_str, data_dir=data_dir,
+                                                                 archive=archive)
+            except FileNotFoundError:
+                missing_tiles.append(tile['name'])
+
+        # A snapshot without some of its tiles would be saved (and checkpointed) as if those edges had no traffic
+        if missing_tiles and not allow_partial:
+            return datetime_str, None, f"Missing tiles: {', '.join(missing_tiles)}"
+
+        # The traffic state of the zone is reset by every snapshot, so the graph is not copied
+        # The workers get the datetimes in any order, so the interpolation does not start from the previous snapshot
+        traffic_state = process_snapshot(datetime_str, _worker_zone, decoded_tiles=decoded_tiles, splits=splits,
+                                         precision=precision, interpolation_method='direct')
+        snapshot = Snapshot.generate_snapshot(traffic_state, datetime_str, _worker_zone['edge_table'],
+                                              _worker_zone['graph_signature'])
+        return datetime_str, snapshot.get_dict(id_mongo=False), None
+    except Exception:
+        return datetime_str, None, traceback.format_exc()
+
+
+def _save_batch(collection, documents, checkpoint_path):
+    """ Insert a batch of snapshots (skipping the ones already in the collection) and checkpoint them"""
+    filenames = [document['filename'] for document in documents]
+    existing = set(collection.distinct('filename', {'filename': {'$in': filenames}}))
+    new_documents = [document for document in documents if document['filename'] not in existing]
+    if new_documents:
+        collection.insert_many(new_documents, ordered=False)
+    append_checkpoint(checkpoint_path, filenames)
+    return len(new_documents)
+
+
+def backfill_zone(zone_id, zones_dir="zonas", data_dir="data", workers=None, batch_size=100, checkpoint_path=None,
+                  start=None, end=None, collection=None, splits=15, precision=3, allow_partial=False):
+    """ Process the archived snapshots of a zone in a process pool and save them in bulk, resuming a previous run
+    Args:
+        zone_id: The zone to backfill
+        zones_dir: The folder with the zones
+        data_dir: The folder where the tiles are archived
+        workers: The amount of processes (the amount of CPUs if None)
+        batch_size: The amount of snapshots of every bulk insert
+        checkpoint_path: The file with the snapshots already saved ('backfill_<zone>.checkpoint' if None)
+        start: The first datetime string to process (all if None)
+        end: The last datetime string to process (all if None)
+        collection: The collection where the snapshots are saved (the snapshot collection of the zone if None)
+        splits: The length of the split parts
+        precision: The precision to check the traffic level of the interpolations
+        allow_partial: Save the snapshots with some of their tiles missing (they fail if False)
+    Returns:
+        The amount of snapshots saved and the datetime strings that failed"""
+    if checkpoint_path is None:
+        checkpoint_path = f"backfill_{zone_id}.checkpoint"
+    if collection is None:
+        from mongo.spool import get_snapshot_collections
+        collection = get_snapshot_collections()[zone_id]
+
+    with open(f"{zones_dir}/{zone_id}/{zone_id}_tiles.json", encoding='utf8', mode='r') as file:
+        tiles = json.load(file)['tiles']
+
+    # Compiled here, so the processes of the pool only load it (a failed initializer breaks the whole pool)
+    ensure_compiled_zone(zone_id, zones_dir=zones_dir)
+
+    done = load_checkpoint(checkpoint_path)
+    snapshots = [x for x in find_archived_snapshots(tiles, data_dir=data_dir, start=start, end=end) if x not in done]
+    logging.info(f"Backfilling {len(snapshots)} snapshots of {zone_id} ({len(done)} already done)")
+
+    start_time = time.monotonic()
+    saved, failed, batch = 0, [], []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(zone_id, zones_dir, data_dir, splits, precision, allow_partial)) as executor:
+        for i, (datetime_str, document, error) in enumerate(executor.map(_backfill_snapshot, snapshots,
+                                                                         chunksize=4)):
+            if error is not None:
+                logging.error(f"Error processing {datetime_str}: {error}")
+                failed.append(datetime_str)
+                continue
+
+            batch.append(document)
+            if len(batch) >= batch_size:
+                saved += _save_batch(collection, batch, checkpoint_path)
+                batch = []
+                elapsed = time.monotonic() - start_time
+                logging.info(f"{i + 1}/{len(snapshots)} snapshots in {elapsed:.1f} s "
+                             f"({(i + 1) / elapsed:.1f} snapshots/s)")
+
+        if batch:
+            saved += _save_batch(collection, batch, checkpoint_path)
+
+    logging.info(f"Backfill of {zone_id} finished: {saved} snapshots saved, {len(failed)} failed, "
+                 f"{time.monotonic() - start_time:.1f} s")
+    return saved, failed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(encoding='utf-8', level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Reprocess the archived tiles of a zone and save the snapshots")
+    parser.add_argument("zone", help="The zone to backfill (e.g. teatinos)")
+    parser.add_argument("--data-dir", default="data", help="The folder where the tiles are archived")
+    parser.add_argument("--zones-dir", default="zonas", help="The folder with the zones")
+    parser.add_argument("--workers", type=int, default=None, help="The amount of processes")
+    parser.add_argument("--batch-size", type=int, default=100, help="The amount of snapshots of every bulk insert")
+    parser.add_argument("--checkpoint", default=None, help="The checkpoint file of the run")
+    parser.add_argument("--start", default=None, help="The first datetime to process (%%Y_%%m_%%d_%%H_%%M_%%S)")
+    parser.add_argument("--end", default=None, help="The last datetime to process (%%Y_%%m_%%d_%%H_%%M_%%S)")
+    parser.add_argument("--allow-partial", action="store_true",
+                        help="Save the snapshots with some of their tiles missing (by default they fail)")
+    args = parser.parse_args()
+
+    backfill_zone(args.zone, zones_dir=args.zones_dir, data_dir=args.data_dir, workers=args.workers,
+                  batch_size=args.batch_size, checkpoint_path=args.checkpoint, start=args.start, end=args.end,
+                  allow_partial=args.allow_partial)
@@ -0,0 +1,47 @@
+import argparse
+import logging
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def build_profiles(zone_id, zones_dir="zonas", start=None, end=None):
+    """ Build the traffic profiles of a zone again from its snapshots in MongoDB (e.g. after a backfill), the scrapper
+    keeps them up to date from then on
+    Args:
+        zone_id: The zone of the profiles
+        zones_dir: The folder with the zones
+        start: The first datetime of the snapshots (all if None)
+        end: The last datetime of the snapshots (all if None)
+    Returns:
+        The amount of slots of the week with snapshots"""
+    from mongo.snapshot_history import SnapshotHistory
+    from mongo.spool import get_snapshot_collections
+    from mongo.traffic_profiles import TrafficProfileStore, get_profile_collections
+    from utils.utils_zone import load_zone
+
+    zone = load_zone(zone_id, zones_dir=zones_dir, compiled_cache=True)
+    history = SnapshotHistory(get_snapshot_collections()[zone_id], zone['edge_table'])
+    store = TrafficProfileStore(get_profile_collections()[zone_id], edge_table=zone['edge_table'])
+    slots = store.rebuild(history.zone_history(start=start, end=end), zone['graph_signature'])
+    logging.info(f"Profiles of {zone_id} built: {slots} slots")
+    return slots
+
+
+if __name__ == "__main__":
+    logging.basicConfig(encoding='utf-8', level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Build the traffic profiles of a zone (by day of the week and 15 "
+                                                 "minutes) again from its snapshots")
+    parser.add_argument("zone", help="The zone of the profiles (e.g. teatinos)")
+    parser.add_argument("--zones-dir", default="zonas", help="The folder with the zones")
+    parser.add_argument("--start", default=None, help="The first datetime of the snapshots (%%Y_%%m_%%d_%%H_%%M_%%S)")
+    parser.add_argument("--end", default=None, help="The last datetime of the snapshots (%%Y_%%m_%%d_%%H_%%M_%%S)")
+    args = parser.parse_args()
+
+    def parse_datetime(datetime_str):
+        return None if datetime_str is None else datetime.strptime(datetime_str, "%Y_%m_%d_%H_%M_%S")
+
+    build_profiles(args.zone, zones_dir=args.zones_dir, start=parse_datetime(args.start), end=parse_datetime(args.end))
@@ -0,0 +1,17 @@
+import argparse
+import logging
+
+from utils.utils_archive import migrate_archive
+
+if __name__ == "__main__":
+    logging.basicConfig(encoding='utf-8', level=logging.WARNING, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Move the tiles archived one file per snapshot into the daily "
+                                                 "segments of the tile archive")
+    parser.add_argument("--data-dir", default="data", help="The folder where the tiles are archived")
+    parser.add_argument("--remove", action="store_true", help="Remove the old files once they are archived")
+    args = parser.parse_args()
+
+    migrated = migrate_archive(args.data_dir, remove=args.remove)
+    for tile_name, count in migrated.items():
+        print(f"{tile_name}: {count} snapshots migrated")
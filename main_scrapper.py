@@ -1,117 +1,47 @@
-import json
 import os
-import time
 import logging
 
-from utils.utils_pbf import extract_tile_pbf_from_url
+from mongo.spool import SnapshotWriter
+from mongo.traffic_profiles import ProfileUpdater, TrafficProfileStore, get_profile_collections
+from utils.utils_metrics import MetricsExporter
+from utils.utils_pbf import TileFetcher
+from utils.utils_profiling import CycleProfiler
+from utils.utils_scheduler import CycleScheduler
 
-import geojson
-from datetime import datetime
 from dotenv import load_dotenv
-from translation import save_in_mongo, get_neighbours_edges, split_features, add_info_to_file, \
-    add_traffic_level_from_file, translate_file_pairs_into_geojson
-import osmnx as ox
+from zone_executor import ZoneExecutor
 
 load_dotenv()
 api_key = os.getenv("TOMTOM_API_KEY")
-
-
-def extract_tiles_pbf_tomtom(selected_zones: dict, message_datetime: str):
-    for zone in selected_zones.values():
-        for tile in zone['tiles']:
-            url = f"https://api.tomtom.com/traffic/map/4/tile/flow/relative/{tile['zoom']}/{tile['x']}/{tile['y']}.pbf?key={api_key}"
-            folder_name = f"data/{tile['name']}/"
-            dir_path = os.path.dirname(folder_name)
-            extract_tile_pbf_from_url(url, message_datetime, dir_path)
-
-
-def save_json_to_mongo(datetime_str: str, zonas_dict: dict, graph_area: str):
-    graph = zonas_dict[graph_area]['graph']
-    neighbours_dictionary = zonas_dict[graph_area]['neightbours']
-    tiles = zonas_dict[graph_area]['tiles']
-    # Translate both tiles files
-    for tile in tiles:
-        dir_output = f"cache/translation/{tile['name']}"
-        dir_input = f"data/{tile['name']}/{datetime_str}.pbf.json"
-
-        # Ensure the output directory exists
-        os.makedirs(dir_output, exist_ok=True)
-
-        outmin = (tile['corners_2'][0], tile['corners_0'][1])
-        outmax = (tile['corners_0'][0], tile['corners_1'][1])
-
-        with open(f"{dir_output}/{datetime_str}.pbf.json", "w") as output_file:
-            output_file.write(
-                json.dumps(
-                    translate_file_pairs_into_geojson(dir_input, outmin, outmax)
-                )
-            )
-
-    logging.info(f"Files translated and saved on 'cache/translation'")
-
-    # Mix the files from the first two folders into the third one
-    files_dirs = [f"cache/translation/{tile['name']}/{datetime_str}.pbf.json" for tile in tiles]
-    dir_output = f"cache/mixed/{datetime_str}.pbf.json"
-    mixed_json = {"type": "FeatureCollection", "features": []}
-
-    for file_dir in files_dirs:
-        with open(file_dir) as file:
-            json_data = json.load(file)
-            mixed_json["features"].extend(json_data["features"])
-
-    # Ensure the output directory exists
-    os.makedirs("cache/mixed", exist_ok=True)
-
-    with open(dir_output, "w") as output_file:
-        output_file.write(json.dumps(mixed_json))
-
-    logging.info(f"Files mixed and saved on 'cache/mixed'")
-
-    # Add information to all the files in the given folder (splits, nearest edge, etc.)
-    dir_input = "cache/mixed"
-    dir_output = "cache/informed"
-    os.makedirs(dir_output, exist_ok=True)
-    add_info_to_file(datetime_str, dir_input, dir_output, graph, splits=15)
-
-    logging.info(f"Files informed and saved on 'cache/informed'")
-
-    # Split the features from the given folder
-    dir_input = "cache/informed"
-    dir_output = "cache/splitted"
-    os.makedirs(dir_output, exist_ok=True)
-    with open(f"{dir_input}/{datetime_str}.pbf.json") as f:
-        split_data = split_features(f)
-
-    with open(f"{dir_output}/{datetime_str}.pbf.json", "w") as output_file:
-        geojson.dump(split_data, output_file)
-
-    logging.info(f"File '{datetime_str}' splitted and saved on '{dir_output}'")
-
-    # Add the traffic level to the edges from a folder
-    dir_input = dir_output
-    with open(f"{dir_input}/{datetime_str}.pbf.json") as f:
-        graph = add_traffic_level_from_file(graph, f, datetime_str,
-                                            neighbours_dictionary=neighbours_dictionary,
-                                            precision=3)
-
-    logging.info(f"Traffic level added to the graph")
-
-    # Save the traffic level and additional info in dates collection in MongoDB
-    # TODO: si en un futuro se cambia a una maquina en la nube (con acceso a ficheros locales para la cache)
-    # TODO: lo único que habría que cambiar sería la ruta de la base de datos de MongoDB
-    save_in_mongo(datetime_str, graph, graph_area)
-
-    logging.info(f"Data saved in MongoDB")
-
-    # Delete the files
-    dirs = [*[f"cache/translation/{tile['name']}" for tile in tiles],
-            "cache/mixed", "cache/informed",
-            "cache/splitted"]
-    for directory in dirs:
-        for filename in os.listdir(directory):
-            os.remove(f"{directory}/{filename}")
-
-    logging.info(f"{datetime_str}: Cached Files deleted")
+debug_cache = os.getenv("SCRAPPER_DEBUG_CACHE", "false").lower() in ("1", "true", "yes")
+spool_path = os.getenv("SCRAPPER_SPOOL_PATH", "spool/snapshots.bson")
+keyframe_interval = int(os.getenv("SCRAPPER_KEYFRAME_INTERVAL", "96"))
+delta_threshold = float(os.getenv("SCRAPPER_DELTA_THRESHOLD", "0.01"))
+zone_timeout = float(os.getenv("SCRAPPER_ZONE_TIMEOUT", "600"))
+overrun_policy = os.getenv("SCRAPPER_OVERRUN_POLICY", "coalesce")
+metrics_dir = os.getenv("SCRAPPER_METRICS_DIR", "metrics")
+profile_cycles = int(os.getenv("SCRAPPER_PROFILE_CYCLES", "0"))
+profile_signal_cycles = int(os.getenv("SCRAPPER_PROFILE_SIGNAL_CYCLES", "1"))
+traffic_profiles = os.getenv("SCRAPPER_TRAFFIC_PROFILES", "true").lower() in ("1", "true", "yes")
+
+# Opt-in profiling of the cycles (SCRAPPER_PROFILE_CYCLES at start or 'kill -USR1'), written next to scrapper.log
+profiler = CycleProfiler(os.path.dirname(os.path.abspath("scrapper.log")))
+
+
+@profiler.profile("extract_tiles_pbf_tomtom")
+def extract_tiles_pbf_tomtom(selected_zones: dict, message_datetime: str, fetcher: TileFetcher = None):
+    """ Fetch the tiles of all the zones concurrently, archiving them in the daily segments of 'data/<tile>/'
+    Args:
+        selected_zones: The zones dictionary
+        message_datetime: The datetime string of the cycle
+        fetcher: The fetcher to reuse between cycles (a temporary one is created if not given)
+    Returns:
+        A dictionary with the RawTiles by tile name (decoded by the zones that translate them)"""
+    tiles = [tile for zone in selected_zones.values() for tile in zone['tiles']]
+    if fetcher is None:
+        with TileFetcher(api_key) as temporary_fetcher:
+            return temporary_fetcher.fetch_tiles(tiles, message_datetime)
+    return fetcher.fetch_tiles(tiles, message_datetime)
 
 
 if __name__ == "__main__":
@@ -123,40 +53,72 @@ if __name__ == "__main__":
     file_logging.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
     logging.getLogger().addHandler(file_logging)
 
+    # The zones are profiled in their workers
+    profiler.register("zones")
+    profiler.install_signal(calls=profile_signal_cycles)
+    if profile_cycles:
+        profiler.arm(profile_cycles)
+
     # Zonas
     id_zonas = (
         'teatinos', 'soho'
     )
-    zonas = {
-        x: {
-            'graph': ox.load_graphml(f"zonas/{x}/{x}.graphml"),
-            'tiles': json.load(open(f'zonas/{x}/{x}_tiles.json', encoding='utf8', mode='r'))['tiles']
-        }
-        for x in id_zonas
-    }
-
-    # Create the neighbours dictionary
-    logging.info("Getting the neighbours edges dictionary...")
-
-    for x, y in zonas.items():
-        graph_zona = y['graph']
-        y['neightbours'] = {(u, v): get_neighbours_edges(graph_zona, u, v)
-                            for u, v, data in graph_zona.edges(data=True)}
-        logging.info(f"Neighbours edges dictionary loaded for {x}")
-
-    while True:
-        start_time = time.time()
-        datetime_string = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-
-        # Get the tiles
-        extract_tiles_pbf_tomtom(zonas, datetime_string)
-        #
-        # # Teatinos
-        save_json_to_mongo(datetime_string, zonas, "teatinos")
-        #
-        # # Soho
-        #save_json_to_mongo(datetime_string, zonas, "soho")
-
-        # Calculate elapsed time and sleep for the remaining time to complete 15 minutes
-        elapsed_time = time.time() - start_time
-        time.sleep(max(0.0, 900 - elapsed_time))
+
+    # Every zone is loaded once in its own worker process
+    logging.info("Loading the zones...")
+
+    zone_executor = ZoneExecutor(id_zonas, timeout=zone_timeout, keyframe_interval=keyframe_interval,
+                                 threshold=delta_threshold, debug_dir="cache" if debug_cache else None).start()
+
+    tile_fetcher = TileFetcher(api_key)
+
+    # Snapshots are saved in MongoDB in the background (the backlog of a previous run is replayed), and every snapshot
+    # saved is added to the traffic profiles of its zone
+    profile_updater = None
+    if traffic_profiles:
+        profile_updater = ProfileUpdater({zone_id: TrafficProfileStore(collection)
+                                          for zone_id, collection in get_profile_collections().items()})
+    snapshot_writer = SnapshotWriter(spool_path, on_saved=profile_updater).start()
+
+    # Metrics of every cycle (cycles.jsonl and scrapper.prom), gathered until the scheduler records the cycle
+    metrics_exporter = MetricsExporter(metrics_dir, budget=900)
+    cycles_metrics = {}
+
+    def fetch_cycle(datetime_string):
+        zones = zone_executor.zones
+        decoded_tiles = extract_tiles_pbf_tomtom(zones, datetime_string, fetcher=tile_fetcher)
+        tiles_count = sum(len(zone['tiles']) for zone in zones.values())
+        cycles_metrics[datetime_string] = {'fetch': {
+            'tiles': len(decoded_tiles),
+            'tiles_failed': tiles_count - len(decoded_tiles),
+            'bytes': sum(len(tile.data) for tile in decoded_tiles.values())}}
+        return decoded_tiles
+
+    def process_cycle(datetime_string, decoded_tiles):
+        zones_metrics = cycles_metrics.setdefault(datetime_string, {}).setdefault('zones', {})
+        # Process all the zones at the same time
+        profile_dir = profiler.output_dir if profiler.take("zones") else None
+        for result in zone_executor.run_cycle(datetime_string, decoded_tiles, profile_dir=profile_dir).values():
+            zones_metrics[result.zone_id] = {'elapsed': result.elapsed, 'error': result.error,
+                                             **(result.metrics or {})}
+            if result.error is not None:
+                logging.error(f"Error processing {result.zone_id}: {result.error}")
+                continue
+            snapshot_writer.submit(result.zone_id, result.snapshot)
+            logging.info(f"{result.zone_id} processed in {result.elapsed:.2f} s, data spooled")
+
+    def record_cycle(cycle_record):
+        cycle_metrics = cycles_metrics.pop(cycle_record.datetime_str, {})
+        metrics_exporter.export(cycle_record, fetch=cycle_metrics.get('fetch'), zones=cycle_metrics.get('zones'),
+                                writer=snapshot_writer.get_stats())
+
+    # Cycles on the quarters of the hour, the tiles of a cycle are fetched while the previous one is processed
+    scheduler = CycleScheduler(fetch_cycle, process_cycle, period=900, overrun_policy=overrun_policy,
+                               on_record=record_cycle)
+
+    try:
+        scheduler.run()
+    finally:
+        zone_executor.close()
+        snapshot_writer.close()
+        tile_fetcher.close()
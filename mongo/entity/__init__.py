@@ -1 +1,3 @@
-from .graph import Graph
\ No newline at end of file
+from .graph import Graph
+from .snapshot import Snapshot
+from .traffic_profile import TrafficProfile
\ No newline at end of file
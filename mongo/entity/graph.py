@@ -31,6 +31,23 @@ def _clean_edges_info(graph):
     return graph
 
 
+def get_date_fields(filename):
+    """ Get the date fields of a snapshot from its filename
+    Args:
+        filename: The filename of the date (%Y_%m_%d_%H_%M_%S)
+    Returns:
+        A dictionary with the datetime, hour_minute_string, hour_int, minute_int, day_of_week and hour_float"""
+    date = datetime.strptime(filename.split(".")[0], "%Y_%m_%d_%H_%M_%S")
+    return {
+        "datetime": date,
+        "hour_minute_string": date.strftime("%H:%M"),
+        "hour_int": date.hour,
+        "minute_int": date.minute,
+        "day_of_week": date.strftime("%A"),
+        "hour_float": date.hour + (date.minute / 60.0)
+    }
+
+
 class Graph(ObjetoMongoAbstract):
 
     def __init__(self, filename, datetime,
@@ -74,13 +91,7 @@ class Graph(ObjetoMongoAbstract):
         graph_to_dictionary.pop('nodes', None)
 
         graph_to_dictionary['filename'] = filename
-        graph_to_dictionary["datetime"] = datetime.strptime(filename.split(".")[0], "%Y_%m_%d_%H_%M_%S")
-        graph_to_dictionary["hour_minute_string"] = graph_to_dictionary["datetime"].strftime("%H:%M")
-        graph_to_dictionary["hour_int"] = graph_to_dictionary["datetime"].hour
-        graph_to_dictionary["minute_int"] = graph_to_dictionary["datetime"].minute
-        graph_to_dictionary["day_of_week"] = graph_to_dictionary["datetime"].strftime("%A")
-
-        graph_to_dictionary["hour_float"] = graph_to_dictionary["hour_int"] + (graph_to_dictionary["minute_int"] / 60.0)
+        graph_to_dictionary.update(get_date_fields(filename))
 
         graph_to_dictionary["automated"] = True
 
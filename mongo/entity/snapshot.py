@@ -0,0 +1,204 @@
+import numpy as np
+from mongo_manager import ObjetoMongoAbstract
+
+from mongo.entity.graph import Graph, get_date_fields
+
+# The traffic level (0 - 1) is quantized to 0 - TRAFFIC_LEVEL_SCALE, TRAFFIC_LEVEL_MISSING marks the unknown ones
+TRAFFIC_LEVEL_SCALE = 254
+TRAFFIC_LEVEL_MISSING = 255
+
+
+def quantize_traffic_levels(traffic_level):
+    """ Quantize the traffic levels to uint8
+    Args:
+        traffic_level: Array with the traffic level of every edge (NaN if unknown)
+    Returns:
+        An uint8 array with the quantized traffic levels"""
+    traffic_level = np.asarray(traffic_level, dtype=float)
+    quantized = np.rint(np.clip(traffic_level, 0, 1) * TRAFFIC_LEVEL_SCALE)
+    return np.where(np.isnan(traffic_level), TRAFFIC_LEVEL_MISSING, quantized).astype(np.uint8)
+
+
+def dequantize_traffic_levels(quantized):
+    """ Get the traffic levels of the quantized ones
+    Args:
+        quantized: The uint8 array with the quantized traffic levels
+    Returns:
+        An array with the traffic level of every edge (NaN if unknown)"""
+    quantized = np.asarray(quantized, dtype=np.uint8)
+    return np.where(quantized == TRAFFIC_LEVEL_MISSING, np.nan, quantized / TRAFFIC_LEVEL_SCALE)
+
+
+def decode_quantized_arrays(traffic_level, api_data, current_speed=None):
+    """ Decode the binary arrays of a snapshot document
+    Args:
+        traffic_level: The bytes of the uint8 quantized traffic levels
+        api_data: The bytes of the api_data bitmap
+        current_speed: The bytes of the float32 current speeds (None if they are not needed)
+    Returns:
+        The uint8 quantized traffic levels, the api_data boolean array and the float32 current speeds (None if
+        current_speed is None)"""
+    traffic_level = np.frombuffer(traffic_level, dtype=np.uint8)
+    api_data = np.unpackbits(np.frombuffer(api_data, dtype=np.uint8), count=len(traffic_level),
+                             bitorder='little').astype(bool)
+    if current_speed is not None:
+        current_speed = np.frombuffer(current_speed, dtype=np.float32)
+    return traffic_level, api_data, current_speed
+
+
+def get_snapshot_arrays(traffic_state, edge_table):
+    """ Get the arrays of a snapshot from the TrafficState of a zone
+    Args:
+        traffic_state: The TrafficState with the traffic level
+        edge_table: The EdgeTable of the graph
+    Returns:
+        The traffic level (NaN if unknown), the api_data boolean array and the current speed of every edge"""
+    if len(traffic_state) != len(edge_table):
+        raise ValueError(f"The traffic state has {len(traffic_state)} edges and the edge table {len(edge_table)}")
+    return traffic_state.traffic_level, traffic_state.api_data, edge_table.current_speed(traffic_state.traffic_level)
+
+
+class Snapshot(ObjetoMongoAbstract):
+    """ Columnar snapshot of the traffic of a zone: the dynamic attributes of the edges as binary arrays aligned with
+    the EdgeTable of the zone (traffic_level as uint8, api_data as a bitmap and current_speed as float32)
+
+    A 'keyframe' has the values of every edge. A 'delta' only has the values of the edges in 'positions' (uint32) that
+    changed since the previous snapshot, and 'keyframe' is the datetime of the keyframe it is applied onto."""
+
+    def __init__(self, filename, datetime,
+                 hour_minute_string, hour_int,
+                 minute_int, day_of_week, hour_float,
+                 graph_signature, edges_count,
+                 traffic_level, api_data, current_speed,
+                 automated, kind='keyframe', keyframe=None, positions=None, _id=None, **kwargs):
+        super().__init__(_id=_id, **kwargs)
+        self.filename = filename
+        self.datetime = datetime
+        self.hour_minute_string = hour_minute_string
+        self.hour_int = hour_int
+        self.minute_int = minute_int
+        self.day_of_week = day_of_week
+        self.hour_float = hour_float
+        self.graph_signature = graph_signature
+        self.edges_count = edges_count
+        self.traffic_level = traffic_level
+        self.api_data = api_data
+        self.current_speed = current_speed
+        self.automated = automated
+        self.kind = kind
+        self.keyframe = keyframe if keyframe is not None else datetime
+        self.positions = positions
+
+    def __str__(self):
+        return f'{self.datetime}: {self.edges_count} edges ({self.kind})'
+
+    @classmethod
+    def from_arrays(cls, filename: str, graph_signature: str, traffic_level, api_data, current_speed):
+        """ Build the keyframe of the given arrays
+        Args:
+            filename: The filename of the date
+            graph_signature: The signature of the graph the arrays are aligned with
+            traffic_level: Array with the traffic level of every edge (NaN if unknown)
+            api_data: Boolean array with the edges with API data
+            current_speed: Array with the current speed of every edge
+        Returns:
+            The Snapshot"""
+        return cls.from_quantized(filename, graph_signature, quantize_traffic_levels(traffic_level), api_data,
+                                  current_speed)
+
+    @classmethod
+    def from_quantized(cls, filename: str, graph_signature: str, traffic_level, api_data, current_speed,
+                       edges_count=None, positions=None, keyframe=None):
+        """ Build a keyframe, or a delta if positions is given, of the given arrays
+        Args:
+            filename: The filename of the date
+            graph_signature: The signature of the graph the arrays are aligned with
+            traffic_level: The uint8 array with the quantized traffic levels
+            api_data: Boolean array with the edges with API data
+            current_speed: Array with the current speed of the edges
+            edges_count: The amount of edges of the graph (the length of the arrays if None)
+            positions: The positions of the edges of the arrays (delta) or None (keyframe)
+            keyframe: The datetime of the keyframe of the delta
+        Returns:
+            The Snapshot"""
+        api_data = np.asarray(api_data, dtype=bool)
+        return cls(filename=filename,
+                   graph_signature=graph_signature,
+                   edges_count=edges_count if edges_count is not None else len(api_data),
+                   traffic_level=np.asarray(traffic_level, dtype=np.uint8).tobytes(),
+                   api_data=np.packbits(api_data, bitorder='little').tobytes(),
+                   current_speed=np.asarray(current_speed, dtype=np.float32).tobytes(),
+                   automated=True,
+                   kind='keyframe' if positions is None else 'delta',
+                   keyframe=keyframe,
+                   positions=np.asarray(positions, dtype=np.uint32).tobytes() if positions is not None else None,
+                   **get_date_fields(filename))
+
+    @classmethod
+    def generate_snapshot(cls, traffic_state, filename: str, edge_table, graph_signature: str):
+        """ Build the snapshot of the TrafficState of a zone
+        Args:
+            traffic_state: The TrafficState with the traffic level
+            filename: The filename of the date
+            edge_table: The EdgeTable of the graph
+            graph_signature: The signature of the graph
+        Returns:
+            The Snapshot"""
+        return cls.from_arrays(filename, graph_signature, *get_snapshot_arrays(traffic_state, edge_table))
+
+    def get_positions(self):
+        """ Get the positions of the edges of the arrays (all of them in a keyframe)"""
+        if self.positions is None:
+            return np.arange(self.edges_count)
+        return np.frombuffer(self.positions, dtype=np.uint32).astype(int)
+
+    def get_quantized_arrays(self):
+        """ Decode the arrays of the snapshot (only the edges of get_positions in a delta)
+        Returns:
+            The uint8 quantized traffic levels, the api_data boolean array and the float32 current speeds"""
+        return decode_quantized_arrays(self.traffic_level, self.api_data, self.current_speed)
+
+    def get_arrays(self):
+        """ Decode the arrays of a keyframe
+        Returns:
+            The traffic level (NaN if unknown), the api_data boolean array and the current speed of every edge"""
+        if self.kind != 'keyframe':
+            raise ValueError(f"The snapshot {self.filename} is a delta, rebuild it with SnapshotReader")
+        traffic_level, api_data, current_speed = self.get_quantized_arrays()
+        return dequantize_traffic_levels(traffic_level), api_data, current_speed.astype(float)
+
+    def to_links(self, edge_table):
+        """ Expand the snapshot into the links of the node_link_data dumps of Graph
+        Args:
+            edge_table: The EdgeTable of the graph of the snapshot
+        Returns:
+            The list of links"""
+        if len(edge_table) != self.edges_count:
+            raise ValueError(f"The snapshot has {self.edges_count} edges and the edge table {len(edge_table)}")
+
+        traffic_level, api_data, current_speed = self.get_arrays()
+
+        links = []
+        for (u, v, key), static_link, level, api, speed in zip(edge_table.edges, edge_table.static_links,
+                                                               traffic_level.tolist(), api_data.tolist(),
+                                                               current_speed.tolist()):
+            level = None if level != level else level
+            links.append({**static_link,
+                          'most_recent': {'traffic_level': level, 'api_data': api, 'date': self.filename},
+                          'traffic_level': level,
+                          'api_data': api,
+                          'current_speed': speed,
+                          'source': u,
+                          'target': v,
+                          'key': key})
+        return links
+
+    def to_graph(self, edge_table):
+        """ Expand the snapshot into a Graph document
+        Args:
+            edge_table: The EdgeTable of the graph of the snapshot
+        Returns:
+            The Graph"""
+        return Graph(filename=self.filename, datetime=self.datetime, hour_minute_string=self.hour_minute_string,
+                     hour_int=self.hour_int, minute_int=self.minute_int, day_of_week=self.day_of_week,
+                     hour_float=self.hour_float, links=self.to_links(edge_table), automated=self.automated)
@@ -0,0 +1,140 @@
+import numpy as np
+from mongo_manager import ObjetoMongoAbstract
+
+from mongo.entity.snapshot import dequantize_traffic_levels, quantize_traffic_levels
+
+
+def merge_statistics(count, mean, m2, count_b, mean_b, m2_b):
+    """ Merge the running statistics of two sets of samples (Chan et al.), a single sample (count_b = 1, m2_b = 0) is
+    the update of Welford
+    Args:
+        count, mean, m2: Arrays with the count, the mean (0 if the count is 0) and the sum of squared differences from
+            the mean of the first set
+        count_b, mean_b, m2_b: The ones of the second set
+    Returns:
+        The count, the mean and the sum of squared differences of both sets"""
+    total = count + count_b
+    delta = mean_b - mean
+    weight = count_b / np.maximum(total, 1)
+    return total, mean + delta * weight, m2 + m2_b + delta ** 2 * count * weight
+
+
+class TrafficProfile(ObjetoMongoAbstract):
+    """ Running statistics of the traffic level of every edge of a zone in a slot of the week (a day of the week and
+    15 minutes of the day), as binary arrays aligned with the EdgeTable of the zone: the count (uint32), the mean and
+    the sum of squared differences of Welford (float32) and the minimum and maximum (quantized as the snapshots)
+
+    'last_datetime' is the last snapshot added, an older one is not added again."""
+
+    def __init__(self, day_of_week, slot, slot_minutes, hour_float,
+                 graph_signature, edges_count,
+                 count, mean, m2, minimum, maximum,
+                 samples, last_datetime, _id=None, **kwargs):
+        super().__init__(_id=_id, **kwargs)
+        self.day_of_week = day_of_week
+        self.slot = slot
+        self.slot_minutes = slot_minutes
+        self.hour_float = hour_float
+        self.graph_signature = graph_signature
+        self.edges_count = edges_count
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.samples = samples
+        self.last_datetime = last_datetime
+
+    def __str__(self):
+        return f'{self.day_of_week} {self.hour_float:05.2f}: {self.samples} snapshots of {self.edges_count} edges'
+
+    @classmethod
+    def from_arrays(cls, day_of_week, slot, slot_minutes, graph_signature, count, mean, m2, minimum, maximum,
+                    samples=0, last_datetime=None):
+        """ Build the profile of a slot of the given arrays
+        Args:
+            day_of_week: The name of the day of the week
+            slot: The slot of the day
+            slot_minutes: The minutes of every slot
+            graph_signature: The signature of the graph the arrays are aligned with
+            count: Array with the amount of known traffic levels of every edge
+            mean: Array with the mean traffic level of every edge
+            m2: Array with the sum of squared differences from the mean of every edge
+            minimum: Array with the minimum traffic level of every edge (NaN if unknown)
+            maximum: Array with the maximum traffic level of every edge (NaN if unknown)
+            samples: The amount of snapshots added
+            last_datetime: The datetime of the last snapshot added
+        Returns:
+            The TrafficProfile"""
+        count = np.asarray(count, dtype=np.uint32)
+        return cls(day_of_week=day_of_week,
+                   slot=slot,
+                   slot_minutes=slot_minutes,
+                   hour_float=slot * slot_minutes / 60.0,
+                   graph_signature=graph_signature,
+                   edges_count=len(count),
+                   count=count.tobytes(),
+                   mean=np.asarray(mean, dtype=np.float32).tobytes(),
+                   m2=np.asarray(m2, dtype=np.float32).tobytes(),
+                   minimum=quantize_traffic_levels(minimum).tobytes(),
+                   maximum=quantize_traffic_levels(maximum).tobytes(),
+                   samples=samples,
+                   last_datetime=last_datetime)
+
+    @classmethod
+    def empty(cls, day_of_week, slot, slot_minutes, graph_signature, edges_count):
+        """ Build the profile of a slot without snapshots"""
+        return cls.from_arrays(day_of_week, slot, slot_minutes, graph_signature, np.zeros(edges_count),
+                               np.zeros(edges_count), np.zeros(edges_count), np.full(edges_count, np.nan),
+                               np.full(edges_count, np.nan))
+
+    def get_arrays(self):
+        """ Decode the arrays of the profile
+        Returns:
+            The count, the mean (NaN if the count is 0), the sum of squared differences, the minimum and the maximum
+            (NaN if unknown) of every edge"""
+        count = np.frombuffer(self.count, dtype=np.uint32)
+        mean = np.frombuffer(self.mean, dtype=np.float32).astype(float)
+        m2 = np.frombuffer(self.m2, dtype=np.float32).astype(float)
+        minimum = dequantize_traffic_levels(np.frombuffer(self.minimum, dtype=np.uint8))
+        maximum = dequantize_traffic_levels(np.frombuffer(self.maximum, dtype=np.uint8))
+        return count, np.where(count > 0, mean, np.nan), m2, minimum, maximum
+
+    def get_variance(self, ddof=1):
+        """ Get the variance of the traffic level of every edge (NaN with less than ddof + 1 samples)"""
+        count, _, m2, _, _ = self.get_arrays()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > ddof, m2 / (count.astype(float) - ddof), np.nan)
+
+    def add(self, traffic_level, date):
+        """ Add the traffic level of a snapshot (the edges without traffic level are not counted)
+        Args:
+            traffic_level: Array with the traffic level of every edge (NaN if unknown)
+            date: The datetime of the snapshot
+        Returns:
+            A boolean indicating if the snapshot was added (False if it is not newer than the last one)"""
+        if self.last_datetime is not None and date <= self.last_datetime:
+            return False
+
+        traffic_level = np.asarray(traffic_level, dtype=float)
+        known = ~np.isnan(traffic_level)
+        self.merge(known.astype(float), np.where(known, traffic_level, 0.0), np.zeros(len(traffic_level)),
+                   traffic_level, traffic_level, samples=1, last_datetime=date)
+        return True
+
+    def merge(self, count_b, mean_b, m2_b, minimum_b, maximum_b, samples=0, last_datetime=None):
+        """ Merge the statistics of other samples of the slot (see merge_statistics)"""
+        count, mean, m2, minimum, maximum = self.get_arrays()
+        count, mean, m2 = merge_statistics(count.astype(float), np.nan_to_num(mean), m2, np.asarray(count_b, float),
+                                           np.nan_to_num(np.asarray(mean_b, float)), np.asarray(m2_b, float))
+        minimum = np.fmin(minimum, minimum_b)
+        maximum = np.fmax(maximum, maximum_b)
+
+        self.count = count.astype(np.uint32).tobytes()
+        self.mean = mean.astype(np.float32).tobytes()
+        self.m2 = m2.astype(np.float32).tobytes()
+        self.minimum = quantize_traffic_levels(minimum).tobytes()
+        self.maximum = quantize_traffic_levels(maximum).tobytes()
+        self.samples += samples
+        if last_datetime is not None and (self.last_datetime is None or last_datetime > self.last_datetime):
+            self.last_datetime = last_datetime
@@ -1,2 +1,6 @@
 from .repository_graph import RepositorioGraph
-from .repository_graph_soho import RepositorioGraphSoho
\ No newline at end of file
+from .repository_graph_soho import RepositorioGraphSoho
+from .repository_snapshot import RepositorioSnapshot
+from .repository_snapshot_soho import RepositorioSnapshotSoho
+from .repository_traffic_profile import RepositorioTrafficProfile
+from .repository_traffic_profile_soho import RepositorioTrafficProfileSoho
\ No newline at end of file
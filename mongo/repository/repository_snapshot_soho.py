@@ -0,0 +1,8 @@
+import os
+from mongo_manager import RepositoryBase
+from mongo.entity.snapshot import Snapshot
+
+
+class RepositorioSnapshotSoho(RepositoryBase[Snapshot]):
+    def __init__(self):
+        super().__init__(os.getenv('MONGO_COLLECTION_SNAPSHOTS_SOHO'), Snapshot)
@@ -0,0 +1,8 @@
+import os
+from mongo_manager import RepositoryBase
+from mongo.entity.traffic_profile import TrafficProfile
+
+
+class RepositorioTrafficProfile(RepositoryBase[TrafficProfile]):
+    def __init__(self):
+        super().__init__(os.getenv('MONGO_COLLECTION_PROFILES_TEATINOS'), TrafficProfile)
@@ -0,0 +1,165 @@
+import numpy as np
+import pymongo
+
+from mongo.entity.snapshot import Snapshot, get_snapshot_arrays, quantize_traffic_levels, \
+    TRAFFIC_LEVEL_MISSING, TRAFFIC_LEVEL_SCALE
+
+
+class SnapshotEncoder:
+    """ Encoder of the snapshots of a zone as keyframes and deltas
+
+    A keyframe is written every 'keyframe_interval' snapshots, and in between only the edges whose traffic level
+    changed more than 'threshold' (or whose api_data changed) since the state a reader rebuilds, so the error of the
+    skipped changes never accumulates.
+    Args:
+        edge_table: The EdgeTable of the zone
+        graph_signature: The signature of the graph of the zone
+        keyframe_interval: The amount of snapshots between keyframes (1 to write only keyframes)
+        threshold: The minimum change of the traffic level (0 - 1) written in a delta"""
+
+    def __init__(self, edge_table, graph_signature, keyframe_interval=96, threshold=0.01):
+        self.edge_table = edge_table
+        self.graph_signature = graph_signature
+        self.keyframe_interval = keyframe_interval
+        self.threshold = threshold
+
+        self.keyframe = None
+        self.snapshots_since_keyframe = 0
+        self.state = None
+
+    def reset(self):
+        """ Write a keyframe with the next snapshot"""
+        self.keyframe = None
+        self.state = None
+
+    def encode_arrays(self, filename, traffic_level, api_data, current_speed):
+        """ Encode the arrays of a snapshot
+        Args:
+            filename: The filename of the date
+            traffic_level: Array with the traffic level of every edge (NaN if unknown)
+            api_data: Boolean array with the edges with API data
+            current_speed: Array with the current speed of every edge
+        Returns:
+            The Snapshot (keyframe or delta)"""
+        quantized = quantize_traffic_levels(traffic_level)
+        api_data = np.asarray(api_data, dtype=bool)
+        current_speed = np.asarray(current_speed, dtype=np.float32)
+
+        if self.state is None or self.snapshots_since_keyframe + 1 >= self.keyframe_interval:
+            snapshot = Snapshot.from_quantized(filename, self.graph_signature, quantized, api_data, current_speed)
+            self.keyframe = snapshot.datetime
+            self.snapshots_since_keyframe = 0
+            self.state = (quantized.copy(), api_data.copy(), current_speed.copy())
+            return snapshot
+
+        state_level, state_api_data, state_speed = self.state
+        changed = (np.abs(quantized.astype(int) - state_level) > self.threshold * TRAFFIC_LEVEL_SCALE) | \
+            ((quantized == TRAFFIC_LEVEL_MISSING) != (state_level == TRAFFIC_LEVEL_MISSING)) | \
+            (api_data != state_api_data)
+        positions = np.flatnonzero(changed)
+
+        state_level[positions] = quantized[positions]
+        state_api_data[positions] = api_data[positions]
+        state_speed[positions] = current_speed[positions]
+        self.snapshots_since_keyframe += 1
+
+        return Snapshot.from_quantized(filename, self.graph_signature, quantized[positions], api_data[positions],
+                                       current_speed[positions], edges_count=len(self.edge_table),
+                                       positions=positions, keyframe=self.keyframe)
+
+    def encode(self, traffic_state, filename):
+        """ Encode the TrafficState of the zone
+        Args:
+            traffic_state: The TrafficState with the traffic level
+            filename: The filename of the date
+        Returns:
+            The Snapshot (keyframe or delta)"""
+        return self.encode_arrays(filename, *get_snapshot_arrays(traffic_state, self.edge_table))
+
+
+class SnapshotReader:
+    """ Rebuild the full snapshots of a zone stored as keyframes and deltas (a snapshot without kind is a keyframe)
+    Args:
+        collection: The collection of the snapshots of the zone
+        edge_table: The EdgeTable of the zone (to check the snapshots belong to it)"""
+
+    def __init__(self, collection, edge_table=None):
+        self.collection = collection
+        self.edge_table = edge_table
+
+    def _check(self, snapshot):
+        if self.edge_table is not None and snapshot.edges_count != len(self.edge_table):
+            raise ValueError(f"The snapshot {snapshot.filename} has {snapshot.edges_count} edges and the edge table "
+                             f"{len(self.edge_table)}")
+
+    @staticmethod
+    def _keyframe_of(state, snapshot):
+        """ Get the full keyframe of a rebuilt state"""
+        traffic_level, api_data, current_speed = state
+        rebuilt = Snapshot.from_quantized(snapshot.filename, snapshot.graph_signature, traffic_level, api_data,
+                                          current_speed)
+        rebuilt._id = snapshot.id
+        return rebuilt
+
+    @staticmethod
+    def _apply(state, snapshot):
+        """ Apply a snapshot onto a state (replaced if it is a keyframe)"""
+        traffic_level, api_data, current_speed = snapshot.get_quantized_arrays()
+        if snapshot.kind == 'keyframe':
+            return traffic_level.copy(), api_data.copy(), current_speed.copy()
+
+        positions = snapshot.get_positions()
+        state_level, state_api_data, state_speed = state
+        state_level[positions] = traffic_level
+        state_api_data[positions] = api_data
+        state_speed[positions] = current_speed
+        return state
+
+    def _find(self, filter_dict):
+        cursor = self.collection.find(filter_dict).sort('datetime', pymongo.ASCENDING)
+        return (Snapshot.generar_object_from_dict(document) for document in cursor)
+
+    def _rebuild(self, snapshot):
+        """ Rebuild the state of a snapshot from its keyframe"""
+        if snapshot.kind == 'keyframe':
+            return self._apply(None, snapshot)
+
+        state = None
+        for chained in self._find({'keyframe': snapshot.keyframe, 'datetime': {'$lte': snapshot.datetime}}):
+            state = self._apply(state, chained)
+        if state is None:
+            raise ValueError(f"The keyframe {snapshot.keyframe} of the snapshot {snapshot.filename} does not exist")
+        return state
+
+    def state_at(self, date):
+        """ Rebuild the last snapshot at or before the given datetime
+        Args:
+            date: The datetime
+        Returns:
+            The full Snapshot (a keyframe) or None if there is no snapshot before the datetime"""
+        document = self.collection.find_one({'datetime': {'$lte': date}}, sort=[('datetime', pymongo.DESCENDING)])
+        if document is None:
+            return None
+        snapshot = Snapshot.generar_object_from_dict(document)
+        self._check(snapshot)
+        return self._keyframe_of(self._rebuild(snapshot), snapshot)
+
+    def states_between(self, start, end):
+        """ Rebuild every snapshot between two datetimes, applying the deltas one after the other
+        Args:
+            start: The first datetime (included)
+            end: The last datetime (included)
+        Returns:
+            A generator of full Snapshots (keyframes) in chronological order"""
+        state, keyframe = None, None
+        for snapshot in self._find({'datetime': {'$gte': start, '$lte': end}}):
+            self._check(snapshot)
+            if snapshot.kind == 'keyframe':
+                state = self._apply(None, snapshot)
+            elif state is not None and snapshot.keyframe == keyframe:
+                state = self._apply(state, snapshot)
+            else:
+                # The first delta of the range (or one of another chain) is rebuilt from its keyframe
+                state = self._rebuild(snapshot)
+            keyframe = snapshot.keyframe
+            yield self._keyframe_of(state, snapshot)
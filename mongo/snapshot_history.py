@@ -0,0 +1,319 @@
+import calendar
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pymongo
+
+from mongo.entity.snapshot import decode_quantized_arrays, dequantize_traffic_levels
+
+# Snapshots read from the cursor (and returned) per batch
+HISTORY_BATCH_SIZE = 500
+
+# The indexes follow the equality, sort, range rule: the day of the week (equality), the datetime (the sort and the
+# time range) and the hour (range), so a query only scans the index keys of its time range and the hour is checked
+# in the keys, before fetching a document
+HISTORY_INDEXES = (
+    pymongo.IndexModel([('datetime', pymongo.ASCENDING), ('hour_float', pymongo.ASCENDING)],
+                       name='history_datetime'),
+    pymongo.IndexModel([('day_of_week', pymongo.ASCENDING), ('datetime', pymongo.ASCENDING),
+                        ('hour_float', pymongo.ASCENDING)], name='history_day_of_week'),
+)
+
+# The snapshots of the chain of a keyframe (to rebuild a delta)
+SNAPSHOT_CHAIN_INDEX = pymongo.IndexModel([('keyframe', pymongo.ASCENDING), ('datetime', pymongo.ASCENDING)],
+                                          name='snapshot_chain')
+
+
+def ensure_history_indexes(collection, snapshots=True):
+    """ Create the indexes of the history queries (nothing is done for the ones that already exist)
+    Args:
+        collection: The collection of the snapshots (or of the old Graph documents) of a zone
+        snapshots: A boolean to indicate if the collection has columnar snapshots (their chains are indexed too)
+    Returns:
+        The names of the indexes"""
+    indexes = list(HISTORY_INDEXES) + ([SNAPSHOT_CHAIN_INDEX] if snapshots else [])
+    return collection.create_indexes(indexes)
+
+
+def build_history_filter(start=None, end=None, days_of_week=None, hour_range=None):
+    """ Build the filter of a history query
+    Args:
+        start: The first datetime (included, unbounded if None)
+        end: The last datetime (included, unbounded if None)
+        days_of_week: The days of the week, as their names ('Monday') or their numbers (0 is Monday), all if None
+        hour_range: A tuple (from, to) with the hours (hour_float) of the day, 'from' included and 'to' excluded, that
+            wraps around midnight if 'from' is greater (e.g. (22, 2)), all if None
+    Returns:
+        The filter dictionary"""
+    filter_dict = {}
+    if start is not None or end is not None:
+        filter_dict['datetime'] = {}
+        if start is not None:
+            filter_dict['datetime']['$gte'] = start
+        if end is not None:
+            filter_dict['datetime']['$lte'] = end
+
+    if days_of_week is not None:
+        filter_dict['day_of_week'] = {'$in': [calendar.day_name[day] if isinstance(day, int) else day
+                                              for day in days_of_week]}
+
+    if hour_range is not None:
+        hour_from, hour_to = hour_range
+        if hour_from <= hour_to:
+            filter_dict['hour_float'] = {'$gte': hour_from, '$lt': hour_to}
+        else:
+            filter_dict['$or'] = [{'hour_float': {'$gte': hour_from}}, {'hour_float': {'$lt': hour_to}}]
+
+    return filter_dict
+
+
+class HistoryBatch(NamedTuple):
+    """ Traffic of some edges in some snapshots (one row per snapshot and one column per edge)
+    Args:
+        datetimes: The list with the datetime of every snapshot
+        edges: The list with the edges (u, v, key) of the columns
+        traffic_level: Array (snapshots, edges) with the traffic level (NaN if unknown)
+        api_data: Boolean array (snapshots, edges) with the edges with API data
+        current_speed: Array (snapshots, edges) with the current speed (None if it was not queried)"""
+    datetimes: list
+    edges: list
+    traffic_level: np.ndarray
+    api_data: np.ndarray
+    current_speed: Optional[np.ndarray]
+
+
+def collect_history(batches):
+    """ Join the batches of a history query
+    Args:
+        batches: An iterable of HistoryBatch of the same edges
+    Returns:
+        The HistoryBatch with every snapshot or None if there is no snapshot"""
+    batches = list(batches)
+    if not batches:
+        return None
+    return HistoryBatch(datetimes=[date for batch in batches for date in batch.datetimes],
+                        edges=batches[0].edges,
+                        traffic_level=np.concatenate([batch.traffic_level for batch in batches]),
+                        api_data=np.concatenate([batch.api_data for batch in batches]),
+                        current_speed=None if batches[0].current_speed is None else
+                        np.concatenate([batch.current_speed for batch in batches]))
+
+
+class SnapshotHistory:
+    """ Time-range queries over the columnar snapshots (keyframes and deltas) of a zone
+
+    Only the snapshots of the query are read, through the indexes of ensure_history_indexes, and the cursor is read in
+    batches, so the time of a query depends on the snapshots it returns and not on the size of the collection. The
+    deltas are rebuilt for the selected edges only: from the previous snapshot returned if it is of the same chain, or
+    from the keyframe of the chain. With a day or hour filter, the snapshots of the chain between two returned ones
+    are read too (at most the keyframe interval of the encoder).
+    Args:
+        collection: The collection of the snapshots of the zone
+        edge_table: The EdgeTable of the zone
+        batch_size: The snapshots per batch
+        create_indexes: A boolean to indicate if the indexes of the queries should be created"""
+
+    def __init__(self, collection, edge_table, batch_size=HISTORY_BATCH_SIZE, create_indexes=True):
+        self.collection = collection
+        self.edge_table = edge_table
+        self.batch_size = batch_size
+        if create_indexes:
+            ensure_history_indexes(collection)
+
+    @staticmethod
+    def _projection(include_speed):
+        fields = ['datetime', 'kind', 'keyframe', 'positions', 'edges_count', 'traffic_level', 'api_data']
+        return {field: 1 for field in fields + (['current_speed'] if include_speed else [])}
+
+    def _apply(self, state, document, selected, include_speed):
+        """ Apply a snapshot document onto the state (the quantized arrays of the selected edges, replaced if the
+        document is a keyframe)"""
+        traffic_level, api_data, current_speed = decode_quantized_arrays(
+            document['traffic_level'], document['api_data'], document['current_speed'] if include_speed else None)
+
+        if document.get('kind', 'keyframe') == 'keyframe':
+            if document['edges_count'] != len(self.edge_table):
+                raise ValueError(f"The snapshot {document['datetime']} has {document['edges_count']} edges and the "
+                                 f"edge table {len(self.edge_table)}")
+            # A copy, the arrays of the document are read-only and the deltas are applied onto the state
+            return [None if array is None else array.copy() if selected is None else array[selected]
+                    for array in (traffic_level, api_data, current_speed)]
+
+        # The positions of a delta are sorted
+        positions = np.frombuffer(document['positions'], dtype=np.uint32).astype(int)
+        if selected is None:
+            target, source = positions, slice(None)
+        else:
+            found = np.minimum(np.searchsorted(positions, selected), max(len(positions) - 1, 0))
+            in_delta = (positions[found] == selected) if len(positions) else np.zeros(len(selected), dtype=bool)
+            target, source = in_delta, found[in_delta]
+
+        for state_array, array in zip(state, (traffic_level, api_data, current_speed)):
+            if array is not None:
+                state_array[target] = array[source]
+        return state
+
+    def _advance(self, state, keyframe, after, before, selected, include_speed):
+        """ Apply the snapshots of the chain of a keyframe that are after a datetime (from the keyframe if the state is
+        None) and before another one"""
+        dates = {'$lt': before}
+        if state is not None:
+            dates['$gt'] = after
+        cursor = self.collection.find({'keyframe': keyframe, 'datetime': dates}, self._projection(include_speed))
+        for document in cursor.sort('datetime', pymongo.ASCENDING).batch_size(self.batch_size):
+            if state is None and document.get('kind', 'keyframe') != 'keyframe':
+                break
+            state = self._apply(state, document, selected, include_speed)
+
+        if state is None:
+            raise ValueError(f"The keyframe {keyframe} of the snapshot {before} does not exist")
+        return state
+
+    def _batch(self, rows, edges):
+        datetimes = [date for date, _ in rows]
+        traffic_level = dequantize_traffic_levels(np.stack([state[0] for _, state in rows]))
+        api_data = np.stack([state[1] for _, state in rows])
+        current_speed = np.stack([state[2] for _, state in rows]).astype(float) if rows[0][1][2] is not None else None
+        return HistoryBatch(datetimes, edges, traffic_level, api_data, current_speed)
+
+    def _query(self, filter_dict, selected, edges, include_speed, batch_size):
+        batch_size = batch_size or self.batch_size
+        # Without a day or hour filter the range has every snapshot between two returned ones
+        filtered = set(filter_dict) != {'datetime'} and bool(filter_dict)
+
+        cursor = self.collection.find(filter_dict, self._projection(include_speed))
+        cursor = cursor.sort('datetime', pymongo.ASCENDING).batch_size(batch_size)
+
+        state, keyframe, last_datetime = None, None, None
+        rows = []
+        for document in cursor:
+            if document.get('kind', 'keyframe') == 'keyframe':
+                state = self._apply(None, document, selected, include_speed)
+            else:
+                if state is None or document['keyframe'] != keyframe:
+                    state = self._advance(None, document['keyframe'], None, document['datetime'], selected,
+                                          include_speed)
+                elif filtered:
+                    state = self._advance(state, keyframe, last_datetime, document['datetime'], selected,
+                                          include_speed)
+                state = self._apply(state, document, selected, include_speed)
+
+            keyframe = document.get('keyframe', document['datetime'])
+            last_datetime = document['datetime']
+            rows.append((document['datetime'], [array.copy() if array is not None else None for array in state]))
+            if len(rows) >= batch_size:
+                yield self._batch(rows, edges)
+                rows = []
+
+        if rows:
+            yield self._batch(rows, edges)
+
+    def edge_history(self, edges, start=None, end=None, days_of_week=None, hour_range=None, include_speed=False,
+                     batch_size=None):
+        """ Get the traffic of some edges in the snapshots of a time range
+        Args:
+            edges: The list of edges (u, v, key)
+            start: The first datetime (included, unbounded if None)
+            end: The last datetime (included, unbounded if None)
+            days_of_week: The days of the week (see build_history_filter)
+            hour_range: The range of hours of the day (see build_history_filter)
+            include_speed: A boolean to indicate if the current speed should be returned
+            batch_size: The snapshots per batch (the one of the history if None)
+        Returns:
+            A generator of HistoryBatch in chronological order"""
+        edges = [tuple(edge) for edge in edges]
+        return self._query(build_history_filter(start, end, days_of_week, hour_range),
+                           self.edge_table.positions(edges), edges, include_speed, batch_size)
+
+    def zone_history(self, start=None, end=None, days_of_week=None, hour_range=None, include_speed=False,
+                     batch_size=None):
+        """ Get the traffic of every edge of the zone in the snapshots of a time range (see edge_history)
+        Returns:
+            A generator of HistoryBatch in chronological order"""
+        return self._query(build_history_filter(start, end, days_of_week, hour_range), None, self.edge_table.edges,
+                           include_speed, batch_size)
+
+
+class GraphHistory:
+    """ Time-range queries over the old Graph documents of a zone (the ones of RepositorioGraph and
+    RepositorioGraphSoho, with a list of links per snapshot)
+
+    The documents are read through the indexes of ensure_history_indexes and the links of the selected edges are
+    filtered in the server, so only they (and the few other links between their nodes) are transferred.
+    Args:
+        collection: The collection of the Graph documents of the zone
+        edge_table: The EdgeTable of the zone
+        batch_size: The snapshots per batch
+        create_indexes: A boolean to indicate if the indexes of the queries should be created"""
+
+    def __init__(self, collection, edge_table, batch_size=HISTORY_BATCH_SIZE, create_indexes=True):
+        self.collection = collection
+        self.edge_table = edge_table
+        self.batch_size = batch_size
+        if create_indexes:
+            ensure_history_indexes(collection, snapshots=False)
+
+    def _query(self, filter_dict, edges, selected_only, include_speed, batch_size):
+        batch_size = batch_size or self.batch_size
+        link_fields = ['source', 'target', 'key', 'traffic_level', 'api_data'] + (['current_speed'] if include_speed
+                                                                                  else [])
+        links = {'$map': {'input': '$links', 'as': 'link',
+                          'in': {field: f'$$link.{field}' for field in link_fields}}}
+        if selected_only:
+            # The server keeps the links between the nodes of the edges, the exact edges are picked below
+            links['$map']['input'] = {'$filter': {
+                'input': '$links', 'as': 'link',
+                'cond': {'$and': [{'$in': ['$$link.source', sorted({u for u, v, key in edges})]},
+                                  {'$in': ['$$link.target', sorted({v for u, v, key in edges})]}]}}}
+
+        pipeline = [{'$match': filter_dict},
+                    {'$sort': {'datetime': pymongo.ASCENDING}},
+                    {'$project': {'_id': 0, 'datetime': 1, 'links': links}}]
+        cursor = self.collection.aggregate(pipeline, batchSize=batch_size, allowDiskUse=True)
+
+        index = {edge: position for position, edge in enumerate(edges)}
+        rows = []
+        for document in cursor:
+            traffic_level = np.full(len(edges), np.nan)
+            api_data = np.zeros(len(edges), dtype=bool)
+            current_speed = np.zeros(len(edges)) if include_speed else None
+            for link in document['links']:
+                position = index.get((link['source'], link['target'], link.get('key', 0)))
+                if position is None:
+                    continue
+                traffic_level[position] = np.nan if link.get('traffic_level') is None else link['traffic_level']
+                api_data[position] = bool(link.get('api_data', False))
+                if include_speed:
+                    current_speed[position] = link.get('current_speed', 0.0)
+
+            rows.append((document['datetime'], traffic_level, api_data, current_speed))
+            if len(rows) >= batch_size:
+                yield self._batch(rows, edges)
+                rows = []
+
+        if rows:
+            yield self._batch(rows, edges)
+
+    @staticmethod
+    def _batch(rows, edges):
+        return HistoryBatch([row[0] for row in rows], edges, np.stack([row[1] for row in rows]),
+                            np.stack([row[2] for row in rows]),
+                            np.stack([row[3] for row in rows]) if rows[0][3] is not None else None)
+
+    def edge_history(self, edges, start=None, end=None, days_of_week=None, hour_range=None, include_speed=False,
+                     batch_size=None):
+        """ Get the traffic of some edges in the Graph documents of a time range (see SnapshotHistory.edge_history)
+        Returns:
+            A generator of HistoryBatch in chronological order"""
+        edges = [tuple(edge) for edge in edges]
+        return self._query(build_history_filter(start, end, days_of_week, hour_range), edges, True, include_speed,
+                           batch_size)
+
+    def zone_history(self, start=None, end=None, days_of_week=None, hour_range=None, include_speed=False,
+                     batch_size=None):
+        """ Get the traffic of every edge of the zone in the Graph documents of a time range (see
+        SnapshotHistory.edge_history)
+        Returns:
+            A generator of HistoryBatch in chronological order"""
+        return self._query(build_history_filter(start, end, days_of_week, hour_range), self.edge_table.edges, False,
+                           include_speed, batch_size)
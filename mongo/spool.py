@@ -0,0 +1,326 @@
+import logging
+import os
+import threading
+import time
+
+import bson
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# Error code of the documents already inserted (a batch replayed after an outage)
+DUPLICATE_KEY_ERROR = 11000
+
+
+class SnapshotSpool:
+    """ Local append-only spool of the documents waiting to be saved in MongoDB
+
+    Every record is a BSON document {'area': zone, 'document': document} appended to the spool file, and the offset of
+    the first record not saved yet is kept in '<path>.offset'. A record cut by a crash at the end of the file is
+    discarded when the spool is opened, and the file is truncated once every record has been saved.
+    Args:
+        path: The spool file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as file:
+                self.offset = int(file.read().strip() or 0)
+
+        self.file = open(path, "ab")
+        self.end = self._recover()
+
+    def _recover(self):
+        """ Get the end of the last complete record, truncating the spool after it"""
+        end = self.offset
+        with open(self.path, "rb") as file:
+            file.seek(end)
+            while True:
+                record = self._read_record(file)
+                if record is None:
+                    break
+                end = file.tell()
+
+        if end != os.path.getsize(self.path):
+            logging.warning(f"Discarding {os.path.getsize(self.path) - end} bytes of an incomplete record "
+                            f"at the end of {self.path}")
+            self.file.truncate(end)
+        return end
+
+    @staticmethod
+    def _read_record(file):
+        """ Read the next record of the file (None at the end of the file or if it is incomplete)"""
+        header = file.read(4)
+        if len(header) < 4:
+            return None
+        size = int.from_bytes(header, "little")
+        body = file.read(size - 4)
+        if len(body) < size - 4:
+            return None
+        try:
+            return bson.decode(header + body)
+        except bson.errors.InvalidBSON:
+            return None
+
+    @property
+    def pending_bytes(self):
+        return self.end - self.offset
+
+    def append(self, area, document):
+        """ Append a document to the spool (written to disk before returning)
+        Args:
+            area: The zone of the document
+            document: The document"""
+        data = bson.encode({'area': area, 'document': document})
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.end += len(data)
+
+    def read(self, max_records):
+        """ Read the first records not saved yet
+        Args:
+            max_records: The maximum amount of records to read
+        Returns:
+            A list of (area, document) and the offset after the last record read"""
+        with self.lock:
+            offset, end = self.offset, self.end
+
+        records = []
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            while offset < end and len(records) < max_records:
+                record = self._read_record(file)
+                records.append((record['area'], record['document']))
+                offset = file.tell()
+        return records, offset
+
+    def commit(self, offset):
+        """ Mark the records before the offset as saved, truncating the spool if all of them are saved
+        Args:
+            offset: The offset returned by read"""
+        with self.lock:
+            truncate = offset == self.end
+            # The offset is written before the spool is truncated: a crash between both replays the saved records
+            # (they are not duplicated) instead of leaving an offset past the end of the spool
+            self._write_offset(0 if truncate else offset)
+            if truncate:
+                self.file.truncate(0)
+                offset = self.end = 0
+            self.offset = offset
+
+    def _write_offset(self, offset):
+        temporary_path = f"{self.offset_path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(str(offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.offset_path)
+
+    def close(self):
+        self.file.close()
+
+
+def get_snapshot_collections():
+    """ Get the MongoDB collections of the snapshots of every zone (the repositories share the MongoManager client)"""
+    from mongo.repository import RepositorioSnapshot, RepositorioSnapshotSoho
+
+    return {
+        'teatinos': RepositorioSnapshot().collection,
+        'soho': RepositorioSnapshotSoho().collection
+    }
+
+
+class SnapshotWriter:
+    """ Write-behind saving of the snapshots: the documents are appended to a local spool and a background thread
+    saves them in MongoDB with bulk inserts, retrying (and replaying the backlog of the spool) while MongoDB is down
+
+    Every document gets its _id when it is spooled, so a batch saved again after a failure does not duplicate it.
+    Args:
+        spool_path: The spool file
+        collections: A dictionary with the collection of every zone, any object with insert_many (the collections of
+            the snapshot repositories if None)
+        batch_size: The maximum amount of documents of every bulk insert
+        max_pending_bytes: The size of the backlog over which submit waits for the writer (backpressure)
+        backpressure_timeout: The maximum seconds submit waits, the document is spooled anyway after it
+        retry_delay: The seconds to wait after the first failed insert (doubled on every failure)
+        max_retry_delay: The maximum seconds between retries
+        on_saved: Function called in the writer thread with the zone and the documents saved of every bulk insert
+            (e.g. a ProfileUpdater). It may get the same documents again: the ones of a batch retried after a failure
+            and the ones replayed from the spool after a restart (saved before a crash, but not committed), so it
+            must be idempotent"""
+
+    def __init__(self, spool_path, collections=None, batch_size=64, max_pending_bytes=256 * 1024 * 1024,
+                 backpressure_timeout=60, retry_delay=1, max_retry_delay=60, on_saved=None):
+        self.spool = SnapshotSpool(spool_path)
+        self.collections = collections
+        self.on_saved = on_saved
+        self.batch_size = batch_size
+        self.max_pending_bytes = max_pending_bytes
+        self.backpressure_timeout = backpressure_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.inserted = 0
+        self.failures = 0
+        self.writes = 0
+        self.write_seconds_total = 0.0
+        self.last_write_seconds = None
+        self.max_write_seconds = None
+
+    def start(self):
+        """ Start the background writer (the backlog left in the spool is replayed first)"""
+        if self.spool.pending_bytes:
+            logging.info(f"Replaying {self.spool.pending_bytes} bytes of snapshots from {self.spool.path}")
+        self.thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, area, document):
+        """ Spool a document to be saved in the collection of its zone
+        Args:
+            area: The zone of the document
+            document: The document (a dictionary or an ObjetoMongoAbstract)"""
+        if area not in self._get_collections():
+            raise ValueError(f"There is no snapshot collection for {area}")
+        if not isinstance(document, dict):
+            document = document.get_dict()
+        if document.get('_id') is None:
+            document['_id'] = bson.ObjectId()
+
+        with self.condition:
+            deadline = time.monotonic() + self.backpressure_timeout
+            while self.spool.pending_bytes > self.max_pending_bytes and time.monotonic() < deadline:
+                self.condition.wait(timeout=max(0.0, deadline - time.monotonic()))
+            if self.spool.pending_bytes > self.max_pending_bytes:
+                logging.warning(f"The snapshot backlog has {self.spool.pending_bytes} bytes, spooling anyway")
+
+            self.spool.append(area, document)
+            self.condition.notify_all()
+
+    def _get_collections(self):
+        if self.collections is None:
+            self.collections = get_snapshot_collections()
+        return self.collections
+
+    def _insert(self, records):
+        """ Insert the records in bulk, grouped by zone"""
+
+        documents_by_area = {}
+        for area, document in records:
+            documents_by_area.setdefault(area, []).append(document)
+
+        for area, documents in documents_by_area.items():
+            try:
+                self._get_collections()[area].insert_many(documents, ordered=False)
+            except BulkWriteError as error:
+                # The documents saved before a failure are already there
+                if any(write_error['code'] != DUPLICATE_KEY_ERROR
+                       for write_error in error.details.get('writeErrors', [])) or \
+                        error.details.get('writeConcernErrors'):
+                    raise
+
+            if self.on_saved is not None:
+                # The documents are saved, an error of the callback must not replay them
+                try:
+                    self.on_saved(area, documents)
+                except Exception:
+                    logging.exception(f"Error in the callback of the snapshots saved of {area}")
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            with self.condition:
+                while not self.spool.pending_bytes and not self.stopping:
+                    self.condition.wait()
+                if not self.spool.pending_bytes and self.stopping:
+                    return
+
+            records, offset = self.spool.read(self.batch_size)
+            start = time.perf_counter()
+            try:
+                self._insert(records)
+            except PyMongoError as error:
+                self.failures += 1
+                logging.error(f"Error saving {len(records)} snapshots in MongoDB, retrying in {delay} s: {error}")
+                with self.condition:
+                    if self.stopping:
+                        return
+                    self.condition.wait(timeout=delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+
+            delay = self.retry_delay
+            self._record_write(time.perf_counter() - start, len(records))
+            with self.condition:
+                self.spool.commit(offset)
+                self.condition.notify_all()
+
+    def _record_write(self, seconds, documents):
+        self.inserted += documents
+        self.writes += 1
+        self.write_seconds_total += seconds
+        self.last_write_seconds = seconds
+        self.max_write_seconds = seconds if self.max_write_seconds is None else max(self.max_write_seconds, seconds)
+
+    def get_stats(self, reset_max=True):
+        """ Get the statistics of the writes in MongoDB
+        Args:
+            reset_max: A boolean to indicate if the maximum write seconds should start again after this call
+        Returns:
+            A dictionary with the documents inserted, the bulk inserts, the failures, the last, maximum and total
+            seconds of the bulk inserts and the bytes waiting in the spool"""
+        stats = {
+            'inserted': self.inserted,
+            'writes': self.writes,
+            'failures': self.failures,
+            'last_write_seconds': self.last_write_seconds,
+            'max_write_seconds': self.max_write_seconds,
+            'write_seconds_total': self.write_seconds_total,
+            'pending_bytes': self.spool.pending_bytes
+        }
+        if reset_max:
+            self.max_write_seconds = None
+        return stats
+
+    def flush(self, timeout=None):
+        """ Wait until the backlog is saved
+        Args:
+            timeout: The maximum seconds to wait (no limit if None)
+        Returns:
+            A boolean indicating if the backlog is empty"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.spool.pending_bytes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(timeout=remaining)
+            return not self.spool.pending_bytes
+
+    def close(self, timeout=30):
+        """ Try to save the backlog and stop the writer (what is not saved stays in the spool for the next start)
+        Args:
+            timeout: The maximum seconds to wait for the backlog"""
+        if self.thread is not None:
+            self.flush(timeout=timeout)
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            self.thread.join(timeout=timeout)
+        self.spool.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
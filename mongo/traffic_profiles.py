@@ -0,0 +1,259 @@
+import calendar
+import logging
+from typing import NamedTuple
+
+import numpy as np
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from mongo.entity.snapshot import decode_quantized_arrays, dequantize_traffic_levels
+from mongo.entity.traffic_profile import TrafficProfile, merge_statistics
+
+# Minutes of every slot of the day (the period of the snapshots)
+PROFILE_SLOT_MINUTES = 15
+
+# Every slot of the week is a single document
+PROFILE_INDEX = pymongo.IndexModel([('day_of_week', pymongo.ASCENDING), ('slot', pymongo.ASCENDING)],
+                                   name='profile_slot', unique=True)
+
+
+def get_profile_collections():
+    """ Get the MongoDB collections of the traffic profiles of every zone"""
+    from mongo.repository import RepositorioTrafficProfile, RepositorioTrafficProfileSoho
+
+    return {
+        'teatinos': RepositorioTrafficProfile().collection,
+        'soho': RepositorioTrafficProfileSoho().collection
+    }
+
+
+def get_profile_slot(date, slot_minutes=PROFILE_SLOT_MINUTES):
+    """ Get the slot of the week of a datetime
+    Args:
+        date: The datetime
+        slot_minutes: The minutes of every slot
+    Returns:
+        The name of the day of the week (as the day_of_week of the snapshots) and the slot of the day"""
+    return date.strftime("%A"), (date.hour * 60 + date.minute) // slot_minutes
+
+
+class ProfileStatistics(NamedTuple):
+    """ Typical traffic of some edges in a slot of the week
+    Args:
+        edges: The list with the edges (u, v, key)
+        count: Array with the amount of snapshots with traffic level of every edge
+        mean: Array with the mean traffic level (NaN if the count is 0)
+        std: Array with the standard deviation of the traffic level (NaN with less than 2 snapshots)
+        minimum: Array with the minimum traffic level (NaN if unknown)
+        maximum: Array with the maximum traffic level (NaN if unknown)"""
+    edges: list
+    count: np.ndarray
+    mean: np.ndarray
+    std: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+
+
+class TrafficProfileStore:
+    """ Typical traffic of a zone by slot of the week (day of the week and 15 minutes of the day), kept up to date
+    snapshot by snapshot
+
+    Every slot is a TrafficProfile document found through a unique index, so adding a snapshot or reading the typical
+    traffic of a slot reads a single document, whatever the size of the history. A snapshot is added with a
+    conditional replace on the last datetime of the slot, so concurrent writers never lose an update and a snapshot
+    is never added twice.
+    Args:
+        collection: The collection of the profiles of the zone
+        edge_table: The EdgeTable of the zone (to read the profiles of some edges)
+        slot_minutes: The minutes of every slot
+        max_retries: The maximum attempts of an update that conflicts with another writer"""
+
+    def __init__(self, collection, edge_table=None, slot_minutes=PROFILE_SLOT_MINUTES, max_retries=5):
+        self.collection = collection
+        self.edge_table = edge_table
+        self.slot_minutes = slot_minutes
+        self.max_retries = max_retries
+        self.indexed = False
+
+    def _ensure_index(self):
+        # Created with the first use, so the store can be built while MongoDB is down
+        if not self.indexed:
+            self.collection.create_indexes([PROFILE_INDEX])
+            self.indexed = True
+
+    def get_profile(self, day_of_week, slot):
+        """ Get the profile of a slot of the week
+        Args:
+            day_of_week: The name of the day of the week
+            slot: The slot of the day
+        Returns:
+            The TrafficProfile or None if the slot has no snapshot"""
+        self._ensure_index()
+        document = self.collection.find_one({'day_of_week': day_of_week, 'slot': slot})
+        return None if document is None else TrafficProfile.generar_object_from_dict(document)
+
+    def add(self, traffic_level, date, graph_signature):
+        """ Add the traffic level of a snapshot to the profile of its slot
+        Args:
+            traffic_level: Array with the traffic level of every edge (NaN if unknown)
+            date: The datetime of the snapshot
+            graph_signature: The signature of the graph of the snapshot (a profile of another graph starts again)
+        Returns:
+            A boolean indicating if the snapshot was added (False if the slot already has it or a newer one)"""
+        day_of_week, slot = get_profile_slot(date, self.slot_minutes)
+        for _ in range(self.max_retries):
+            profile = self.get_profile(day_of_week, slot)
+            previous = None if profile is None else profile.last_datetime
+
+            if profile is None or profile.graph_signature != graph_signature or \
+                    profile.edges_count != len(traffic_level):
+                if profile is not None:
+                    logging.warning(f"The graph of the profile of {day_of_week} {profile.hour_float:05.2f} has "
+                                    f"changed, starting it again")
+                profile = TrafficProfile.empty(day_of_week, slot, self.slot_minutes, graph_signature,
+                                               len(traffic_level))
+
+            if not profile.add(traffic_level, date):
+                return False
+
+            try:
+                self.collection.replace_one({'day_of_week': day_of_week, 'slot': slot, 'last_datetime': previous},
+                                            profile.get_dict(id_mongo=False), upsert=True)
+                return True
+            except DuplicateKeyError:
+                # Another writer updated the slot after it was read
+                continue
+
+        raise RuntimeError(f"The profile of {day_of_week} slot {slot} could not be updated after "
+                           f"{self.max_retries} attempts")
+
+    def _statistics(self, profile, edges):
+        count, mean, _, minimum, maximum = profile.get_arrays()
+        std = np.sqrt(profile.get_variance())
+        if edges is None:
+            return ProfileStatistics(self.edge_table.edges if self.edge_table is not None else None, count, mean, std,
+                                     minimum, maximum)
+        positions = self.edge_table.positions(edges)
+        return ProfileStatistics([tuple(edge) for edge in edges], count[positions], mean[positions], std[positions],
+                                 minimum[positions], maximum[positions])
+
+    def lookup(self, date, edges=None):
+        """ Get the typical traffic at the slot of the week of a datetime
+        Args:
+            date: The datetime
+            edges: The list of edges (u, v, key), every edge if None
+        Returns:
+            The ProfileStatistics or None if the slot has no snapshot"""
+        profile = self.get_profile(*get_profile_slot(date, self.slot_minutes))
+        return None if profile is None else self._statistics(profile, edges)
+
+    def week_profile(self, edges):
+        """ Get the mean and the standard deviation of some edges in every slot of the week
+        Args:
+            edges: The list of edges (u, v, key)
+        Returns:
+            The list of the names of the days and two arrays (days, slots, edges) with the mean and the standard
+            deviation (NaN in the slots without snapshots)"""
+        self._ensure_index()
+        days = list(calendar.day_name)
+        slots = 24 * 60 // self.slot_minutes
+        mean = np.full((len(days), slots, len(edges)), np.nan)
+        std = np.full((len(days), slots, len(edges)), np.nan)
+        for document in self.collection.find({}):
+            profile = TrafficProfile.generar_object_from_dict(document)
+            statistics = self._statistics(profile, edges)
+            mean[days.index(profile.day_of_week), profile.slot] = statistics.mean
+            std[days.index(profile.day_of_week), profile.slot] = statistics.std
+        return days, mean, std
+
+    def rebuild(self, batches, graph_signature):
+        """ Build every profile again from the snapshots of a history query (replacing the stored ones)
+        Args:
+            batches: An iterable of HistoryBatch with every edge of the zone in chronological order (e.g. the one of
+                SnapshotHistory.zone_history)
+            graph_signature: The signature of the graph of the snapshots
+        Returns:
+            The amount of slots written"""
+        self._ensure_index()
+        slots = {}
+        for batch in batches:
+            keys = [get_profile_slot(date, self.slot_minutes) for date in batch.datetimes]
+            for key in set(keys):
+                rows = [row for row, row_key in enumerate(keys) if row_key == key]
+                levels = batch.traffic_level[rows]
+                known = ~np.isnan(levels)
+
+                count_b = known.sum(axis=0).astype(float)
+                mean_b = np.where(known, levels, 0.0).sum(axis=0) / np.maximum(count_b, 1)
+                m2_b = (np.where(known, levels - mean_b, 0.0) ** 2).sum(axis=0)
+                minimum_b, maximum_b = np.fmin.reduce(levels, axis=0), np.fmax.reduce(levels, axis=0)
+
+                if key not in slots:
+                    slots[key] = [np.zeros(levels.shape[1]), np.zeros(levels.shape[1]), np.zeros(levels.shape[1]),
+                                  np.full(levels.shape[1], np.nan), np.full(levels.shape[1], np.nan), 0, None]
+                count, mean, m2, minimum, maximum, samples, _ = slots[key]
+                count, mean, m2 = merge_statistics(count, mean, m2, count_b, mean_b, m2_b)
+                slots[key] = [count, mean, m2, np.fmin(minimum, minimum_b), np.fmax(maximum, maximum_b),
+                              samples + len(rows), max(batch.datetimes[row] for row in rows)]
+
+        for (day_of_week, slot), (count, mean, m2, minimum, maximum, samples, last_datetime) in slots.items():
+            profile = TrafficProfile.from_arrays(day_of_week, slot, self.slot_minutes, graph_signature, count, mean,
+                                                 m2, minimum, maximum, samples=samples, last_datetime=last_datetime)
+            self.collection.replace_one({'day_of_week': day_of_week, 'slot': slot}, profile.get_dict(id_mongo=False),
+                                        upsert=True)
+        # The slots without snapshots in the history
+        written = [{'day_of_week': day_of_week, 'slot': slot} for day_of_week, slot in slots]
+        self.collection.delete_many({'$nor': written} if written else {})
+        return len(slots)
+
+
+class ProfileUpdater:
+    """ Add the snapshots saved by the SnapshotWriter to the profiles of their zones (the on_saved of the writer)
+
+    The documents are keyframes and deltas, so the quantized traffic level of every zone is kept here and the deltas
+    are applied onto it. A delta that does not follow it (e.g. the first one after a restart) is rebuilt from
+    MongoDB with the SnapshotReader.
+    Args:
+        stores: A dictionary with the TrafficProfileStore of every zone
+        snapshot_collections: A dictionary with the collection of the snapshots of every zone (the ones of the
+            snapshot repositories if None)"""
+
+    def __init__(self, stores, snapshot_collections=None):
+        self.stores = stores
+        self.snapshot_collections = snapshot_collections
+        self.states = {}
+
+    def _get_traffic_level(self, area, document):
+        """ Get the quantized traffic level of every edge in a snapshot document"""
+        traffic_level, _, _ = decode_quantized_arrays(document['traffic_level'], document['api_data'])
+        state = self.states.get(area)
+
+        if document.get('kind', 'keyframe') == 'keyframe':
+            traffic_level = traffic_level.copy()
+        elif state is not None and state[0] == document['keyframe'] and state[1] < document['datetime']:
+            positions = np.frombuffer(document['positions'], dtype=np.uint32).astype(int)
+            state[2][positions] = traffic_level
+            traffic_level = state[2]
+        else:
+            from mongo.snapshot_delta import SnapshotReader
+            from mongo.spool import get_snapshot_collections
+
+            if self.snapshot_collections is None:
+                self.snapshot_collections = get_snapshot_collections()
+            snapshot = SnapshotReader(self.snapshot_collections[area]).state_at(document['datetime'])
+            traffic_level = snapshot.get_quantized_arrays()[0].copy()
+
+        self.states[area] = (document.get('keyframe', document['datetime']), document['datetime'], traffic_level)
+        return traffic_level
+
+    def __call__(self, area, documents):
+        """ Add the saved snapshots of a zone to its profiles
+        Args:
+            area: The zone of the documents
+            documents: The snapshot documents saved"""
+        store = self.stores.get(area)
+        if store is None:
+            return
+        for document in sorted(documents, key=lambda saved: saved['datetime']):
+            traffic_level = self._get_traffic_level(area, document)
+            store.add(dequantize_traffic_levels(traffic_level), document['datetime'], document['graph_signature'])
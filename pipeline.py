@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+
+from translation import translate_tile_into_segments, add_info_to_features, split_feature_collection, \
+    resolve_traffic_level_edges, apply_traffic_level, interpolate_traffic_level
+from utils.utils_archive import TileArchive
+from utils.utils_match_cache import get_graph_signature, get_segment_key
+from utils.utils_metrics import CycleMetrics
+from utils.utils_pbf import RawTile, decode_tile
+from utils.utils_segments import SegmentTable
+
+
+########################################################################################################################
+#                                         IN-MEMORY PIPELINE
+########################################################################################################################
+
+
+def _dump_debug_file(debug_dir, stage, datetime_str, data):
+    """ Write an intermediate stage of the pipeline to disk (only in debug mode)
+    Args:
+        debug_dir: The root folder of the debug files
+        stage: The subfolder of the stage ('translation/<tile>', 'mixed', 'informed' or 'splitted')
+        datetime_str: The datetime string of the snapshot
+        data: The FeatureCollection to write"""
+    os.makedirs(f"{debug_dir}/{stage}", exist_ok=True)
+    with open(f"{debug_dir}/{stage}/{datetime_str}.pbf.json", "w") as output_file:
+        output_file.write(json.dumps(data))
+
+
+def load_decoded_tile(tile, datetime_str, data_dir="data", archive=None):
+    """ Load a tile from the archive of the scrapper (or from the files of the old archives that are not migrated)
+    Args:
+        tile: The tile dictionary
+        datetime_str: The datetime string of the snapshot
+        data_dir: The folder where the tiles are archived
+        archive: The TileArchive of data_dir, to reuse its indexes (a new one if None)
+    Returns:
+        The RawTile or the decoded tile"""
+    archived_tile = (archive or TileArchive(data_dir)).get(tile['name'], datetime_str)
+    if archived_tile is not None:
+        return archived_tile
+
+    filename = f"{data_dir}/{tile['name']}/{datetime_str}.pbf"
+    if os.path.exists(filename):
+        with open(filename, "rb") as file:
+            return RawTile(file.read())
+    with open(f"{filename}.json") as file:
+        return json.load(file)
+
+
+def translate_tiles(datetime_str, tiles, decoded_tiles=None, debug_dir=None, metrics=None):
+    """ Translate the tiles of a zone and mix them into a single table of segments
+    Args:
+        datetime_str: The datetime string of the snapshot
+        tiles: The list of tile dictionaries of the zone
+        decoded_tiles: The RawTiles or decoded tiles by tile name (if None, they are loaded from the archive)
+        debug_dir: The folder where the intermediate files are written (disabled if None)
+        metrics: The CycleMetrics where the amount of tiles and features (and the names of the missing tiles) are
+            recorded
+    Returns:
+        The mixed SegmentTable"""
+    metrics = metrics if metrics is not None else CycleMetrics()
+    translations = []
+    missing_tiles = []
+
+    for tile in tiles:
+        if decoded_tiles is None:
+            decoded_tile = decode_tile(load_decoded_tile(tile, datetime_str))
+        elif tile['name'] in decoded_tiles:
+            decoded_tile = decode_tile(decoded_tiles[tile['name']])
+        else:
+            logging.error(f"ERROR: tile {tile['name']} is missing in the snapshot {datetime_str}")
+            missing_tiles.append(tile['name'])
+            continue
+
+        outmin = (tile['corners_2'][0], tile['corners_0'][1])
+        outmax = (tile['corners_0'][0], tile['corners_1'][1])
+
+        translation = translate_tile_into_segments(decoded_tile, outmin, outmax)
+        if debug_dir is not None:
+            _dump_debug_file(debug_dir, f"translation/{tile['name']}", datetime_str, translation.to_geojson())
+
+        translations.append(translation)
+        metrics.add('tiles', 1)
+        metrics.add('tile_features', len(translation.properties))
+
+    # A partial snapshot is recorded, an empty one would be stored as if no edge had traffic
+    metrics.set('missing_tiles', missing_tiles)
+    if not translations:
+        raise ValueError(f"None of the tiles of the zone are present in the snapshot {datetime_str}")
+
+    mixed_segments = SegmentTable.concatenate(translations)
+    metrics.set('segments', len(mixed_segments))
+    if debug_dir is not None:
+        _dump_debug_file(debug_dir, "mixed", datetime_str, mixed_segments.to_geojson())
+
+    return mixed_segments
+
+
+def match_segments(segments, zone, datetime_str, splits=15, debug_dir=None, metrics=None):
+    """ Get the edges that get the traffic level of every translated segment
+    The segments already seen in previous snapshots are taken from the match cache of the zone (if it has one), the
+    rest are turned into GeoJSON features and go through the stages that add the information, split them and resolve
+    their edges.
+    Args:
+        segments: The SegmentTable with the translated segments
+        zone: The zone dictionary
+        datetime_str: The datetime string of the snapshot
+        splits: The length of the split parts
+        debug_dir: The folder where the intermediate files are written (disabled if None), only the segments that
+            are not cached are written
+        metrics: The CycleMetrics where the amount of cached, resolved, distant and split segments are recorded
+    Returns:
+        A list with a tuple (traffic level, edge id, extra edges ids) for every matched part, in the order of the
+        segments"""
+    metrics = metrics if metrics is not None else CycleMetrics()
+    graph = zone['graph']
+    match_cache = zone.get('match_cache')
+    if match_cache is not None:
+        if zone.get('graph_signature') is None:
+            zone['graph_signature'] = get_graph_signature(graph)
+        if match_cache.ensure_signature((zone['graph_signature'], splits)):
+            logging.info("Match cache invalidated")
+
+    segment_keys = [get_segment_key(coordinates) for coordinates in segments.coordinates()]
+
+    resolved = {}
+    missing_positions = []
+    missing_keys = []
+    for position, segment_key in enumerate(segment_keys):
+        if segment_key in resolved:
+            continue
+
+        cached = match_cache.get(segment_key) if match_cache is not None else None
+        if cached is not None:
+            resolved[segment_key] = cached
+            continue
+
+        # The matching only depends on the coordinates, so every distinct segment is resolved once
+        resolved[segment_key] = []
+        missing_positions.append(position)
+        missing_keys.append(segment_key)
+
+    if missing_positions:
+        missing_features = segments.to_features(missing_positions, segment_index=range(len(missing_positions)))
+        informed_json = add_info_to_features({"type": "FeatureCollection", "features": missing_features}, graph,
+                                             splits=splits, edge_index=zone.get('edge_index'))
+        if debug_dir is not None:
+            _dump_debug_file(debug_dir, "informed", datetime_str, informed_json)
+
+        split_json = split_feature_collection(informed_json)
+        if debug_dir is not None:
+            _dump_debug_file(debug_dir, "splitted", datetime_str, split_json)
+
+        for feature, edge_id, extra_edges_ids in resolve_traffic_level_edges(graph, split_json,
+                                                                             edge_index=zone.get('edge_index')):
+            resolved[missing_keys[feature["properties"]["segment_index"]]].append((edge_id, extra_edges_ids))
+
+        if match_cache is not None:
+            for segment_key in missing_keys:
+                match_cache.put(segment_key, resolved[segment_key])
+
+    logging.info(f"Segments matched: {len(segment_keys) - len(missing_positions)} from the cache, "
+                 f"{len(missing_positions)} resolved")
+
+    matches = [(traffic_level, edge_id, extra_edges_ids)
+               for traffic_level, segment_key in zip(segments.traffic_levels(), segment_keys)
+               for edge_id, extra_edges_ids in resolved[segment_key]]
+
+    metrics.set('segments_cached', len(segment_keys) - len(missing_positions))
+    metrics.set('segments_resolved', len(missing_positions))
+    # The distant segments are the ones discarded before the split, so they have no part
+    metrics.set('distant_rejections', sum(1 for segment_key in segment_keys if not resolved[segment_key]))
+    metrics.set('split_parts', len(matches))
+
+    return matches
+
+
+def process_snapshot(datetime_str, zone, decoded_tiles=None, debug_dir=None, splits=15, precision=3, metrics=None,
+                     interpolation_method='incremental'):
+    """ Run all the stages of the pipeline for a snapshot of a zone, passing the features in memory
+    Args:
+        datetime_str: The datetime string of the snapshot
+        zone: The zone dictionary (graph, tiles, neightbours, interpolator, edge_index, match_cache and traffic_state)
+        decoded_tiles: The RawTiles or decoded tiles by tile name (if None, they are loaded from the archive)
+        debug_dir: The folder where the intermediate files are written (disabled if None)
+        splits: The length of the split parts
+        precision: The precision to check the traffic level of the interpolations
+        metrics: The CycleMetrics where the durations of the stages and their counts are recorded
+        interpolation_method: The method of interpolate_traffic_level ('incremental' starts from the previous snapshot
+            of the zone, 'direct' does not depend on it)
+    Returns:
+        The TrafficState of the zone with the traffic level (it is reused by the next snapshot of the zone)"""
+    metrics = metrics if metrics is not None else CycleMetrics()
+
+    with metrics.stage('translate'):
+        mixed_segments = translate_tiles(datetime_str, zone['tiles'], decoded_tiles=decoded_tiles, debug_dir=debug_dir,
+                                         metrics=metrics)
+    logging.info(f"Tiles translated and mixed ({len(mixed_segments)} segments)")
+
+    with metrics.stage('match'):
+        matches = match_segments(mixed_segments, zone, datetime_str, splits=splits, debug_dir=debug_dir,
+                                 metrics=metrics)
+
+    with metrics.stage('apply'):
+        traffic_state = apply_traffic_level(zone['graph'], matches, datetime_str, fill_empty_edges=False,
+                                            traffic_state=zone.get('traffic_state'))
+        zone['traffic_state'] = traffic_state
+
+    with metrics.stage('interpolate'):
+        result = interpolate_traffic_level(zone['graph'], traffic_state, datetime_str,
+                                           neighbours_dictionary=zone['neightbours'], precision=precision,
+                                           interpolator=zone.get('interpolator'), method=interpolation_method)
+    metrics.set('interpolation_iterations', result.iterations)
+    metrics.set('edges_filled', result.edges_filled)
+    metrics.set('interpolation_residual', result.residual)
+    metrics.set('interpolation_error_bound', result.error_bound)
+    logging.info(f"Traffic level added to the graph ({len(matches)} edges from the API)")
+
+    return traffic_state
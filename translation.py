@@ -1,20 +1,27 @@
-import copy
 import json
 import logging
 import os
 from datetime import datetime
 
 import geojson
+import numpy as np
 import osmnx as ox
 import shapely
 from shapely.geometry import Point, LineString
 
-from mongo.entity import Graph
-from mongo.repository import RepositorioGraph, RepositorioGraphSoho
-from utils.utils import are_opposite_bearings, get_neighbours_edges, normalize, skip_feature, \
-    get_cardinal_direction_from_bearing
-from utils.utils_geojson import create_linestring_geojson
-from utils.utils_zona_teatinos import handle_jimenez_fraud
+from mongo.entity import Graph, Snapshot
+from mongo.repository import RepositorioGraph, RepositorioSnapshot, RepositorioSnapshotSoho
+from utils.utils import are_opposite_bearings, get_neighbours_edges_dictionary, normalize, \
+    skip_feature, get_cardinal_directions_from_bearings
+from utils.utils_geojson import GEOJSON_PRECISION, round_coordinates
+from utils.utils_interpolation import TrafficInterpolator
+from utils.utils_segments import SEGMENT_DTYPE, SegmentTable, split_segments
+from utils.utils_spatial import EdgeSpatialIndex
+from utils.utils_traffic_state import TrafficState
+from utils.utils_zona_teatinos import get_jimenez_fraud_edges
+
+# Extent of the vector tiles when the layer does not say it
+DEFAULT_TILE_EXTENT = 4096
 
 
 ########################################################################################################################
@@ -32,46 +39,81 @@ def translate_file_pairs_into_geojson(dirname, outmin, outmax):
     Returns:
         A GeoJSON object with the coordinates of the file"""
 
-    translation = {
-        "type": "FeatureCollection",
-        "features": []}
-
     with (open(dirname) as file):
-        json_coordinates = json.load(file)
-        feature_id = 0
-        for feature in json_coordinates["Traffic flow"]["features"]:
-            coordinates = feature["geometry"]["coordinates"]
-
-            # Skip points
-            if feature["geometry"]["type"] == "Point":
-                print("\t Skipping point")
-                continue
-
-            if feature["geometry"]["type"] == "LineString":
-                coordinates = [coordinates]
-
-            for line in coordinates:
-                # TODO: REVISAR DE DONDE VIENE EL 4095
-                for point_number in range(len(line) - 1):
-                    next_pair = [
-                        [
-                            normalize(line[point_number][0], 4095, 0, outmin[0], outmax[0]),
-                            normalize(line[point_number][1], 4095, 0, outmin[1], outmax[1])
-                        ],
-                        [
-                            normalize(line[point_number + 1][0], 4095, 0, outmin[0], outmax[0]),
-                            normalize(line[point_number + 1][1], 4095, 0, outmin[1], outmax[1])
-
-                        ]
-                    ]
-                    feature_properties = {**feature["properties"], "feature_id": feature_id}
-                    feature_id += 1
-                    translation["features"].append(create_linestring_geojson(next_pair, feature_properties))
-
-    return translation
-
-
-def __generate_lists_coordiantes_and_neares_edges(data, graph):
+        return translate_tile_into_geojson(json.load(file), outmin, outmax)
+
+
+def translate_tile_into_geojson(decoded_tile, outmin, outmax):
+    """ Translate a decoded tile into a GeoJSON object
+    Args:
+        decoded_tile: The decoded tile (as returned by mapbox_vector_tile.decode)
+        outmin: The minimum coordinates of the output (to normalize)
+        outmax: The maximum coordinates of the output (to normalize)
+    Returns:
+        A GeoJSON object with a feature for every pair of consecutive points of the tile"""
+
+    return translate_tile_into_segments(decoded_tile, outmin, outmax).to_geojson()
+
+
+def translate_tile_into_segments(decoded_tile, outmin, outmax, layer_name="Traffic flow"):
+    """ Translate a decoded tile into a table with every pair of consecutive points of its lines
+    All the points of the layer are scaled at once, using the extent of the layer
+    Args:
+        decoded_tile: The decoded tile (as returned by mapbox_vector_tile.decode)
+        outmin: The minimum coordinates of the output (to normalize)
+        outmax: The maximum coordinates of the output (to normalize)
+        layer_name: The layer with the traffic flow
+    Returns:
+        A SegmentTable with the coordinates of the segments"""
+
+    layer = decoded_tile[layer_name]
+    extent = layer.get("extent", DEFAULT_TILE_EXTENT)
+
+    properties = []
+    lines = []
+    lines_feature = []
+    for feature in layer["features"]:
+        coordinates = feature["geometry"]["coordinates"]
+
+        # Skip points
+        if feature["geometry"]["type"] == "Point":
+            print("\t Skipping point")
+            continue
+
+        if feature["geometry"]["type"] == "LineString":
+            coordinates = [coordinates]
+
+        for line in coordinates:
+            if len(line) > 1:
+                lines.append(line)
+                lines_feature.append(len(properties))
+
+        properties.append(feature["properties"])
+
+    if not lines:
+        return SegmentTable(properties=properties)
+
+    lines_length = np.array([len(line) for line in lines])
+    points = np.array([point[:2] for line in lines for point in line], dtype=float)
+
+    # The tile coordinates go from 0 (outmax) to the extent (outmin)
+    points = normalize(points, extent, 0, np.asarray(outmin, dtype=float), np.asarray(outmax, dtype=float))
+
+    # Every point but the last one of each line starts a segment
+    is_start = np.ones(len(points), dtype=bool)
+    is_start[np.cumsum(lines_length) - 1] = False
+    starts = np.flatnonzero(is_start)
+
+    segments = np.empty(len(starts), dtype=SEGMENT_DTYPE)
+    segments['x0'], segments['y0'] = points[starts, 0], points[starts, 1]
+    segments['x1'], segments['y1'] = points[starts + 1, 0], points[starts + 1, 1]
+    segments['feature'] = np.repeat(lines_feature, lines_length - 1)
+    segments['feature_id'] = np.arange(len(starts))
+
+    return SegmentTable(segments, properties)
+
+
+def __generate_lists_coordiantes_and_neares_edges(data, graph, edge_index=None):
     middle_coordinates_lat, middle_coordinates_lon = [], []
     coordinates_lat, coordinates_lon = [], []
     # Get from every feature (pair of points) the middle point
@@ -93,8 +135,9 @@ def __generate_lists_coordiantes_and_neares_edges(data, graph):
 
         middle_coordinates_lat.append((point_1_lat + point_2_lat) / 2)
         middle_coordinates_lon.append((point_1_lon + point_2_lon) / 2)
-    nearest_edges_and_distance_list = ox.distance.nearest_edges(graph, middle_coordinates_lon, middle_coordinates_lat,
-                                                                return_dist=True)
+    if edge_index is None:
+        edge_index = EdgeSpatialIndex(graph)
+    nearest_edges_and_distance_list = edge_index.nearest_edges(middle_coordinates_lon, middle_coordinates_lat)
     return coordinates_lat, coordinates_lon, nearest_edges_and_distance_list
 
 
@@ -105,7 +148,8 @@ def __generate_lists_coordiantes_and_neares_edges(data, graph):
 def add_info_to_file(filename, folder_input, folder_output, graph,
                      error_management=False,
                      print_distant_edges=False,
-                     splits=15):
+                     splits=15,
+                     edge_index=None):
     """ Add information to the given file (splits, nearest edge, etc.)
     Args:
         filename: The name of the file
@@ -114,111 +158,105 @@ def add_info_to_file(filename, folder_input, folder_output, graph,
         graph: The graph to use to get the nearest edges
         error_management: A boolean to indicate if the error management is enabled
         print_distant_edges: A boolean to indicate if the distant edges should be printed
-        splits: The amount of splits to use"""
+        splits: The amount of splits to use
+        edge_index: The EdgeSpatialIndex of the graph (built here if None)"""
 
     with open(f"{folder_input}/{filename}.pbf.json") as f:
         data = geojson.load(f)
 
-    middle_coordinates_lat = []
-    middle_coordinates_lon = []
-
-    coordinates_lat = []
-    coordinates_lon = []
-
-    new_features = []
-    i = 0
-    for feature in data["features"]:
+    res = add_info_to_features(data, graph, error_management=error_management,
+                               print_distant_edges=print_distant_edges, splits=splits, edge_index=edge_index)
 
-        if skip_feature(feature):
-            continue
+    json.dump(res, open(f"{folder_output}/{filename}.pbf.json", "w"))
 
-        i += 1
 
-        coordinates = feature["geometry"]["coordinates"]
+def add_info_to_features(data, graph,
+                         error_management=False,
+                         print_distant_edges=False,
+                         splits=15,
+                         edge_index=None):
+    """ Add information to the features of a GeoJSON object (splits, nearest edge, etc.)
+    Args:
+        data: The GeoJSON object (FeatureCollection)
+        graph: The graph to use to get the nearest edges
+        error_management: A boolean to indicate if the error management is enabled
+        print_distant_edges: A boolean to indicate if the distant edges should be printed
+        splits: The amount of splits to use
+        edge_index: The EdgeSpatialIndex of the graph (built here if None)
+    Returns:
+        A new FeatureCollection with the informed features (the distant ones are discarded)"""
 
-        # We add the length of the edge to the total length
-        point1 = Point(coordinates[0][1], coordinates[0][0])
-        point2 = Point(coordinates[1][1], coordinates[1][0])
+    features = [feature for feature in data["features"] if not skip_feature(feature)]
 
-        length = point1.distance(point2) * 100_000
-        feature["properties"]["length"] = length
+    # Same precision as the features loaded from a file
+    for feature in features:
+        feature["geometry"]["coordinates"] = round_coordinates(feature["geometry"]["coordinates"])
 
-        coordinates_lat.append(point1.x)
-        coordinates_lat.append(point2.x)
+    if edge_index is None:
+        edge_index = EdgeSpatialIndex(graph)
+    edge_table = edge_index.edge_table
 
-        coordinates_lon.append(point1.y)
-        coordinates_lon.append(point2.y)
+    coordinates = np.array([feature["geometry"]["coordinates"][:2] for feature in features], dtype=float).reshape(-1, 2, 2)
+    lat_1, lon_1 = coordinates[:, 0, 1], coordinates[:, 0, 0]
+    lat_2, lon_2 = coordinates[:, 1, 1], coordinates[:, 1, 0]
 
-        # Get the middle of both points
-        middle_point = ((point1.x + point2.x) / 2, (point1.y + point2.y) / 2)
-        middle_coordinates_lon.append(middle_point[1])
-        middle_coordinates_lat.append(middle_point[0])
+    # Length of the API edge (distance between the points in degrees, as in shapely)
+    delta_lat, delta_lon = lat_1 - lat_2, lon_1 - lon_2
+    length = np.sqrt(delta_lat * delta_lat + delta_lon * delta_lon) * 100_000
 
-    nearest_edges_and_distance_list = ox.distance.nearest_edges(graph, middle_coordinates_lon,
-                                                                middle_coordinates_lat, return_dist=True)
+    # Nearest edge to the middle of both points
+    middle_lat, middle_lon = (lat_1 + lat_2) / 2, (lon_1 + lon_2) / 2
+    nearest_positions, distances_in_meters = edge_index.nearest_positions(middle_lon, middle_lat)
 
-    if len(nearest_edges_and_distance_list[0]) != i:
+    if len(nearest_positions) != len(features):
         raise ValueError("ERROR: Different number of features and nearest edges")
 
-    nearest_edges_list = nearest_edges_and_distance_list[0]
-    nearest_distance_list = nearest_edges_and_distance_list[1]
+    bearing_api_edge = np.asarray(ox.bearing.calculate_bearing(lat_1, lon_1, lat_2, lon_2), dtype=float)
 
-    j = 0
-    for feature in data["features"]:
+    # Check if the direction is reversed or not
+    nearest_reversed = edge_table.reversed[nearest_positions]
+    opposite = are_opposite_bearings(edge_table.bearing[nearest_positions], bearing_api_edge, tolerance=45)
+    nearest_edge_reverse = np.where(opposite, ~nearest_reversed, nearest_reversed)
 
-        if skip_feature(feature):
-            continue
+    # Once we know the nearest edge, we check if the API edge needs to be split (not in roundabouts)
+    junction = edge_table.junction[nearest_positions]
+    roundabout = junction == "roundabout"
+    amount_splits = np.where(roundabout, 0, np.round(length / splits)).astype(int)
 
-        nearest_edge_id = nearest_edges_list[j]
-        feature["properties"]["error"] = ""
-        distance_in_meters = nearest_distance_list[j] * 100000
+    aiming = get_cardinal_directions_from_bearings(bearing_api_edge)
+    distant = distances_in_meters > 10
+
+    new_features = []
+    for j, feature in enumerate(features):
+        properties = feature["properties"]
+        properties["length"] = length[j].item()
+        properties["error"] = ""
 
-        if distance_in_meters > 10:
-            feature["properties"]["error"] = "Very distant from the nearest edge"
+        if distant[j]:
+            properties["error"] = "Very distant from the nearest edge"
 
             if print_distant_edges:
                 print(
-                    f"Feature {j} (edge{nearest_edge_id}) is very distant from the nearest edge: "
-                    f"{distance_in_meters} meters -> {[middle_coordinates_lat[j], middle_coordinates_lon[j]]}")
+                    f"Feature {j} (edge{edge_table.edges[nearest_positions[j]]}) is very distant from the nearest "
+                    f"edge: {distances_in_meters[j]} meters -> {[middle_lat[j].item(), middle_lon[j].item()]}")
 
-            j += 1
             continue
 
-        nearest_edge = graph.edges[nearest_edge_id]
-
-        bearing_api_edge = ox.bearing.calculate_bearing(coordinates_lat[j * 2], coordinates_lon[j * 2],
-                                                        coordinates_lat[j * 2 + 1], coordinates_lon[j * 2 + 1])
-
-        # Check if the direction is reversed or not
-        if are_opposite_bearings(nearest_edge["bearing"], bearing_api_edge, tolerance=45):
-            feature["properties"]["nearest_edge_reverse"] = not nearest_edge["reversed"]
-        else:
-            feature["properties"]["nearest_edge_reverse"] = nearest_edge["reversed"]
-
-        # Once we know the nearest edge, we check if the API edge needs to be split
-        amount_splits = round(feature["properties"]["length"] / splits)
-
-        if 'junction' in nearest_edge.keys() and nearest_edge["junction"] == "roundabout":
-            feature["properties"]["splits"] = 0
-            feature["properties"]["junction"] = nearest_edge["junction"]
-        else:
-            feature["properties"]["splits"] = amount_splits
-
-        feature["properties"]["aiming"] = get_cardinal_direction_from_bearing(bearing_api_edge)
-        feature["properties"]["api_bearing"] = bearing_api_edge
-
-        j += 1
+        properties["nearest_edge_reverse"] = bool(nearest_edge_reverse[j])
+        properties["splits"] = amount_splits[j].item()
+        if roundabout[j]:
+            properties["junction"] = junction[j]
+        properties["aiming"] = aiming[j]
+        properties["api_bearing"] = bearing_api_edge[j].item()
 
         new_features.append(feature)
 
     res = {
         "type": "FeatureCollection",
-        # "features": data["features"]
         "features": new_features
-
     }
 
-    json.dump(res, open(f"{folder_output}/{filename}.pbf.json", "w"))
+    return res
 
 
 ########################################################################################################################
@@ -228,37 +266,50 @@ def add_info_to_file(filename, folder_input, folder_output, graph,
 
 def split_features(geojson_file,
                    print_if_more_splits_than=-1):
-    data = geojson.load(geojson_file)
-    new_features = []
-    # Split the features
-    for feature in data['features']:
-        if skip_feature(feature):
-            continue
+    return split_feature_collection(geojson.load(geojson_file), print_if_more_splits_than=print_if_more_splits_than)
+
+
+def split_feature_collection(data,
+                             print_if_more_splits_than=-1):
+    """ Split the features of a GeoJSON object in as many parts as their 'splits' property says
+    Args:
+        data: The GeoJSON object (FeatureCollection), it is modified in place
+        print_if_more_splits_than: Print the features with more splits than this value (disabled if negative)
+    Returns:
+        The GeoJSON object with the split features"""
+    features = [feature for feature in data['features'] if not skip_feature(feature)]
+    features_to_split = [feature for feature in features if feature['properties']['splits'] >= 2]
 
+    # Get the parts of all the features at once
+    parents, parts_coordinates = split_segments([feature['geometry']['coordinates'] for feature in features_to_split],
+                                                [feature['properties']['splits'] for feature in features_to_split])
+    parts_boundaries = np.searchsorted(parents, np.arange(len(features_to_split) + 1)).tolist()
+    parts_coordinates = parts_coordinates.tolist()
+
+    new_features = []
+    feature_to_split = 0
+    for feature in features:
         # Split each feature into segments
         amount_of_splits = feature['properties']['splits']
 
         if amount_of_splits < 2:
             new_features.append(feature)
             continue
-        else:
-
-            if 0 < print_if_more_splits_than < amount_of_splits:
-                print("More than 10 splits -> ", amount_of_splits)
-
-            # Get the coordinates of the original feature
-            coordinates = feature['geometry']['coordinates']
-            line = LineString(coordinates)
 
-            geometries = split_line_with_two_points_in_parts(line, amount_of_splits, format_geojson=False)
-
-            for geometry in geometries:
-                # Get the properties of the original feature
-                new_feature = copy.deepcopy(feature)
-                new_feature['geometry'] = geometry
-                new_feature['properties']['splits'] = -1
-
-                new_features.append(new_feature)
+        if 0 < print_if_more_splits_than < amount_of_splits:
+            print("More than 10 splits -> ", amount_of_splits)
+
+        # The parts share the properties of the original feature
+        properties = {**feature['properties'], 'splits': -1}
+        for (x0, y0), (x1, y1) in parts_coordinates[parts_boundaries[feature_to_split]:
+                                                    parts_boundaries[feature_to_split + 1]]:
+            # Same precision as the features loaded from a file
+            coordinates = [[round(x0, GEOJSON_PRECISION), round(y0, GEOJSON_PRECISION)],
+                           [round(x1, GEOJSON_PRECISION), round(y1, GEOJSON_PRECISION)]]
+            new_features.append({**feature,
+                                 'properties': properties,
+                                 'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+        feature_to_split += 1
 
     data['features'] = new_features
     return data
@@ -358,13 +409,49 @@ def add_traffic_level_from_file(graph, datafile, filename, neighbours_dictionary
     Returns:
         The graph with the traffic level added"""
 
-    for u, v, edge_data in graph.edges(data=True):
-        edge_data["most_recent"] = {'traffic_level': None, 'api_data': False, 'date': filename}
+    return add_traffic_level_from_data(graph, geojson.load(datafile), filename,
+                                       neighbours_dictionary=neighbours_dictionary,
+                                       fill_empty_edges=fill_empty_edges, precision=precision)
+
+
+def add_traffic_level_from_data(graph, data, filename, neighbours_dictionary=None, fill_empty_edges=True,
+                                precision=6, interpolator=None, edge_index=None):
+    """ Add the traffic level to the edges from a GeoJSON object, and add the traffic level to the edges that are empty
+    Args:
+        graph: The graph to add the traffic level
+        data: The GeoJSON object (FeatureCollection) with the split features
+        filename: The filename of the date
+        fill_empty_edges: A boolean to indicate if the empty edges should be filled
+        neighbours_dictionary: The dictionary with the neighbours of the edges
+        precision: The precision to check the traffic level of the interpolations
+        interpolator: The TrafficInterpolator compiled for the graph (compiled when interpolating if None)
+        edge_index: The EdgeSpatialIndex of the graph (built here if None)
+    Returns:
+        The graph with the traffic level added"""
+
+    matches = resolve_traffic_level_edges(graph, data, edge_index=edge_index)
+
+    traffic_state = apply_traffic_level(graph, [(feature["properties"]["traffic_level"], edge_id, extra_edges_ids)
+                                                for feature, edge_id, extra_edges_ids in matches],
+                                        filename, neighbours_dictionary=neighbours_dictionary,
+                                        fill_empty_edges=fill_empty_edges, precision=precision,
+                                        interpolator=interpolator)
+
+    # The old Graph documents are built from the 'most_recent' info of the edges
+    return traffic_state.to_graph(graph)
 
-    data = geojson.load(datafile)
+
+def resolve_traffic_level_edges(graph, data, edge_index=None):
+    """ Get the edge of the graph that gets the traffic level of every (split) feature
+    Args:
+        graph: The graph to add the traffic level
+        data: The GeoJSON object (FeatureCollection) with the split features
+        edge_index: The EdgeSpatialIndex of the graph (built here if None)
+    Returns:
+        A list with a tuple (feature, edge id, extra edges ids) for every feature, in the order of the features"""
 
     coordinates_lat, coordinates_lon, nearest_edges_and_distance_list = __generate_lists_coordiantes_and_neares_edges(
-        data, graph)
+        data, graph, edge_index=edge_index)
 
     if len(nearest_edges_and_distance_list[0]) != len(coordinates_lat) / 2:
         raise ValueError("ERROR: Different number of features and nearest edges")
@@ -372,14 +459,13 @@ def add_traffic_level_from_file(graph, datafile, filename, neighbours_dictionary
     nearest_edges_list = nearest_edges_and_distance_list[0]
     # nearest_distance_list = nearest_edges_and_distance_list[1]
 
+    matches = []
     # Iteration over the features (easiest way to keep the order)
     j = 0
     for feature in data["features"]:
         if skip_feature(feature):
             continue
 
-        info = {'traffic_level': feature["properties"]["traffic_level"], 'api_data': True, 'date': filename}
-
         nearest_edge_id = nearest_edges_list[j]
 
         # We assume that the nearest edge is the correct one (reversed or not)
@@ -389,81 +475,118 @@ def add_traffic_level_from_file(graph, datafile, filename, neighbours_dictionary
         bearing_api_edge = ox.bearing.calculate_bearing(coordinates_lat[j * 2], coordinates_lon[j * 2],
                                                         coordinates_lat[j * 2 + 1], coordinates_lon[j * 2 + 1])
 
-        nearest_edge = graph.edges[node_1_id, node_2_id, 0]
+        edge_id = (node_1_id, node_2_id, 0)
+        extra_edges_ids = ()
+        nearest_edge = graph.edges[edge_id]
 
         if not nearest_edge["oneway"] and are_opposite_bearings(nearest_edge["bearing"], bearing_api_edge):
-            nearest_edge = graph.edges[node_2_id, node_1_id, 0]
+            edge_id = (node_2_id, node_1_id, 0)
+            nearest_edge = graph.edges[edge_id]
 
         # Handle Jimenez Fraud Way (API edge is reversed)
         if nearest_edge["osmid"] == 199419587 and are_opposite_bearings(nearest_edge["bearing"], bearing_api_edge):
-            nearest_edge = handle_jimenez_fraud(graph, node_1_id, node_2_id, filename, info)
+            edge_id, extra_edges_ids = get_jimenez_fraud_edges(node_1_id, node_2_id)
 
-        # Add traffic level
-        nearest_edge["most_recent"] = info
+        matches.append((feature, edge_id, extra_edges_ids))
 
         j += 1
 
+    return matches
+
+
+def apply_traffic_level(graph, matches, filename, neighbours_dictionary=None, fill_empty_edges=True, precision=6,
+                        interpolator=None, traffic_state=None):
+    """ Set the traffic level of the matched edges, and add the traffic level to the edges that are empty
+    Args:
+        graph: The graph to add the traffic level
+        matches: An iterable of tuples (traffic level, edge id, extra edges ids), later ones overwrite earlier ones
+        filename: The filename of the date
+        fill_empty_edges: A boolean to indicate if the empty edges should be filled
+        neighbours_dictionary: The dictionary with the neighbours of the edges
+        precision: The precision to check the traffic level of the interpolations
+        interpolator: The TrafficInterpolator compiled for the graph (compiled when interpolating if None)
+        traffic_state: The TrafficState of the graph, it is reset and reused (a new one is built if None)
+    Returns:
+        The TrafficState with the traffic level"""
+
+    if traffic_state is None:
+        traffic_state = TrafficState(list(graph.edges(keys=True)))
+    traffic_state.reset(filename)
+
+    # The extra edges of Jimenez Fraud Way get the traffic level of their edge too
+    traffic_state.set_matches(matches)
+
     if fill_empty_edges:
-        interpolate_traffic_level(graph, filename, neighbours_dictionary=neighbours_dictionary, precision=precision)
+        interpolate_traffic_level(graph, traffic_state, filename, neighbours_dictionary=neighbours_dictionary,
+                                  precision=precision, interpolator=interpolator)
 
-    return graph
+    return traffic_state
 
 
-def interpolate_traffic_level(graph, filename, neighbours_dictionary=None, precision=6):
+def interpolate_traffic_level(graph, traffic_state, filename, neighbours_dictionary=None, precision=6,
+                              interpolator=None, method='direct'):
     """ Interpolate the traffic level of the edges with the traffic level of the neighbours that have it
     Args:
         graph: The graph to interpolate the traffic level
+        traffic_state: The TrafficState of the graph, it is interpolated in place
         filename: The filename of the date to interpolate
         precision: The precision to check the traffic level of the interpolations
-        neighbours_dictionary: The dictionary with the neighbours of the edges"""
+        neighbours_dictionary: The dictionary with the neighbours of the edges
+        interpolator: The TrafficInterpolator compiled for the graph (compiled here if None)
+        method: 'direct' (harmonic solve, the fixed point of the sweeps), 'iterative' (sweeps until nothing changes at
+            the given precision) or 'incremental' (sweeps near the changed API edges from the previous snapshot of the
+            state, within a tolerance of the direct solve)
+    Returns:
+        The InterpolationResult with the iterations and the convergence of the interpolation"""
 
-    num_iter = 0
-    num_edges_interpolated = 1
-    d = neighbours_dictionary
-    if neighbours_dictionary is None:
-        logging.info("Getting the neighbours edges...")
-        d = {(u, v): get_neighbours_edges(graph, u, v) for u, v, data in graph.edges(data=True)}
+    if interpolator is None:
+        d = neighbours_dictionary
+        if neighbours_dictionary is None:
+            logging.info("Getting the neighbours edges...")
+            d = get_neighbours_edges_dictionary(graph)
+        interpolator = TrafficInterpolator(graph, d)
 
     logging.info("Interpolating the traffic level...")
-    while num_edges_interpolated > 0:
-        num_edges_interpolated = 0
-        num_iter += 1
-
-        for u, v, data in graph.edges(data=True):
-            if not data['most_recent']['api_data']:
-                neighbours_edges = d[(u, v)]
-
-                neighbour_traffic_levels = [graph.edges[edge[0], edge[1], 0]['most_recent']['traffic_level']
-                                            for edge in neighbours_edges
-                                            if
-                                            graph.edges[edge[0], edge[1], 0]['most_recent'][
-                                                'traffic_level'] is not None]
+    result = interpolator.interpolate_state(traffic_state, precision=precision, method=method)
 
-                if len(neighbour_traffic_levels) > 0:
-                    new_traffic_level = sum(neighbour_traffic_levels) / len(neighbour_traffic_levels)
+    logging.info(f"Interpolated {result.edges_filled} edges in {result.iterations} iterations "
+                 f"({result.method}, {'converged' if result.converged else 'not converged'}, "
+                 f"residual {result.residual:.2e}) "
+                 f"file = {filename}")
 
-                    if round(new_traffic_level, precision) != round(
-                            data['most_recent'].get('traffic_level', -1) if data['most_recent'].get(
-                                'traffic_level', -1) is not None else -1, precision):
-                        data['most_recent']['traffic_level'] = new_traffic_level
-                        num_edges_interpolated += 1
-
-        if num_iter % 50 == 0:
-            print("\tIteration: ", num_iter, " - Interpolated ", num_edges_interpolated, " edges\t\tfile =", filename)
+    return result
 
 
 ########################################################################################################################
 #                                         SAVE TRAFFIC LEVEL IN MONGO
 ########################################################################################################################
 
-def save_in_mongo(datetime_string, graph, graph_area):
+def save_in_mongo(datetime_string, traffic_state, graph_area, edge_table, graph_signature, writer=None, encoder=None):
+    """ Save the traffic level of a zone in MongoDB as a columnar snapshot (see Snapshot.to_links to get the links
+    of the old Graph documents back)
+    Args:
+        datetime_string: The filename of the date
+        traffic_state: The TrafficState with the traffic level
+        graph_area: The zone of the graph ('teatinos' or 'soho')
+        edge_table: The EdgeTable of the graph
+        graph_signature: The signature of the graph
+        writer: The SnapshotWriter to spool the snapshot to (inserted synchronously if None)
+        encoder: The SnapshotEncoder of the zone to save keyframes and deltas (a keyframe is saved if None)"""
+    if encoder is not None:
+        snapshot = encoder.encode(traffic_state, datetime_string)
+    else:
+        snapshot = Snapshot.generate_snapshot(traffic_state, datetime_string, edge_table, graph_signature)
+
+    if writer is not None:
+        writer.submit(graph_area, snapshot)
+        return
+
     repo = None
     if graph_area == 'teatinos':
-        repo = RepositorioGraph()
+        repo = RepositorioSnapshot()
     elif graph_area == 'soho':
-        repo = RepositorioGraphSoho()
-    graph_object = Graph.generate_graph(graph, datetime_string)
-    repo.insert_one(graph_object)
+        repo = RepositorioSnapshotSoho()
+    repo.insert_one(snapshot)
 
 
 def get_files_dictionary_from_folder(path):
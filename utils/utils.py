@@ -1,3 +1,10 @@
+from collections import defaultdict
+
+import numpy as np
+
+CARDINAL_DIRECTIONS = ["north", "north east", "east", "south east", "south", "south west", "west", "north west"]
+
+
 def get_neighbours_edges(graph, node1, node2):
     """ Get the neighbours edges of the nodes
     Args:
@@ -21,6 +28,44 @@ def get_neighbours_edges(graph, node1, node2):
     return neighbours_edges
 
 
+def get_neighbours_edges_dictionary(graph):
+    """ Get the neighbours edges of every edge of the graph in a single pass over the edges
+    The result is the same as calling 'get_neighbours_edges' for every edge (same neighbours and in the same order),
+    but the neighbours are taken from the edges incident to each node instead of scanning the whole graph each time.
+    Args:
+        graph: The graph to get the neighbours edges
+    Returns:
+        A dictionary with the list of neighbours edges (u, v) of every edge (u, v)"""
+    edges = list(graph.edges())
+
+    # Positions (in the order of graph.edges) of the edges incident to every node
+    incident_edges = defaultdict(list)
+    for position, (u, v) in enumerate(edges):
+        incident_edges[u].append(position)
+        if v != u:
+            incident_edges[v].append(position)
+
+    neighbours_dictionary = {}
+    for node1, node2 in edges:
+        if (node1, node2) in neighbours_dictionary:
+            continue
+
+        positions = sorted(set(incident_edges[node1]).union(incident_edges[node2]))
+        neighbours_edges = [edges[position] for position in positions]
+
+        neighbours_edges.remove((node1, node2))
+
+        try:
+            # Don't consider the reverse way of the edge, if it exists
+            neighbours_edges.remove((node2, node1))
+        except ValueError:
+            pass
+
+        neighbours_dictionary[(node1, node2)] = neighbours_edges
+
+    return neighbours_dictionary
+
+
 def normalize(x, in_min, in_max, out_min, out_max):
     """ Normalize a value from one range to another
     Args:
@@ -69,7 +114,7 @@ def float_to_hex_color(value):
 
 
 def are_opposite_bearings(bearing_1, bearing_2, tolerance=45):
-    """ Check if two bearings are opposite to each other
+    """ Check if two bearings are opposite to each other (it also works with arrays of bearings)
     Args:
         bearing_1: The first bearing
         bearing_2: The second bearing
@@ -77,7 +122,9 @@ def are_opposite_bearings(bearing_1, bearing_2, tolerance=45):
     Returns:
         A boolean indicating if the bearings are opposite"""
 
-    return abs(bearing_1 - bearing_2) > 180 - tolerance
+    # Angle between both bearings, taking into account the wrap-around (e.g. 350 and 10 are 20 degrees apart)
+    difference = np.abs(np.asarray(bearing_1, dtype=float) - bearing_2) % 360
+    return np.minimum(difference, 360 - difference) > 180 - tolerance
 
 
 def get_cardinal_direction_from_bearing(bearing):
@@ -87,11 +134,19 @@ def get_cardinal_direction_from_bearing(bearing):
     Returns:
         A string with the cardinal direction"""
 
-    points = ["north", "north east", "east", "south east", "south", "south west", "west", "north west"]
-
     bearing = bearing % 360
     bearing = int(bearing / 45)  # values 0 to 7
-    return points[bearing]
+    return CARDINAL_DIRECTIONS[bearing]
+
+
+def get_cardinal_directions_from_bearings(bearings):
+    """ Get the cardinal direction of every bearing of an array
+    Args:
+        bearings: The bearings in degrees
+    Returns:
+        An array with the cardinal directions"""
+
+    return np.array(CARDINAL_DIRECTIONS, dtype=object)[(np.asarray(bearings, dtype=float) % 360 / 45).astype(int)]
 
 
 def skip_feature(feature):
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from utils.utils_pbf import RawTile
+
+SEGMENT_EXTENSION = ".tiles"
+INDEX_EXTENSION = ".index"
+
+# Formats of the records: the raw .pbf or the decoded JSON (the old archives that only kept the .pbf.json)
+FORMAT_PBF = 0
+FORMAT_JSON = 1
+
+# An entry of the index of a segment: the datetime (as the integer YYYYMMDDHHMMSS), the offset and the length of the
+# compressed record and its format
+INDEX_DTYPE = np.dtype([('key', '<i8'), ('offset', '<u8'), ('length', '<u4'), ('format', 'u1')])
+
+
+def get_datetime_key(datetime_str):
+    """ Get the integer key of a datetime string ('2024_12_02_10_15_00' -> 20241202101500)"""
+    return int(datetime_str.replace("_", ""))
+
+
+def get_datetime_string(key):
+    """ Get the datetime string of an integer key (20241202101500 -> '2024_12_02_10_15_00')"""
+    key = f"{int(key):014d}"
+    return "_".join((key[0:4], key[4:6], key[6:8], key[8:10], key[10:12], key[12:14]))
+
+
+def is_datetime_string(value):
+    try:
+        datetime.strptime(value, "%Y_%m_%d_%H_%M_%S")
+        return True
+    except ValueError:
+        return False
+
+
+class TileArchive:
+    """ Append-only archive of the raw tiles: one segment per tile and day ('<data_dir>/<tile>/<YYYY_MM_DD>.tiles')
+    with the zlib compressed tiles one after the other, and an index next to it ('<YYYY_MM_DD>.index') with the
+    datetime, offset, length and format of every record
+
+    The record is written (and synced) before its index entry, so a crash never leaves an entry without its record.
+    A record without entry (or a torn entry) at the end of a segment is overwritten by the next append. When a
+    datetime is archived twice, the last record is the one that is read.
+    Args:
+        data_dir: The folder of the archive
+        compression_level: The zlib compression level of the records"""
+
+    def __init__(self, data_dir="data", compression_level=6):
+        self.data_dir = data_dir
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        self._indexes = {}
+
+    def _segment_path(self, tile_name, day):
+        return f"{self.data_dir}/{tile_name}/{day}"
+
+    def _read_index(self, tile_name, day):
+        """ Get the valid entries of the index of a segment (cached until the index changes)"""
+        path = self._segment_path(tile_name, day)
+        if not os.path.exists(path + INDEX_EXTENSION) or not os.path.exists(path + SEGMENT_EXTENSION):
+            return np.empty(0, dtype=INDEX_DTYPE)
+
+        index_size = os.path.getsize(path + INDEX_EXTENSION)
+        cached = self._indexes.get((tile_name, day))
+        if cached is not None and cached[0] == index_size:
+            return cached[1]
+
+        # A torn entry at the end is ignored, as the entries whose record is not complete
+        index = np.fromfile(path + INDEX_EXTENSION, dtype=INDEX_DTYPE, count=index_size // INDEX_DTYPE.itemsize)
+        complete = index['offset'] + index['length'] <= os.path.getsize(path + SEGMENT_EXTENSION)
+        if not complete.all():
+            index = index[:np.argmin(complete)]
+
+        self._indexes[(tile_name, day)] = (index_size, index)
+        return index
+
+    def append(self, tile_name, datetime_str, data, data_format=FORMAT_PBF):
+        """ Archive a tile
+        Args:
+            tile_name: The name of the tile
+            datetime_str: The datetime string of the snapshot
+            data: The raw content of the tile (or the encoded JSON if data_format is FORMAT_JSON)
+            data_format: FORMAT_PBF or FORMAT_JSON"""
+        day = datetime_str[:10]
+        path = self._segment_path(tile_name, day)
+        compressed = zlib.compress(data, self.compression_level)
+
+        with self.lock:
+            os.makedirs(f"{self.data_dir}/{tile_name}", exist_ok=True)
+            index = self._read_index(tile_name, day)
+            offset = int(index['offset'][-1] + index['length'][-1]) if len(index) else 0
+
+            with open(path + SEGMENT_EXTENSION, "r+b" if os.path.exists(path + SEGMENT_EXTENSION) else "wb") as file:
+                file.seek(offset)
+                file.write(compressed)
+                file.truncate()
+                file.flush()
+                os.fsync(file.fileno())
+
+            entry = np.array([(get_datetime_key(datetime_str), offset, len(compressed), data_format)],
+                             dtype=INDEX_DTYPE)
+            with open(path + INDEX_EXTENSION, "r+b" if os.path.exists(path + INDEX_EXTENSION) else "wb") as file:
+                file.seek(len(index) * INDEX_DTYPE.itemsize)
+                file.write(entry.tobytes())
+                file.truncate()
+                file.flush()
+                os.fsync(file.fileno())
+
+        logging.info(f"Archived {tile_name} {datetime_str} ({len(data)} bytes, {len(compressed)} compressed)")
+
+    @staticmethod
+    def _decode_record(compressed, data_format):
+        data = zlib.decompress(compressed)
+        if data_format == FORMAT_JSON:
+            return json.loads(data)
+        return RawTile(data)
+
+    def get(self, tile_name, datetime_str):
+        """ Get an archived tile
+        Args:
+            tile_name: The name of the tile
+            datetime_str: The datetime string of the snapshot
+        Returns:
+            The RawTile (or the decoded tile of the JSON records), None if it is not archived"""
+        day = datetime_str[:10]
+        index = self._read_index(tile_name, day)
+        positions = np.flatnonzero(index['key'] == get_datetime_key(datetime_str))
+        if not len(positions):
+            return None
+
+        entry = index[positions[-1]]
+        with open(self._segment_path(tile_name, day) + SEGMENT_EXTENSION, "rb") as file:
+            file.seek(int(entry['offset']))
+            return self._decode_record(file.read(int(entry['length'])), entry['format'])
+
+    def days(self, tile_name):
+        """ Get the sorted days with a segment of a tile"""
+        tile_dir = f"{self.data_dir}/{tile_name}"
+        if not os.path.isdir(tile_dir):
+            return []
+        return sorted(filename[:-len(INDEX_EXTENSION)] for filename in os.listdir(tile_dir)
+                      if filename.endswith(INDEX_EXTENSION))
+
+    def _entries(self, tile_name, day, start_key, end_key):
+        """ Get the entries of a segment in the range, sorted by datetime (the last record of every datetime)"""
+        index = self._read_index(tile_name, day)
+        entries = {int(entry['key']): entry for entry in index if start_key <= entry['key'] <= end_key}
+        return [entries[key] for key in sorted(entries)]
+
+    def datetimes(self, tile_name, start=None, end=None):
+        """ Get the archived datetime strings of a tile
+        Args:
+            tile_name: The name of the tile
+            start: The first datetime string to include (all if None)
+            end: The last datetime string to include (all if None)
+        Returns:
+            The sorted list of datetime strings"""
+        start_key = get_datetime_key(start) if start is not None else 0
+        end_key = get_datetime_key(end) if end is not None else np.iinfo(np.int64).max
+        return [get_datetime_string(entry['key'])
+                for day in self.days(tile_name)
+                if (start is None or day >= start[:10]) and (end is None or day <= end[:10])
+                for entry in self._entries(tile_name, day, start_key, end_key)]
+
+    def iter_range(self, tile_name, start=None, end=None):
+        """ Read the archived tiles of a tile in a range, one segment at a time
+        Args:
+            tile_name: The name of the tile
+            start: The first datetime string to include (all if None)
+            end: The last datetime string to include (all if None)
+        Returns:
+            A generator of (datetime string, RawTile or decoded tile) in chronological order"""
+        start_key = get_datetime_key(start) if start is not None else 0
+        end_key = get_datetime_key(end) if end is not None else np.iinfo(np.int64).max
+        for day in self.days(tile_name):
+            if (start is not None and day < start[:10]) or (end is not None and day > end[:10]):
+                continue
+            entries = self._entries(tile_name, day, start_key, end_key)
+            if not entries:
+                continue
+            with open(self._segment_path(tile_name, day) + SEGMENT_EXTENSION, "rb") as file:
+                for entry in entries:
+                    file.seek(int(entry['offset']))
+                    yield (get_datetime_string(entry['key']),
+                           self._decode_record(file.read(int(entry['length'])), entry['format']))
+
+
+def migrate_tile_folder(archive, tile_name, remove=False):
+    """ Move the old archive of a tile (a .pbf and a .pbf.json per snapshot) into the segments of the archive
+    The raw .pbf is archived when it exists, otherwise the .pbf.json (as compact JSON). The snapshots already in
+    the archive are skipped, so an interrupted migration can be run again.
+    Args:
+        archive: The TileArchive
+        tile_name: The name of the tile (folder inside the data folder of the archive)
+        remove: A boolean to indicate if the old files should be removed once they are archived
+    Returns:
+        The amount of snapshots archived"""
+    tile_dir = f"{archive.data_dir}/{tile_name}"
+    files = {}
+    for filename in os.listdir(tile_dir):
+        datetime_str = filename.split(".")[0]
+        if (filename.endswith(".pbf") or filename.endswith(".pbf.json")) and is_datetime_string(datetime_str):
+            files.setdefault(datetime_str, []).append(filename)
+
+    archived = set(archive.datetimes(tile_name))
+    migrated = 0
+    for datetime_str in sorted(files):
+        if datetime_str not in archived:
+            filename = f"{tile_dir}/{datetime_str}.pbf"
+            if os.path.exists(filename):
+                with open(filename, "rb") as file:
+                    archive.append(tile_name, datetime_str, file.read())
+            else:
+                with open(f"{filename}.json") as file:
+                    data = json.dumps(json.load(file), separators=(",", ":")).encode()
+                archive.append(tile_name, datetime_str, data, data_format=FORMAT_JSON)
+            migrated += 1
+
+        if remove:
+            for filename in files[datetime_str]:
+                os.remove(f"{tile_dir}/{filename}")
+
+    logging.info(f"{tile_name}: {migrated} snapshots migrated, {len(files) - migrated} already archived")
+    return migrated
+
+
+def migrate_archive(data_dir="data", remove=False):
+    """ Migrate the old archive of every tile of a data folder
+    Args:
+        data_dir: The data folder
+        remove: A boolean to indicate if the old files should be removed once they are archived
+    Returns:
+        A dictionary with the amount of snapshots archived by tile name"""
+    archive = TileArchive(data_dir)
+    return {tile_name: migrate_tile_folder(archive, tile_name, remove=remove)
+            for tile_name in sorted(os.listdir(data_dir)) if os.path.isdir(f"{data_dir}/{tile_name}")}
@@ -0,0 +1,82 @@
+import numpy as np
+
+# Attributes of the edges that are not kept in the links of the snapshots
+CLEAN_EDGE_KEYS = ('dates', 'lanes', 'oneway', 'bearing', 'speed_kph', 'maxspeed', 'length',
+                   'geometry', 'ref', 'service', 'junction', 'reversed', 'travel_time')
+
+# Attributes of the links that change with every snapshot
+SNAPSHOT_EDGE_KEYS = ('most_recent', 'traffic_level', 'api_data', 'current_speed')
+
+
+def parse_maxspeed(maxspeed):
+    """ Parse the maxspeed of an edge (the mean if it is a list)
+    Args:
+        maxspeed: The maxspeed attribute of the edge (0 if it does not exist)
+    Returns:
+        The maxspeed as a float, NaN if it can not be parsed"""
+    try:
+        if type(maxspeed) is list:
+            return sum(float(x) for x in maxspeed) / len(maxspeed)
+        return float(maxspeed)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class EdgeTable:
+    """ Static attributes of the edges of a zone as aligned arrays (one position per edge, in the order of graph.edges)
+    Args:
+        graph: The graph of the zone"""
+
+    def __init__(self, graph):
+        self.edges = list(graph.edges(keys=True))
+        self.index = {edge: position for position, edge in enumerate(self.edges)}
+
+        edges_data = [data for u, v, data in graph.edges(data=True)]
+        self.bearing = np.array([data.get('bearing', np.nan) for data in edges_data], dtype=float)
+        self.oneway = np.array([bool(data.get('oneway', False)) for data in edges_data], dtype=bool)
+        self.reversed = np.array([bool(data.get('reversed', False)) for data in edges_data], dtype=bool)
+        self.junction = np.array([data.get('junction') for data in edges_data], dtype=object)
+        self.maxspeed = np.array([parse_maxspeed(data.get('maxspeed', 0)) for data in edges_data], dtype=float)
+        self.length = np.array([data.get('length', np.nan) for data in edges_data], dtype=float)
+
+        # Attributes of the links that do not change between snapshots
+        self.static_links = [
+            {key: value for key, value in data.items() if key not in CLEAN_EDGE_KEYS and key not in SNAPSHOT_EDGE_KEYS}
+            for data in edges_data]
+
+    @classmethod
+    def from_arrays(cls, edges, bearing, oneway, reversed, junction, maxspeed, length, static_links):
+        """ Build the table of already computed arrays (e.g. the ones of a compiled zone)
+        Args:
+            edges: The list of edges (u, v, key)
+            bearing, oneway, reversed, junction, maxspeed, length: The arrays of the attributes
+            static_links: The list with the attributes of the links that do not change between snapshots
+        Returns:
+            The EdgeTable"""
+        table = cls.__new__(cls)
+        table.edges = edges
+        table.index = {edge: position for position, edge in enumerate(edges)}
+        table.bearing = bearing
+        table.oneway = oneway
+        table.reversed = reversed
+        table.junction = junction
+        table.maxspeed = maxspeed
+        table.length = length
+        table.static_links = static_links
+        return table
+
+    def __len__(self):
+        return len(self.edges)
+
+    def positions(self, edges):
+        """ Get the positions of the given edges (u, v, key)"""
+        return np.array([self.index[tuple(edge)] for edge in edges], dtype=int)
+
+    def current_speed(self, traffic_level):
+        """ Get the current speed of every edge (maxspeed * traffic level, 0 if any of them is unknown)
+        Args:
+            traffic_level: Array with the traffic level of every edge (NaN if unknown)
+        Returns:
+            An array with the current speed of every edge"""
+        current_speed = self.maxspeed * np.asarray(traffic_level, dtype=float)
+        return np.where(np.isnan(current_speed), 0.0, current_speed)
@@ -1,5 +1,8 @@
 import math
 
+# Precision of the coordinates when they are loaded or dumped with the 'geojson' library
+GEOJSON_PRECISION = 6
+
 
 def create_linestring_geojson(coordinates, properties):
     """ Create a GeoJSON object with a LineString geometry
@@ -19,6 +22,18 @@ def create_linestring_geojson(coordinates, properties):
     }
 
 
+def round_coordinates(coordinates, precision=GEOJSON_PRECISION):
+    """ Round the coordinates the same way the 'geojson' library does when it loads or dumps a geometry
+    Args:
+        coordinates: A (nested) list of coordinates
+        precision: The number of decimals to keep
+    Returns:
+        A (nested) list with the rounded coordinates"""
+
+    return [round_coordinates(coordinate, precision) if isinstance(coordinate, (list, tuple))
+            else round(coordinate, precision) for coordinate in coordinates]
+
+
 def get_geojson_corners_coordinates(x_tile, y_tile, zoom, format="latlng"):
     """ Get the coordinates of the corners of a tile in the GeoJSON format
     Args:
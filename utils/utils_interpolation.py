@@ -0,0 +1,313 @@
+from typing import NamedTuple
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+# Default maximum difference between the incremental interpolation and the direct solve, under half of the
+# quantization step of the traffic level of the snapshots (1 / 254)
+INCREMENTAL_TOLERANCE = 1e-3
+
+
+class InterpolationResult(NamedTuple):
+    """ Summary of an interpolation of the traffic level
+    Args:
+        method: The method used ('iterative' or 'direct')
+        iterations: The amount of sweeps over the edges (1 for the direct solve)
+        converged: A boolean indicating if the interpolation converged before the maximum amount of iterations
+        edges_filled: The amount of edges without API data that have a traffic level after the interpolation
+        residual: The maximum difference between an interpolated edge and the mean of its neighbours
+        error_bound: The maximum difference with the traffic level of the direct solve (0 for the direct solve, NaN if
+            unknown)"""
+    method: str
+    iterations: int
+    converged: bool
+    edges_filled: int
+    residual: float
+    error_bound: float = float('nan')
+
+
+class HarmonicSystem(NamedTuple):
+    """ Linear system of the direct solve for a set of edges with traffic level, factorized once and reused while the
+    edges with API data do not change
+    Args:
+        known: Boolean array with the edges with API data and traffic level
+        api_mask: Boolean array with the edges with API data
+        reachable: Boolean array with the known edges and the ones without API data with a path of neighbours to them
+        unknown: Array with the positions of the edges to interpolate (reachable, without API data)
+        adjacency_known: The rows of the unknown edges and the columns of the known ones of the adjacency matrix
+        coupling: The rows and columns of the unknown edges of the adjacency matrix
+        degree: Array with the amount of reachable neighbours of every unknown edge
+        factorization: The LU factorization of the system (None if there is no edge to interpolate)
+        components: Array with the connected component of every unknown edge (they do not depend on each other)
+        hitting_time: Array with the maximum hitting time of the known edges of every component (the expected sweeps
+            of the random walk of the means), it bounds the error of an interpolation from its residual"""
+    known: np.ndarray
+    api_mask: np.ndarray
+    reachable: np.ndarray
+    unknown: np.ndarray
+    adjacency_known: scipy.sparse.csr_matrix
+    coupling: scipy.sparse.csr_matrix
+    degree: np.ndarray
+    factorization: object
+    components: np.ndarray
+    hitting_time: np.ndarray
+
+
+class TrafficInterpolator:
+    """ Interpolate the traffic level of the edges without API data from their neighbours
+
+    The neighbours relation is compiled once into a sparse matrix (one row per edge of the graph, in the order of
+    graph.edges, and one column per edge read, that is, the edge with key 0 as in 'interpolate_traffic_level').
+    A neighbour that appears twice in the neighbours list counts twice in the mean, as in the original loop.
+    The factorized system of the last direct solve is kept (harmonic_system), so the next snapshots with the same edges
+    with API data skip it, and the incremental interpolation starts from the traffic level of the previous snapshot.
+    Args:
+        graph: The graph of the zone
+        neighbours_dictionary: The dictionary with the neighbours of the edges"""
+
+    def __init__(self, graph, neighbours_dictionary):
+        self.edges = list(graph.edges(keys=True))
+        self.edge_index = {edge: i for i, edge in enumerate(self.edges)}
+
+        rows, columns = [], []
+        for i, (u, v, key) in enumerate(self.edges):
+            for neighbour_u, neighbour_v in neighbours_dictionary[(u, v)]:
+                rows.append(i)
+                columns.append(self.edge_index[(neighbour_u, neighbour_v, 0)])
+
+        # Repeated (row, column) pairs are summed, so the weight is the multiplicity of the neighbour
+        self.adjacency = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                                                 shape=(len(self.edges), len(self.edges)))
+        self.harmonic_system = None
+
+    @classmethod
+    def from_adjacency(cls, edges, adjacency):
+        """ Build the interpolator of an already compiled adjacency matrix (e.g. the one of a compiled zone)
+        Args:
+            edges: The list of edges (u, v, key), in the order of the rows of the matrix
+            adjacency: The CSR adjacency matrix
+        Returns:
+            The TrafficInterpolator"""
+        interpolator = cls.__new__(cls)
+        interpolator.edges = edges
+        interpolator.edge_index = {edge: i for i, edge in enumerate(edges)}
+        interpolator.adjacency = adjacency
+        interpolator.harmonic_system = None
+        return interpolator
+
+    def __getstate__(self):
+        # The factorization can not be pickled, it is built again by the first direct solve
+        state = self.__dict__.copy()
+        state['harmonic_system'] = None
+        return state
+
+    def _neighbours_mean(self, values):
+        """ Get the mean of the neighbours with traffic level (NaN if none of them has it)"""
+        known = ~np.isnan(values)
+        sums = self.adjacency @ np.where(known, values, 0.0)
+        counts = self.adjacency @ known.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / np.where(counts > 0, counts, 1.0), np.nan)
+
+    def _residual(self, values, api_mask):
+        means = self._neighbours_mean(values)
+        interpolated = ~api_mask & ~np.isnan(values) & ~np.isnan(means)
+        if not interpolated.any():
+            return 0.0
+        return float(np.max(np.abs(values[interpolated] - means[interpolated])))
+
+    def _reachable(self, known, api_mask):
+        """ Get the edges that will get a traffic level: the known ones and the ones without API data with a path of
+        neighbours to them (an API edge without traffic level never gets one, so the paths do not go through it)"""
+        reachable = known.copy()
+        while True:
+            newly_reachable = ((self.adjacency @ reachable.astype(float)) > 0) & ~reachable & ~api_mask
+            if not newly_reachable.any():
+                return reachable
+            reachable |= newly_reachable
+
+    def interpolate_iterative(self, values, api_mask, precision=6, max_iterations=10_000):
+        """ Jacobi sweeps: every edge without API data takes the mean of its neighbours with traffic level, until no
+        edge changes at the given precision (same stop condition as the original loop). The original loop updated the
+        edges in place one by one (Gauss-Seidel), so it needed fewer sweeps than this method for the same result
+        Args:
+            values: Array with the traffic level of every edge (NaN if unknown), it is modified in place
+            api_mask: Boolean array with the edges that have API data (they are never modified)
+            precision: The precision to check the traffic level of the interpolations
+            max_iterations: The maximum amount of sweeps
+        Returns:
+            The InterpolationResult"""
+        iterations = 0
+        converged = False
+        while iterations < max_iterations:
+            iterations += 1
+
+            means = self._neighbours_mean(values)
+            candidates = ~api_mask & ~np.isnan(means)
+            previous = np.where(np.isnan(values), -1, values)
+            changed = candidates & (np.round(means, precision) != np.round(previous, precision))
+
+            if not changed.any():
+                converged = True
+                break
+
+            values[changed] = means[changed]
+
+        return InterpolationResult('iterative', iterations, converged,
+                                   int(np.count_nonzero(~api_mask & ~np.isnan(values))),
+                                   self._residual(values, api_mask))
+
+    def _get_system(self, known, api_mask):
+        """ Get the factorized system of the direct solve for the edges with traffic level (the last one if they have
+        not changed)"""
+        system = self.harmonic_system
+        if system is not None and np.array_equal(system.known, known) and np.array_equal(system.api_mask, api_mask):
+            return system
+
+        reachable = self._reachable(known, api_mask)
+        unknown = np.flatnonzero(reachable & ~known)
+        adjacency_unknown = self.adjacency[unknown]
+        degree = np.asarray(adjacency_unknown[:, reachable].sum(axis=1)).ravel()
+        coupling = adjacency_unknown[:, unknown].tocsr()
+
+        factorization, components, hitting_time = None, np.zeros(0, dtype=int), np.zeros(0)
+        if len(unknown):
+            factorization = scipy.sparse.linalg.splu((scipy.sparse.diags(degree) - coupling).tocsc())
+            # Expected steps of a walk from every unknown edge to a random neighbour until it reaches a known one
+            steps = factorization.solve(degree)
+            _, components = scipy.sparse.csgraph.connected_components(coupling, directed=True, connection='weak')
+            hitting_time = np.zeros(components.max() + 1)
+            np.maximum.at(hitting_time, components, steps)
+
+        self.harmonic_system = HarmonicSystem(known.copy(), api_mask.copy(), reachable, unknown,
+                                              adjacency_unknown[:, known].tocsr(), coupling, degree, factorization,
+                                              components, hitting_time)
+        return self.harmonic_system
+
+    def _solve(self, values, system):
+        """ Set the traffic level of the unknown edges of a system to its solution"""
+        if system.factorization is not None:
+            values[system.unknown] = system.factorization.solve(system.adjacency_known @ values[system.known])
+
+    def _direct_result(self, values, api_mask):
+        return InterpolationResult('direct', 1, True, int(np.count_nonzero(~api_mask & ~np.isnan(values))),
+                                   self._residual(values, api_mask), 0.0)
+
+    def interpolate_direct(self, values, api_mask):
+        """ Harmonic solve: with the API edges fixed, solve the linear system where every reachable edge is the mean of
+        its neighbours with traffic level (the fixed point the iterative method converges to)
+        Args:
+            values: Array with the traffic level of every edge (NaN if unknown), it is modified in place
+            api_mask: Boolean array with the edges that have API data (they are never modified)
+        Returns:
+            The InterpolationResult"""
+        known = api_mask & ~np.isnan(values)
+        self._solve(values, self._get_system(known, api_mask))
+        return self._direct_result(values, api_mask)
+
+    def interpolate_incremental(self, values, api_mask, previous_values, hops=2, tolerance=INCREMENTAL_TOLERANCE,
+                                max_sweeps=8):
+        """ Warm-started interpolation: the unknown edges start from the traffic level of the previous snapshot and
+        only the ones within some hops of an API edge whose traffic level has changed are swept
+
+        The error of the result is bounded from its residual: in every component of unknown edges, the difference with
+        the direct solve is at most its maximum residual times its hitting time. The components whose bound exceeds
+        the tolerance get the traffic level of the direct solve (solved with the factorization of the previous
+        snapshot), so the result is always within the tolerance of the direct solve. If the edges with API data are
+        not the ones of the previous snapshot, the result is the direct solve.
+        Args:
+            values: Array with the traffic level of every edge (NaN if unknown), it is modified in place
+            api_mask: Boolean array with the edges that have API data (they are never modified)
+            previous_values: Array with the interpolated traffic level of every edge in the previous snapshot
+            hops: The hops of neighbours from the changed API edges of the swept edges
+            tolerance: The maximum difference with the direct solve
+            max_sweeps: The maximum amount of sweeps over the swept edges
+        Returns:
+            The InterpolationResult (method 'direct' if the direct solve was used for every edge)"""
+        known = api_mask & ~np.isnan(values)
+        previous_system = self.harmonic_system
+        system = self._get_system(known, api_mask)
+        if system.factorization is None:
+            return self._direct_result(values, api_mask)
+
+        current = previous_values[system.unknown]
+        if system is not previous_system or np.isnan(current).any():
+            self._solve(values, system)
+            return self._direct_result(values, api_mask)
+
+        # The unknown edges within some hops of the changed API edges
+        changed = known & (values != previous_values)
+        for _ in range(hops):
+            changed |= (self.adjacency @ changed.astype(float)) > 0
+        frontier = np.flatnonzero(changed[system.unknown])
+
+        independent = system.adjacency_known @ values[system.known]
+        sweeps = 0
+        if len(frontier):
+            coupling, degree = system.coupling[frontier], system.degree[frontier]
+            threshold = tolerance / system.hitting_time[system.components[frontier]].max()
+            while sweeps < max_sweeps:
+                sweeps += 1
+                means = (coupling @ current + independent[frontier]) / degree
+                change = np.max(np.abs(means - current[frontier]))
+                current[frontier] = means
+                if change <= threshold:
+                    break
+
+        residual = np.abs(current - (system.coupling @ current + independent) / system.degree)
+        error_bound = np.zeros(len(system.hitting_time))
+        np.maximum.at(error_bound, system.components, residual)
+        error_bound *= system.hitting_time
+
+        # The components that the sweeps have not brought within the tolerance are solved
+        unbounded = error_bound[system.components] > tolerance
+        if unbounded.all():
+            self._solve(values, system)
+            return self._direct_result(values, api_mask)
+        if unbounded.any():
+            current[unbounded] = system.factorization.solve(independent)[unbounded]
+            error_bound[error_bound > tolerance] = 0.0
+
+        values[system.unknown] = current
+        return InterpolationResult('incremental', sweeps, True, int(np.count_nonzero(~api_mask & ~np.isnan(values))),
+                                   self._residual(values, api_mask), float(error_bound.max()))
+
+    def interpolate(self, values, api_mask, precision=6, method='iterative', max_iterations=10_000,
+                    previous_values=None):
+        """ Interpolate the traffic level of the edges without API data
+        Args:
+            values: Array with the traffic level of every edge (NaN if unknown), it is modified in place
+            api_mask: Boolean array with the edges that have API data
+            precision: The precision to check the traffic level of the interpolations (iterative method)
+            method: 'iterative', 'direct' or 'incremental'
+            max_iterations: The maximum amount of sweeps (iterative method)
+            previous_values: Array with the traffic level of the previous snapshot (incremental method, the direct
+                solve is used if None)
+        Returns:
+            The InterpolationResult"""
+        if method == 'iterative':
+            return self.interpolate_iterative(values, api_mask, precision=precision, max_iterations=max_iterations)
+        elif method == 'direct' or (method == 'incremental' and previous_values is None):
+            return self.interpolate_direct(values, api_mask)
+        elif method == 'incremental':
+            return self.interpolate_incremental(values, api_mask, previous_values)
+        else:
+            raise ValueError("Invalid method. Choose 'iterative', 'direct' or 'incremental'.")
+
+    def interpolate_state(self, traffic_state, precision=6, method='iterative', max_iterations=10_000):
+        """ Interpolate in place the traffic level of a TrafficState
+        Args:
+            traffic_state: The TrafficState of the graph (aligned with the edges the interpolator was compiled with)
+            precision: The precision to check the traffic level of the interpolations (iterative method)
+            method: 'iterative', 'direct' or 'incremental' (starting from the previous snapshot of the state)
+            max_iterations: The maximum amount of sweeps (iterative method)
+        Returns:
+            The InterpolationResult"""
+        if len(traffic_state) != len(self.edges):
+            raise ValueError(f"The traffic state has {len(traffic_state)} edges and the interpolator {len(self.edges)}")
+
+        # The edges with API data are never modified, so the arrays of the state are interpolated directly
+        return self.interpolate(traffic_state.traffic_level, traffic_state.api_data, precision=precision, method=method,
+                                max_iterations=max_iterations, previous_values=traffic_state.previous_traffic_level)
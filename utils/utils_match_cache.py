@@ -0,0 +1,87 @@
+import hashlib
+from collections import OrderedDict
+
+from utils.utils_geojson import GEOJSON_PRECISION, round_coordinates
+
+
+def get_graph_signature(graph):
+    """ Get a hash of everything of the graph the matching of the features depends on (edges, nodes positions,
+    geometries, bearings, directions and junctions)
+    Args:
+        graph: The graph of the zone
+    Returns:
+        The hexadecimal digest of the graph"""
+    sha256 = hashlib.sha256()
+    for node, data in graph.nodes(data=True):
+        sha256.update(repr((node, data.get('x'), data.get('y'))).encode())
+    for u, v, key, data in graph.edges(keys=True, data=True):
+        geometry = data.get('geometry')
+        sha256.update(repr((u, v, key, data.get('osmid'), data.get('bearing'), data.get('oneway'),
+                            data.get('reversed'), data.get('junction'),
+                            geometry.wkt if geometry is not None else None)).encode())
+    return sha256.hexdigest()
+
+
+def get_segment_key(coordinates, precision=GEOJSON_PRECISION):
+    """ Get the key of a translated segment: its coordinates quantized to the precision used by the pipeline
+    Args:
+        coordinates: The coordinates of the segment
+        precision: The number of decimals to keep
+    Returns:
+        A hashable key"""
+    return tuple(tuple(point) for point in round_coordinates(coordinates, precision))
+
+
+class MatchCache:
+    """ LRU cache of the edges matched to every translated segment, shared between snapshots
+
+    The value of a segment is a tuple with a (edge id, extra edges ids) pair for every part the segment is split in
+    (empty if the segment is discarded for being too far from the graph). The cache is cleared when the signature of
+    the graph or the parameters of the matching change.
+    Args:
+        max_size: The maximum amount of segments kept
+        signature: The signature of the graph and the matching parameters the cached values are valid for"""
+
+    def __init__(self, max_size=100_000, signature=None):
+        self.max_size = max_size
+        self.signature = signature
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def ensure_signature(self, signature):
+        """ Clear the cache if it was filled for a different graph or matching parameters
+        Args:
+            signature: The current signature
+        Returns:
+            A boolean indicating if the cache was invalidated"""
+        if signature == self.signature:
+            return False
+        self.invalidate()
+        self.signature = signature
+        return True
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def get(self, key):
+        """ Get the matches of a segment (None if it is not cached), marking it as recently used"""
+        matches = self.entries.get(key)
+        if matches is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return matches
+
+    def put(self, key, matches):
+        self.entries[key] = tuple(matches)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Help of the values recorded by the zones (exposed as scrapper_zone_<name>)
+ZONE_VALUES_HELP = {
+    'tiles': "Tiles of the zone in the cycle",
+    'tile_features': "Features of the tiles of the zone",
+    'missing_tiles': "Tiles of the zone missing in the cycle",
+    'segments': "Segments (pairs of consecutive points) translated from the tiles",
+    'segments_cached': "Segments matched from the match cache",
+    'segments_resolved': "Segments matched against the graph",
+    'distant_rejections': "Segments discarded because they are too far from the nearest edge",
+    'split_parts': "Parts of the split segments matched with an edge",
+    'interpolation_iterations': "Iterations of the interpolation",
+    'edges_filled': "Edges without API data that got a traffic level from the interpolation",
+    'interpolation_residual': "Residual of the interpolation",
+    'interpolation_error_bound': "Bound of the difference between the interpolation and the direct solve",
+}
+
+
+class CycleMetrics:
+    """ Durations of the stages and values (counts, iterations...) of a cycle of a zone"""
+
+    def __init__(self):
+        self.timings = {}
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ Time a stage (the time of a stage run several times is added up)"""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def to_dict(self):
+        return {'timings': dict(self.timings), 'values': dict(self.values)}
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_samples(name, metric_type, help_text, samples):
+    """ Get the lines of a metric in the Prometheus text format
+    Args:
+        name: The name of the metric
+        metric_type: 'gauge' or 'counter'
+        help_text: The help of the metric
+        samples: A list of (labels dictionary, value), the samples without value are left out
+    Returns:
+        The list of lines"""
+    samples = [(labels, value) for labels, value in samples if value is not None]
+    if not samples:
+        return []
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_string = ",".join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_string}}} {float(value)!r}" if labels else f"{name} {float(value)!r}")
+    return lines
+
+
+class MetricsExporter:
+    """ Export the metrics of every cycle as a JSON line ('cycles.jsonl') and as a Prometheus text file
+    ('scrapper.prom', to be read by the textfile collector of the node exporter or served as it is)
+
+    The text file is replaced atomically with the metrics of the last cycle and the totals since the start. A cycle that
+    ends (from its wall-clock boundary) after 'warning_ratio' of the budget is logged as a warning.
+    Args:
+        metrics_dir: The folder of the files
+        budget: The seconds a cycle has (the period of the cycles)
+        warning_ratio: The part of the budget over which a cycle is logged as a warning"""
+
+    def __init__(self, metrics_dir="metrics", budget=900, warning_ratio=0.8):
+        self.metrics_dir = metrics_dir
+        self.json_path = f"{metrics_dir}/cycles.jsonl"
+        self.prometheus_path = f"{metrics_dir}/scrapper.prom"
+        self.budget = budget
+        self.warning_ratio = warning_ratio
+        self.cycles_by_status = {}
+        self.zone_errors = {}
+
+    def build_record(self, cycle, fetch=None, zones=None, writer=None):
+        """ Build the record of a cycle
+        Args:
+            cycle: The CycleRecord of the scheduler
+            fetch: Dictionary with the metrics of the fetch (tiles, tiles_failed, bytes)
+            zones: Dictionary by zone with the metrics of the zone (elapsed, error, timings and values)
+            writer: Dictionary with the statistics of the SnapshotWriter
+        Returns:
+            The record dictionary"""
+        end = cycle.process_finished if cycle.process_finished is not None else cycle.fetched
+        duration = None if end is None else end - cycle.scheduled
+        return {
+            **cycle.to_dict(),
+            'duration': duration,
+            'budget': self.budget,
+            'budget_ratio': None if duration is None else duration / self.budget,
+            'fetch': fetch or {},
+            'zones': zones or {},
+            'writer': writer or {}
+        }
+
+    def export(self, cycle, fetch=None, zones=None, writer=None):
+        """ Write the metrics of a cycle (see build_record)
+        Returns:
+            The record of the cycle"""
+        record = self.build_record(cycle, fetch=fetch, zones=zones, writer=writer)
+        self.cycles_by_status[record['status']] = self.cycles_by_status.get(record['status'], 0) + 1
+        for zone_id, zone in record['zones'].items():
+            self.zone_errors[zone_id] = self.zone_errors.get(zone_id, 0) + (zone.get('error') is not None)
+
+        if record['budget_ratio'] is not None and record['budget_ratio'] > self.warning_ratio:
+            logging.warning(f"Cycle {record['datetime_str']} took {record['duration']:.1f} s, "
+                            f"{record['budget_ratio']:.0%} of its {self.budget} s budget")
+
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        with open(self.json_path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+        temporary_path = f"{self.prometheus_path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write("\n".join(self.to_prometheus(record)) + "\n")
+        os.replace(temporary_path, self.prometheus_path)
+
+        return record
+
+    def to_prometheus(self, record):
+        """ Get the lines of the Prometheus text file of a cycle record"""
+        zones = record['zones']
+        lines = []
+        lines += _format_samples("scrapper_cycle_timestamp_seconds", "gauge",
+                                 "Wall-clock boundary of the last cycle", [({}, record['scheduled'])])
+        lines += _format_samples("scrapper_cycle_duration_seconds", "gauge",
+                                 "Seconds from the boundary of the last cycle to the end of its processing",
+                                 [({}, record['duration'])])
+        lines += _format_samples("scrapper_cycle_budget_seconds", "gauge", "Seconds a cycle has",
+                                 [({}, record['budget'])])
+        lines += _format_samples("scrapper_cycle_budget_ratio", "gauge", "Part of the budget used by the last cycle",
+                                 [({}, record['budget_ratio'])])
+        lines += _format_samples("scrapper_cycle_phase_seconds", "gauge", "Seconds of every phase of the last cycle",
+                                 [({'phase': phase}, record[phase])
+                                  for phase in ('lag', 'fetch_duration', 'queue_wait', 'process_duration')])
+        lines += _format_samples("scrapper_cycle_missed_boundaries", "gauge",
+                                 "Boundaries skipped before the last cycle", [({}, record['missed'])])
+        lines += _format_samples("scrapper_cycles_total", "counter", "Cycles by status since the start",
+                                 [({'status': status}, count) for status, count in self.cycles_by_status.items()])
+
+        fetch = record['fetch']
+        lines += _format_samples("scrapper_fetch_tiles", "gauge", "Tiles of the last cycle by status",
+                                 [({'status': 'fetched'}, fetch.get('tiles')),
+                                  ({'status': 'failed'}, fetch.get('tiles_failed'))])
+        lines += _format_samples("scrapper_fetch_bytes", "gauge", "Bytes of the tiles of the last cycle",
+                                 [({}, fetch.get('bytes'))])
+
+        lines += _format_samples("scrapper_zone_duration_seconds", "gauge", "Seconds of every zone in the last cycle",
+                                 [({'zone': zone_id}, zone.get('elapsed')) for zone_id, zone in zones.items()])
+        lines += _format_samples("scrapper_zone_up", "gauge", "1 if the zone was processed in the last cycle",
+                                 [({'zone': zone_id}, zone.get('error') is None) for zone_id, zone in zones.items()])
+        lines += _format_samples("scrapper_zone_errors_total", "counter", "Failed cycles of every zone",
+                                 [({'zone': zone_id}, count) for zone_id, count in self.zone_errors.items()])
+        lines += _format_samples("scrapper_stage_duration_seconds", "gauge",
+                                 "Seconds of every stage of every zone in the last cycle",
+                                 [({'zone': zone_id, 'stage': stage}, seconds) for zone_id, zone in zones.items()
+                                  for stage, seconds in zone.get('timings', {}).items()])
+        value_names = sorted({name for zone in zones.values() for name in zone.get('values', {})})
+        for name in value_names:
+            # The values that are lists (e.g. the names of the missing tiles) are exported as their length
+            lines += _format_samples(f"scrapper_zone_{name}", "gauge", ZONE_VALUES_HELP.get(name, name),
+                                     [({'zone': zone_id}, len(value) if isinstance(value, list) else value)
+                                      for zone_id, zone in zones.items()
+                                      for value in [zone.get('values', {}).get(name)] if value is not None])
+
+        writer = record['writer']
+        lines += _format_samples("scrapper_mongo_write_seconds", "gauge", "Seconds of the bulk inserts in MongoDB",
+                                 [({'quantity': 'last'}, writer.get('last_write_seconds')),
+                                  ({'quantity': 'max'}, writer.get('max_write_seconds'))])
+        lines += _format_samples("scrapper_mongo_write_seconds_total", "counter",
+                                 "Seconds spent in bulk inserts in MongoDB since the start",
+                                 [({}, writer.get('write_seconds_total'))])
+        lines += _format_samples("scrapper_mongo_writes_total", "counter", "Bulk inserts in MongoDB since the start",
+                                 [({}, writer.get('writes'))])
+        lines += _format_samples("scrapper_mongo_documents_inserted_total", "counter",
+                                 "Snapshots saved in MongoDB since the start", [({}, writer.get('inserted'))])
+        lines += _format_samples("scrapper_mongo_write_failures_total", "counter",
+                                 "Failed bulk inserts in MongoDB since the start", [({}, writer.get('failures'))])
+        lines += _format_samples("scrapper_spool_pending_bytes", "gauge", "Bytes of snapshots waiting in the spool",
+                                 [({}, writer.get('pending_bytes'))])
+        return lines
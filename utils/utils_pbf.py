@@ -1,41 +1,166 @@
-import json
 import logging
-import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import mapbox_vector_tile
 import requests
+from requests.adapters import HTTPAdapter
 
+TOMTOM_FLOW_TILE_URL = ("https://api.tomtom.com/traffic/map/4/tile/flow/relative/"
+                        "{zoom}/{x}/{y}.pbf?key={api_key}")
 
-def extract_tile_pbf_from_url(tomtom_url, current_datetime, dir_path):
-    try:
-        response = requests.get(tomtom_url)
-        # Verify if the request was successful
-        if response.status_code == 200:
-            save_pbf_to_json(response.content, current_datetime, dir_path)
-        else:
-            raise Exception(f"ERROR on request with code: {response.status_code}")
-    except Exception as e:
-        # Save error on Log
-        logging.error(str(e))
 
+class RawTile:
+    """ The raw bytes of a tile, decoded the first time they are needed
 
-def save_pbf_to_json(response, current_datetime, dir_path):
+    Only the raw bytes are pickled, so sending a tile to another process does not send its decoded layers.
+    Args:
+        data: The raw content of the .pbf"""
 
-    os.makedirs(dir_path, exist_ok=True)
-    filename = f"{dir_path}/{current_datetime}.pbf"
-    # Write response to file
-    with open(filename, "wb") as output_file:
-        output_file.write(response)
-        logging.info(f"Saved pbf to {filename}")
-    pbf_to_json(filename)
+    def __init__(self, data):
+        self.data = data
+        self._decoded = None
 
+    def decode(self):
+        """ Get the decoded tile (as returned by mapbox_vector_tile.decode)"""
+        if self._decoded is None:
+            self._decoded = mapbox_vector_tile.decode(self.data)
+        return self._decoded
 
-def pbf_to_json(filename):
-    with open(filename, "rb") as file:
-        data = file.read()
+    def __reduce__(self):
+        return RawTile, (self.data,)
 
-    geojson = mapbox_vector_tile.decode(data)
 
-    with open(filename + ".json", "w") as file:
-        json.dump(geojson, file, indent=4)
-        logging.info(f"Saved pbf to {filename}")
+def decode_tile(tile):
+    """ Get a decoded tile
+    Args:
+        tile: A RawTile, the raw bytes of the tile or an already decoded tile
+    Returns:
+        The decoded tile"""
+    if isinstance(tile, RawTile):
+        return tile.decode()
+    if isinstance(tile, (bytes, bytearray)):
+        return mapbox_vector_tile.decode(tile)
+    return tile
+
+
+class _FetchCycle:
+    """ The tiles of a cycle archived before its deadline
+
+    The tiles are archived and added here holding the lock, and the cycle is closed holding it too, so the archive
+    only gets the tiles of the result of the cycle.
+    Args:
+        datetime_str: The datetime string of the cycle"""
+
+    def __init__(self, datetime_str):
+        self.datetime_str = datetime_str
+        self.lock = threading.Lock()
+        self.closed = False
+        self.tiles = {}
+
+    def close(self):
+        """ Stop accepting tiles
+        Returns:
+            The dictionary with the RawTiles by tile name accepted before"""
+        with self.lock:
+            self.closed = True
+            return dict(self.tiles)
+
+
+class TileFetcher:
+    """ Fetch the tiles of a cycle concurrently through a single keep-alive connection pool
+
+    Every request has its own timeout and the whole cycle has a deadline: the tiles that are not downloaded
+    before the deadline are logged as errors and left out of the result (the requests that end after it are not
+    archived either).
+    Args:
+        api_key: The TomTom API key
+        url_template: The url of a tile, formatted with zoom, x, y and api_key (change it to test against a
+            local server)
+        max_workers: The maximum amount of tiles downloaded at the same time
+        timeout: The (connect, read) timeout of every request, in seconds
+        cycle_deadline: The maximum time to fetch all the tiles of a cycle, in seconds
+        data_dir: The folder of the TileArchive where the raw tiles are archived"""
+
+    def __init__(self, api_key, url_template=TOMTOM_FLOW_TILE_URL, max_workers=8, timeout=(3.05, 10),
+                 cycle_deadline=120, data_dir="data"):
+        from utils.utils_archive import TileArchive
+
+        self.api_key = api_key
+        self.url_template = url_template
+        self.timeout = timeout
+        self.cycle_deadline = cycle_deadline
+        self.data_dir = data_dir
+        self.archive = TileArchive(data_dir)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile-fetcher")
+
+    def tile_url(self, tile):
+        return self.url_template.format(zoom=tile['zoom'], x=tile['x'], y=tile['y'], api_key=self.api_key)
+
+    def fetch_tile(self, tile, current_datetime, cycle=None):
+        """ Download and archive a single tile (it is not decoded here, the zone that translates it decodes it)
+        Args:
+            tile: The tile dictionary (name, zoom, x, y)
+            current_datetime: The datetime string of the cycle
+            cycle: The _FetchCycle of the tile (the tile is not archived if the cycle is already closed)
+        Returns:
+            The RawTile"""
+        response = self.session.get(self.tile_url(tile), timeout=self.timeout)
+        if response.status_code != 200:
+            raise Exception(f"ERROR on request with code: {response.status_code} ({tile['name']})")
+
+        raw_tile = RawTile(response.content)
+        if cycle is None:
+            self.archive.append(tile['name'], current_datetime, response.content)
+            return raw_tile
+
+        with cycle.lock:
+            # A tile that is not part of the processed snapshot would be backfilled as part of it
+            if cycle.closed:
+                raise Exception(f"ERROR: tile {tile['name']} fetched after the cycle deadline, not archived")
+            self.archive.append(tile['name'], current_datetime, response.content)
+            cycle.tiles[tile['name']] = raw_tile
+        return raw_tile
+
+    def fetch_tiles(self, tiles, current_datetime):
+        """ Fetch all the given tiles concurrently
+        Args:
+            tiles: The list of tile dictionaries
+            current_datetime: The datetime string of the cycle
+        Returns:
+            A dictionary with the RawTiles by tile name (failed tiles are not included)"""
+        start_time = time.monotonic()
+        cycle = _FetchCycle(current_datetime)
+        futures = {self.executor.submit(self.fetch_tile, tile, current_datetime, cycle): tile for tile in tiles}
+        done, not_done = wait(futures, timeout=self.cycle_deadline)
+
+        # The running requests can not be cancelled, the tiles they get after this are discarded
+        decoded_tiles = cycle.close()
+        for future in done:
+            if future.exception() is not None:
+                logging.error(str(future.exception()))
+
+        for future in not_done:
+            future.cancel()
+            if futures[future]['name'] not in decoded_tiles:
+                logging.error(f"ERROR: tile {futures[future]['name']} not fetched before the cycle deadline "
+                              f"({self.cycle_deadline} s)")
+
+        logging.info(f"Fetched {len(decoded_tiles)}/{len(futures)} tiles in {time.monotonic() - start_time:.2f} s")
+        return decoded_tiles
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,163 @@
+import cProfile
+import functools
+import linecache
+import logging
+import os
+import signal
+import threading
+import tracemalloc
+from datetime import datetime
+
+# tracemalloc is global to the process, it is started by the first capture and stopped by the last one
+_tracing_lock = threading.Lock()
+_tracing_captures = 0
+
+
+def _start_tracing(traceback_frames):
+    global _tracing_captures
+    with _tracing_lock:
+        if _tracing_captures == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(traceback_frames)
+        _tracing_captures += 1
+
+
+def _stop_tracing():
+    global _tracing_captures
+    with _tracing_lock:
+        _tracing_captures -= 1
+        if _tracing_captures == 0:
+            tracemalloc.stop()
+
+
+def _write_allocations(path, name, before, after, peak, top_allocations):
+    """ Write the lines whose allocated memory grew more during a call (the memory still allocated at the end)"""
+    # The allocations of the capture itself are left out
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    statistics = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    with open(path, "w") as file:
+        file.write(f"{name}: peak of traced memory {peak / 2 ** 20:.2f} MB "
+                   f"(the allocations of other threads during the call are included)\n\n")
+        for statistic in statistics[:top_allocations]:
+            frame = statistic.traceback[0]
+            file.write(f"{statistic.size_diff / 1024:+.1f} KiB ({statistic.count_diff:+d} blocks), "
+                       f"{statistic.size / 1024:.1f} KiB total: {frame.filename}:{frame.lineno}\n")
+            line = linecache.getline(frame.filename, frame.lineno).strip()
+            if line:
+                file.write(f"    {line}\n")
+
+
+def profile_call(function, name, output_dir, args=(), kwargs=None, top_allocations=25, traceback_frames=1):
+    """ Call a function under cProfile and tracemalloc, writing '<name>_<timestamp>.prof' (pstats) and
+    '<name>_<timestamp>.allocations.txt' (the top allocations and the peak memory) in the output folder
+    Args:
+        function: The function to call
+        name: The name of the capture (prefix of the files)
+        output_dir: The folder of the files
+        args: The positional arguments of the call
+        kwargs: The keyword arguments of the call
+        top_allocations: The amount of lines of the allocations file
+        traceback_frames: The frames stored by tracemalloc for every allocation
+    Returns:
+        The result of the function"""
+    timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S_%f")
+    prefix = f"{output_dir}/{name}_{timestamp}"
+
+    _start_tracing(traceback_frames)
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    # cProfile only sees the thread of the call
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return function(*args, **(kwargs or {}))
+    finally:
+        profiler.disable()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _stop_tracing()
+
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            profiler.dump_stats(f"{prefix}.prof")
+            _write_allocations(f"{prefix}.allocations.txt", name, before, after, peak, top_allocations)
+            logging.info(f"Profile of {name} written to {prefix}.prof")
+        except OSError as error:
+            logging.error(f"Error writing the profile of {name}: {error}")
+
+
+class CycleProfiler:
+    """ Opt-in profiling of the next calls of some functions (e.g. the next N cycles of the scrapper)
+
+    The functions are wrapped with 'profile'. While the profiler is not armed a wrapped call only checks a counter, so
+    it costs nothing measurable. 'arm' (or the signal installed with 'install_signal') profiles the next calls of
+    every wrapped function with profile_call.
+    Args:
+        output_dir: The folder of the profiles
+        top_allocations: The amount of lines of the allocations files
+        traceback_frames: The frames stored by tracemalloc for every allocation"""
+
+    def __init__(self, output_dir=".", top_allocations=25, traceback_frames=1):
+        self.output_dir = output_dir
+        self.top_allocations = top_allocations
+        self.traceback_frames = traceback_frames
+        self.names = set()
+        self.remaining = {}
+        # Reentrant, the signal handler runs in the main thread, that may be holding it
+        self.lock = threading.RLock()
+
+    def register(self, name):
+        """ Add a name armed with the rest (for the calls profiled with take and profile_call)"""
+        self.names.add(name)
+
+    def arm(self, calls=1, names=None):
+        """ Profile the next calls of the wrapped functions
+        Args:
+            calls: The amount of calls of every function
+            names: The names of the functions to profile (all the wrapped ones if None)"""
+        with self.lock:
+            for name in (names if names is not None else self.names):
+                self.remaining[name] = self.remaining.get(name, 0) + calls
+        logging.info(f"Profiling the next {calls} calls of {', '.join(sorted(names or self.names))}")
+
+    def take(self, name):
+        """ Check if the next call of a function has to be profiled (it is counted as profiled)
+        Args:
+            name: The name of the function
+        Returns:
+            A boolean"""
+        if not self.remaining.get(name):
+            return False
+        with self.lock:
+            if self.remaining.get(name, 0) <= 0:
+                return False
+            self.remaining[name] -= 1
+            return True
+
+    def call(self, name, function, *args, **kwargs):
+        """ Call a function, profiling it with the name if it is armed"""
+        if not self.take(name):
+            return function(*args, **kwargs)
+        return profile_call(function, name, self.output_dir, args=args, kwargs=kwargs,
+                            top_allocations=self.top_allocations, traceback_frames=self.traceback_frames)
+
+    def profile(self, name):
+        """ Decorator that profiles the function when the profiler is armed
+        Args:
+            name: The name of the function in the profiler (prefix of its files)"""
+        self.register(name)
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self.call(name, function, *args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def install_signal(self, signum=signal.SIGUSR1, calls=1):
+        """ Arm the profiler when the process gets a signal (e.g. 'kill -USR1 <pid>'), must be called from the main
+        thread
+        Args:
+            signum: The signal
+            calls: The amount of calls of every function profiled after every signal"""
+        signal.signal(signum, lambda received_signum, frame: self.arm(calls))
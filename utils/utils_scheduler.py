@@ -0,0 +1,218 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+OVERRUN_POLICIES = ('skip', 'coalesce', 'queue')
+
+
+class CycleRecord:
+    """ Scheduling information of a cycle (the times are seconds since the epoch)
+    Args:
+        datetime_str: The datetime string of the cycle (its scheduled boundary)
+        scheduled: The boundary the cycle was scheduled for
+        fired: When the cycle started
+        missed: The amount of boundaries skipped before this one (the previous cycle fired too late)"""
+
+    def __init__(self, datetime_str, scheduled, fired, missed=0):
+        self.datetime_str = datetime_str
+        self.scheduled = scheduled
+        self.fired = fired
+        self.missed = missed
+        self.fetched = None
+        self.process_started = None
+        self.process_finished = None
+        self.status = 'fetching'  # fetching, pending, processing, done, failed, skipped, coalesced or dropped
+        self.error = None
+
+    @property
+    def lag(self):
+        """ Seconds between the boundary and the start of the cycle"""
+        return self.fired - self.scheduled
+
+    @property
+    def fetch_duration(self):
+        return None if self.fetched is None else self.fetched - self.fired
+
+    @property
+    def queue_wait(self):
+        """ Seconds the fetched data waited for the processing of the previous cycle"""
+        return None if self.process_started is None else self.process_started - self.fetched
+
+    @property
+    def process_duration(self):
+        if self.process_started is None or self.process_finished is None:
+            return None
+        return self.process_finished - self.process_started
+
+    def to_dict(self):
+        return {
+            'datetime_str': self.datetime_str,
+            'scheduled': self.scheduled,
+            'fired': self.fired,
+            'missed': self.missed,
+            'lag': self.lag,
+            'fetch_duration': self.fetch_duration,
+            'queue_wait': self.queue_wait,
+            'process_duration': self.process_duration,
+            'status': self.status,
+            'error': self.error
+        }
+
+
+class CycleScheduler:
+    """ Run a cycle on every wall-clock boundary of the period (e.g. :00, :15, :30 and :45), fetching the data of a
+    cycle while the previous one is still being processed
+
+    The fetch runs in the thread of the scheduler and the processing in a background thread. When a cycle is fetched
+    while the previous one is still processing, the overrun policy decides what happens with it:
+        'skip': the new cycle is not processed
+        'coalesce': only the newest waiting cycle is processed (the older waiting ones are discarded)
+        'queue': the cycles wait in order (at most max_queue, the oldest ones are dropped)
+    If the fetch itself ends after the next boundary, the boundaries already passed are skipped (and counted in the
+    'missed' of the next cycle).
+    Args:
+        fetch: Function (datetime_str) -> data, the I/O of the cycle
+        process: Function (datetime_str, data) -> None, the processing and persistence of the cycle
+        period: The seconds between cycles
+        offset: The seconds after every boundary the cycles start
+        overrun_policy: 'skip', 'coalesce' or 'queue'
+        max_queue: The maximum waiting cycles of the 'queue' policy
+        max_records: The amount of cycle records kept
+        on_record: Function (CycleRecord) called when a cycle ends (processed, failed or discarded)
+        clock: The function that returns the current time in seconds since the epoch"""
+
+    def __init__(self, fetch, process, period=900, offset=0, overrun_policy='coalesce', max_queue=4,
+                 max_records=96, on_record=None, clock=time.time):
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Invalid overrun policy. Choose one of {OVERRUN_POLICIES}.")
+        self.fetch = fetch
+        self.process = process
+        self.period = period
+        self.offset = offset
+        self.overrun_policy = overrun_policy
+        self.max_queue = max_queue
+        self.on_record = on_record
+        self.clock = clock
+
+        self.records = deque(maxlen=max_records)
+        self.stop_event = threading.Event()
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.busy = False
+        self.processor = None
+
+    def next_boundary(self, now):
+        """ Get the first boundary at or after the given time"""
+        return math.ceil((now - self.offset) / self.period) * self.period + self.offset
+
+    def _finish(self, record, status, error=None):
+        record.status = status
+        record.error = error
+        self.records.append(record)
+        if status == 'done':
+            logging.info(f"Cycle {record.datetime_str}: lag {record.lag:.2f} s, fetch {record.fetch_duration:.2f} s, "
+                         f"wait {record.queue_wait:.2f} s, process {record.process_duration:.2f} s")
+        else:
+            logging.warning(f"Cycle {record.datetime_str} {status} (lag {record.lag:.2f} s)"
+                            f"{': ' + error if error else ''}")
+        if self.on_record is not None:
+            try:
+                self.on_record(record)
+            except Exception as exception:
+                logging.error(f"Error recording the cycle {record.datetime_str}: {exception}")
+
+    def _dispatch(self, record, data):
+        """ Hand a fetched cycle to the processing thread, applying the overrun policy"""
+        with self.condition:
+            overrun = self.busy or bool(self.pending)
+            if overrun and self.overrun_policy == 'skip':
+                discarded, status = [(record, data)], 'skipped'
+            elif overrun and self.overrun_policy == 'coalesce':
+                discarded, status = list(self.pending), 'coalesced'
+                self.pending.clear()
+                record.status = 'pending'
+                self.pending.append((record, data))
+            else:
+                discarded, status = [], 'dropped'
+                record.status = 'pending'
+                self.pending.append((record, data))
+                while len(self.pending) > self.max_queue:
+                    discarded.append(self.pending.popleft())
+            self.condition.notify_all()
+
+        for discarded_record, _ in discarded:
+            self._finish(discarded_record, status, f"overrun ({self.overrun_policy} policy)")
+
+    def _run_processor(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stop_event.is_set():
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                record, data = self.pending.popleft()
+                self.busy = True
+
+            record.status = 'processing'
+            record.process_started = self.clock()
+            try:
+                self.process(record.datetime_str, data)
+                record.process_finished = self.clock()
+                self._finish(record, 'done')
+            except Exception as exception:
+                record.process_finished = self.clock()
+                logging.exception(f"Error processing the cycle {record.datetime_str}")
+                self._finish(record, 'failed', repr(exception))
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def run(self, max_cycles=None):
+        """ Run the cycles until stop is called (or max_cycles cycles are fired), the first one on the next boundary
+        Args:
+            max_cycles: The maximum amount of cycles (no limit if None)"""
+        self.stop_event.clear()
+        self.processor = threading.Thread(target=self._run_processor, name="cycle-processor", daemon=True)
+        self.processor.start()
+
+        boundary = self.next_boundary(self.clock())
+        cycles = 0
+        try:
+            while not self.stop_event.is_set() and (max_cycles is None or cycles < max_cycles):
+                if self.stop_event.wait(timeout=max(0.0, boundary - self.clock())):
+                    break
+
+                now = self.clock()
+                missed = max(0, int((now - boundary) // self.period))
+                boundary += missed * self.period
+
+                datetime_str = datetime.fromtimestamp(boundary).strftime("%Y_%m_%d_%H_%M_%S")
+                record = CycleRecord(datetime_str, boundary, now, missed=missed)
+                cycles += 1
+                boundary += self.period
+
+                try:
+                    data = self.fetch(datetime_str)
+                except Exception as exception:
+                    record.fetched = self.clock()
+                    logging.exception(f"Error fetching the cycle {datetime_str}")
+                    self._finish(record, 'failed', repr(exception))
+                    continue
+                record.fetched = self.clock()
+                self._dispatch(record, data)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=None):
+        """ Stop firing cycles, letting the processing thread finish the waiting ones
+        Args:
+            timeout: The maximum seconds to wait for the processing thread (no limit if None)"""
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify_all()
+        if self.processor is not None and self.processor is not threading.current_thread():
+            self.processor.join(timeout=timeout)
@@ -0,0 +1,129 @@
+import numpy as np
+
+from utils.utils_geojson import create_linestring_geojson
+
+SEGMENT_DTYPE = np.dtype([
+    ('x0', 'f8'), ('y0', 'f8'),  # First point (longitude, latitude)
+    ('x1', 'f8'), ('y1', 'f8'),  # Second point (longitude, latitude)
+    ('feature', 'i4'),  # Index of the properties of the original feature
+    ('feature_id', 'i4'),  # Position of the segment in its tile
+])
+
+
+class SegmentTable:
+    """ Compact table with the segments (pairs of consecutive points) of the translated tiles
+
+    The properties are stored once per original feature and referenced by index from the segments.
+    Args:
+        segments: Structured array with SEGMENT_DTYPE
+        properties: List with the properties of the original features"""
+
+    def __init__(self, segments=None, properties=None):
+        self.segments = segments if segments is not None else np.empty(0, dtype=SEGMENT_DTYPE)
+        self.properties = properties if properties is not None else []
+
+    def __len__(self):
+        return len(self.segments)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """ Mix several tables into a single one
+        Args:
+            tables: The tables to mix
+        Returns:
+            A new SegmentTable"""
+        segments, properties = [], []
+        for table in tables:
+            table_segments = table.segments.copy()
+            table_segments['feature'] += len(properties)
+            segments.append(table_segments)
+            properties.extend(table.properties)
+        if not segments:
+            return cls()
+        return cls(np.concatenate(segments), properties)
+
+    def coordinates(self):
+        """ Get the coordinates of the segments as a list of [[x0, y0], [x1, y1]]"""
+        return [[[x0, y0], [x1, y1]] for x0, y0, x1, y1 in zip(self.segments['x0'].tolist(),
+                                                                 self.segments['y0'].tolist(),
+                                                                 self.segments['x1'].tolist(),
+                                                                 self.segments['y1'].tolist())]
+
+    def traffic_levels(self):
+        """ Get the traffic level of every segment"""
+        return [self.properties[feature]['traffic_level'] for feature in self.segments['feature'].tolist()]
+
+    def to_features(self, indices=None, **extra_properties):
+        """ Build the GeoJSON features of the given segments
+        Args:
+            indices: The positions of the segments (all of them if None)
+            extra_properties: Lists with extra properties, aligned with the indices
+        Returns:
+            A list of GeoJSON features"""
+        if indices is None:
+            indices = range(len(self.segments))
+        segments = self.segments[np.asarray(indices, dtype=int)]
+        features = []
+        for position, (x0, y0, x1, y1, feature, feature_id) in enumerate(segments.tolist()):
+            feature_properties = {**self.properties[feature], "feature_id": feature_id}
+            for name, values in extra_properties.items():
+                feature_properties[name] = values[position]
+            features.append(create_linestring_geojson([[x0, y0], [x1, y1]], feature_properties))
+        return features
+
+    def to_geojson(self):
+        """ Build the GeoJSON FeatureCollection of the table"""
+        return {
+            "type": "FeatureCollection",
+            "features": self.to_features()}
+
+
+def split_segments(coordinates, parts):
+    """ Split every segment in parts of the same length, all of them at once
+    The points are the same 'split_line_with_two_points_in_parts' gets with shapely: the distances of the inner points
+    are accumulated step by step, and a point is added while it is before the end of the segment.
+    Args:
+        coordinates: Array (n, 2, 2) with the two points of every segment
+        parts: Array (n,) with the amount of parts of every segment
+    Returns:
+        An array with the index of the original segment of every part and an array (m, 2, 2) with the two points of
+        every part, the parts of a segment are consecutive and in order"""
+    coordinates = np.asarray(coordinates, dtype=float)
+    parts = np.asarray(parts, dtype=int)
+    amount_segments = len(coordinates)
+    if amount_segments == 0:
+        return np.empty(0, dtype=int), np.empty((0, 2, 2))
+
+    start, end = coordinates[:, 0, :], coordinates[:, 1, :]
+    delta = end - start
+    length = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+    step = length / parts
+
+    # Distances of the inner points (NaN once the end of the segment is reached)
+    max_parts = int(parts.max())
+    distances = np.full((amount_segments, max_parts + 1), np.nan)
+    current_step = np.zeros(amount_segments)
+    for i in range(max_parts + 1):
+        current_step = current_step + step
+        distances[:, i] = np.where(current_step < length, current_step, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = distances / length[:, None]
+
+    # Points of every segment: start, inner points and end
+    points = np.full((amount_segments, max_parts + 3, 2), np.nan)
+    points[:, 0, :] = start
+    points[:, 1:max_parts + 2, :] = start[:, None, :] + fraction[:, :, None] * delta[:, None, :]
+    amount_inner = np.count_nonzero(~np.isnan(distances), axis=1)
+    points[np.arange(amount_segments), amount_inner + 1, :] = end
+
+    valid = ~np.isnan(points[:, :, 0])
+    flat_points = points[valid]
+    flat_segment = np.repeat(np.arange(amount_segments), amount_inner + 2)
+
+    # Every point but the last one of its segment starts a part
+    is_start = np.ones(len(flat_points), dtype=bool)
+    is_start[np.cumsum(amount_inner + 2) - 1] = False
+    starts = np.flatnonzero(is_start)
+
+    return flat_segment[starts], np.stack((flat_points[starts], flat_points[starts + 1]), axis=1)
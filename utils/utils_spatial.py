@@ -0,0 +1,80 @@
+import numpy as np
+import osmnx as ox
+import pyproj
+import shapely
+
+from utils.utils_edge_table import EdgeTable
+
+
+class EdgeSpatialIndex:
+    """ Spatial index of the edges of a graph in a projected (metric) CRS, built once and reused between snapshots
+
+    The queries are given in the CRS of the graph (longitude, latitude) and the distances are returned in metres.
+    When several edges are at the same distance (e.g. both ways of a street) the first one in graph.edges is returned.
+    Args:
+        graph: The unprojected graph of the zone
+        to_crs: The projected CRS to use (the UTM zone of the graph if None)
+        edge_table: The EdgeTable of the graph (built here if None)"""
+
+    def __init__(self, graph, to_crs=None, edge_table=None):
+        self.edge_table = edge_table if edge_table is not None else EdgeTable(graph)
+        self.edges = self.edge_table.edges
+
+        graph_projected = ox.projection.project_graph(graph, to_crs=to_crs)
+        geometries = ox.convert.graph_to_gdfs(graph_projected, nodes=False)["geometry"]
+
+        # The tree positions are the positions of the edge table
+        self._build(geometries.loc[self.edges].to_numpy(), graph.graph["crs"], graph_projected.graph["crs"])
+
+    def _build(self, geometries, graph_crs, crs):
+        self.geometries = geometries
+        self.crs = crs
+        self.tree = shapely.STRtree(geometries)
+        self.transformer = pyproj.Transformer.from_crs(graph_crs, crs, always_xy=True)
+
+    @classmethod
+    def from_geometries(cls, edge_table, geometries, graph_crs, crs):
+        """ Build the index of already projected geometries (e.g. the ones of a compiled zone)
+        Args:
+            edge_table: The EdgeTable of the graph
+            geometries: The projected geometries of the edges, in the order of the edge table
+            graph_crs: The CRS of the graph
+            crs: The projected CRS of the geometries
+        Returns:
+            The EdgeSpatialIndex"""
+        index = cls.__new__(cls)
+        index.edge_table = edge_table
+        index.edges = edge_table.edges
+        index._build(geometries, graph_crs, crs)
+        return index
+
+    def nearest_positions(self, lon, lat):
+        """ Get the position (in the edge table) of the nearest edge of every point
+        Args:
+            lon: The longitudes of the points
+            lat: The latitudes of the points
+        Returns:
+            An array with the position of the nearest edge of every point and an array with the distances in metres"""
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        if lon.size == 0:
+            return np.empty(0, dtype=int), np.empty(0)
+
+        x, y = self.transformer.transform(lon, lat)
+        positions, distances = self.tree.query_nearest(shapely.points(x, y), all_matches=True, return_distance=True)
+
+        # Keep the first edge (in graph order) of the ties of every point
+        order = np.lexsort((positions[1], positions[0]))
+        first = order[np.r_[True, positions[0][order][1:] != positions[0][order][:-1]]]
+
+        return positions[1][first], distances[first]
+
+    def nearest_edges(self, lon, lat):
+        """ Get the nearest edge of every point
+        Args:
+            lon: The longitudes of the points
+            lat: The latitudes of the points
+        Returns:
+            A list with the nearest edge (u, v, key) of every point and an array with the distances in metres"""
+        positions, distances = self.nearest_positions(lon, lat)
+        return [self.edges[position] for position in positions.tolist()], distances
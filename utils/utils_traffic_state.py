@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class TrafficState:
+    """ Traffic level of the edges of a zone in a snapshot, kept apart from the static graph
+
+    The state is a pair of contiguous arrays indexed by the dense id of the edges (their position in graph.edges, the
+    one of the EdgeTable and the TrafficInterpolator), so a cycle only refills them in place instead of allocating the
+    info of every edge. Reusing the state of a zone (reset) keeps the memory of the cycles constant, and keeps the
+    traffic level of the previous snapshot (previous_traffic_level) to warm start the interpolation.
+    Args:
+        edges: The list of edges (u, v, key) of the graph, in the order of graph.edges
+        index: The dictionary (u, v, key) -> position (built here if None)"""
+
+    def __init__(self, edges, index=None):
+        self.edges = edges
+        self.index = index if index is not None else {edge: position for position, edge in enumerate(edges)}
+        self.traffic_level = np.full(len(edges), np.nan)
+        self.previous_traffic_level = np.full(len(edges), np.nan)
+        self.api_data = np.zeros(len(edges), dtype=bool)
+        self.filename = None
+
+    @classmethod
+    def from_edge_table(cls, edge_table):
+        """ Build the state of the edges of an EdgeTable (sharing its edges and its index)"""
+        return cls(edge_table.edges, index=edge_table.index)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def reset(self, filename):
+        """ Start the state of a new snapshot: every edge without traffic level nor API data (the traffic level of the
+        current one becomes the previous one)
+        Args:
+            filename: The filename of the date of the snapshot"""
+        # The arrays are swapped, so the previous traffic level is kept without a copy
+        self.traffic_level, self.previous_traffic_level = self.previous_traffic_level, self.traffic_level
+        self.traffic_level.fill(np.nan)
+        self.api_data.fill(False)
+        self.filename = filename
+
+    def position(self, edge_id):
+        """ Get the dense id of an edge (u, v, key)"""
+        return self.index[tuple(edge_id)]
+
+    def get(self, edge_id):
+        """ Get the info of an edge as the 'most_recent' dictionary of the old graphs
+        Args:
+            edge_id: The edge (u, v, key)
+        Returns:
+            A dictionary with the traffic_level (None if unknown), the api_data and the date"""
+        position = self.position(edge_id)
+        traffic_level = self.traffic_level[position]
+        return {'traffic_level': None if np.isnan(traffic_level) else float(traffic_level),
+                'api_data': bool(self.api_data[position]), 'date': self.filename}
+
+    def set(self, edge_id, traffic_level, api_data=True):
+        """ Set the traffic level of an edge
+        Args:
+            edge_id: The edge (u, v, key)
+            traffic_level: The traffic level (None if unknown)
+            api_data: A boolean to indicate if the traffic level comes from the API"""
+        position = self.position(edge_id)
+        self.traffic_level[position] = np.nan if traffic_level is None else traffic_level
+        self.api_data[position] = api_data
+
+    def set_matches(self, matches):
+        """ Set the traffic level of the API edges
+        Args:
+            matches: An iterable of tuples (traffic level, edge id, extra edges ids), later ones overwrite earlier ones
+        Returns:
+            The amount of edges set"""
+        positions, traffic_levels = [], []
+        for traffic_level, edge_id, extra_edges_ids in matches:
+            for matched_edge_id in (edge_id, *extra_edges_ids):
+                positions.append(self.index[tuple(matched_edge_id)])
+                traffic_levels.append(np.nan if traffic_level is None else traffic_level)
+        if not positions:
+            return 0
+
+        # The order of repeated positions in a fancy assignment is not guaranteed, so only the last one is kept
+        positions = np.array(positions, dtype=int)
+        last = len(positions) - 1 - np.unique(positions[::-1], return_index=True)[1]
+        self.traffic_level[positions[last]] = np.array(traffic_levels, dtype=float)[last]
+        self.api_data[positions[last]] = True
+        return len(last)
+
+    def copy(self):
+        """ Get an independent copy of the state (sharing the edges and the index)"""
+        state = TrafficState(self.edges, index=self.index)
+        state.traffic_level[:] = self.traffic_level
+        state.previous_traffic_level[:] = self.previous_traffic_level
+        state.api_data[:] = self.api_data
+        state.filename = self.filename
+        return state
+
+    def to_graph(self, graph):
+        """ Write the state in the 'most_recent' info of the edges of the graph (the format of the old Graph
+        documents)
+        Args:
+            graph: The graph of the edges
+        Returns:
+            The graph"""
+        for edge_id, traffic_level, api_data in zip(self.edges, self.traffic_level.tolist(), self.api_data.tolist()):
+            graph.edges[edge_id]['most_recent'] = {'traffic_level': None if traffic_level != traffic_level
+                                                   else traffic_level, 'api_data': api_data, 'date': self.filename}
+        return graph
@@ -1,33 +1,25 @@
-def handle_jimenez_fraud(graph, node_1_id, node_2_id, filename, info):
-    nearest_edge = graph.edges[node_1_id, node_2_id, 0]
+# Edges of Jimenez Fraud Way that TomTom maps in the opposite direction:
+# (node_1_id, node_2_id) of the nearest edge -> (edge that gets the traffic level, extra edges that also get it)
+JIMENEZ_FRAUD_EDGES = {
+    (2094195157, 2094195159): ((418336300, 418336304, 0),
+                               ((418336304, 418336308, 0),)),
+    (2094195165, 3152120576): ((418336289, 4943984606, 0),
+                               ((4943984604, 3152120577, 0), (3152120577, 418336292, 0))),
+    (2094195153, 2094195155): ((418336308, 2094195150, 0),
+                               ()),
+    (2614757891, 2094195161): ((250962361, 2614757893, 0),
+                               ((2614757893, 5625095808, 0), (5625095808, 418336300, 0))),
+    (2094195161, 2874546302): ((2874546303, 250962361, 0),
+                               ()),
+}
+
+
+def get_jimenez_fraud_edges(node_1_id, node_2_id):
+    """ Get the edges that should get the traffic level of an API edge matched to Jimenez Fraud Way
+    Args:
+        node_1_id: The first node of the nearest edge
+        node_2_id: The second node of the nearest edge
+    Returns:
+        The id of the edge that gets the traffic level and a tuple with the ids of the extra edges"""
+    return JIMENEZ_FRAUD_EDGES.get((node_1_id, node_2_id), ((node_1_id, node_2_id, 0), ()))
 
-    if node_1_id == 2094195157 and node_2_id == 2094195159:
-        nearest_edge = graph.edges[418336300, 418336304, 0]
-        extra_edge_info = graph.edges[418336304, 418336308, 0]
-        extra_edge_info["dates"][filename] = info
-
-    if node_1_id == 2094195165 and node_2_id == 3152120576:
-        nearest_edge = graph.edges[418336289, 4943984606, 0]
-
-        extra_edge_info = graph.edges[4943984604, 3152120577, 0]
-        extra_edge_info["dates"][filename] = info
-
-        extra_edge_info = graph.edges[3152120577, 418336292, 0]
-        extra_edge_info["dates"][filename] = info
-
-    if node_1_id == 2094195153 and node_2_id == 2094195155:
-        nearest_edge = graph.edges[418336308, 2094195150, 0]
-
-    if node_1_id == 2614757891 and node_2_id == 2094195161:
-        nearest_edge = graph.edges[250962361, 2614757893, 0]
-
-        extra_edge_info = graph.edges[2614757893, 5625095808, 0]
-        extra_edge_info["dates"][filename] = info
-
-        extra_edge_info = graph.edges[5625095808, 418336300, 0]
-        extra_edge_info["dates"][filename] = info
-
-    if node_1_id == 2094195161 and node_2_id == 2874546302:
-        nearest_edge = graph.edges[2874546303, 250962361, 0]
-
-    return nearest_edge
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import pickle
+
+import osmnx as ox
+
+from utils.utils import get_neighbours_edges_dictionary
+from utils.utils_edge_table import EdgeTable
+from utils.utils_interpolation import TrafficInterpolator
+from utils.utils_match_cache import MatchCache, get_graph_signature
+from utils.utils_spatial import EdgeSpatialIndex
+from utils.utils_traffic_state import TrafficState
+from utils.utils_zone_cache import ensure_compiled_zone, get_file_hash, load_compiled_zone
+
+
+def load_neighbours_dictionary(graph, graphml_path, cache_path=None):
+    """ Get the neighbours edges dictionary of a zone, reusing the cached one if the GraphML has not changed
+    Args:
+        graph: The graph of the zone
+        graphml_path: The GraphML file the graph was loaded from
+        cache_path: The file where the dictionary is cached (disabled if None)
+    Returns:
+        The neighbours edges dictionary"""
+    if cache_path is None:
+        return get_neighbours_edges_dictionary(graph)
+
+    graphml_hash = get_file_hash(graphml_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as file:
+            cached = pickle.load(file)
+        if cached.get('graphml_hash') == graphml_hash:
+            return cached['neighbours']
+        logging.info(f"{graphml_path} has changed, rebuilding the neighbours edges dictionary")
+
+    neighbours_dictionary = get_neighbours_edges_dictionary(graph)
+    with open(cache_path, "wb") as file:
+        pickle.dump({'graphml_hash': graphml_hash, 'neighbours': neighbours_dictionary}, file)
+
+    return neighbours_dictionary
+
+
+def load_zone(zone_id, zones_dir="zonas", cache_neighbours=False, compiled_cache=False):
+    """ Load a zone: its graph, its tiles, the neighbours edges dictionary, the compiled interpolator, the table with
+    the static attributes of the edges, the projected spatial index of the edges, an empty match cache and the traffic
+    state of the snapshots
+    Args:
+        zone_id: The name of the zone (folder inside zones_dir)
+        zones_dir: The folder with the zones
+        cache_neighbours: A boolean to indicate if the neighbours dictionary should be cached next to the GraphML
+        compiled_cache: A boolean to indicate if the zone should be loaded from its compiled cache (compiled first if
+            it does not exist or the GraphML or the tiles JSON have changed)
+    Returns:
+        The zone dictionary (graph, tiles, neightbours, interpolator, edge_table, edge_index, graph_signature,
+        match_cache and traffic_state)"""
+    if compiled_cache:
+        zone = load_compiled_zone(zone_id, zones_dir=zones_dir)
+        if zone is None:
+            ensure_compiled_zone(zone_id, zones_dir=zones_dir)
+            zone = load_compiled_zone(zone_id, zones_dir=zones_dir)
+        return zone
+
+    graphml_path = f"{zones_dir}/{zone_id}/{zone_id}.graphml"
+    graph = ox.load_graphml(graphml_path)
+
+    with open(f"{zones_dir}/{zone_id}/{zone_id}_tiles.json", encoding='utf8', mode='r') as file:
+        tiles = json.load(file)['tiles']
+
+    cache_path = f"{zones_dir}/{zone_id}/{zone_id}_neighbours.pickle" if cache_neighbours else None
+    neighbours_dictionary = load_neighbours_dictionary(graph, graphml_path, cache_path=cache_path)
+
+    edge_table = EdgeTable(graph)
+
+    return {
+        'graph': graph,
+        'tiles': tiles,
+        'neightbours': neighbours_dictionary,
+        'interpolator': TrafficInterpolator(graph, neighbours_dictionary),
+        'edge_table': edge_table,
+        'edge_index': EdgeSpatialIndex(graph, edge_table=edge_table),
+        'graph_signature': get_graph_signature(graph),
+        'match_cache': MatchCache(),
+        'traffic_state': TrafficState.from_edge_table(edge_table)
+    }
@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import osmnx as ox
+import pyproj
+import scipy.sparse
+import shapely
+
+from utils.utils import get_neighbours_edges_dictionary
+from utils.utils_edge_table import EdgeTable
+from utils.utils_interpolation import TrafficInterpolator
+from utils.utils_match_cache import MatchCache, get_graph_signature
+from utils.utils_spatial import EdgeSpatialIndex
+from utils.utils_traffic_state import TrafficState
+
+# Change it when the content of the compiled zones changes
+COMPILED_ZONE_VERSION = 1
+
+# Arrays of a compiled zone, saved as .npy files and loaded memory-mapped
+COMPILED_ZONE_ARRAYS = ('edge_u', 'edge_v', 'edge_key', 'bearing', 'oneway', 'reversed', 'junction', 'maxspeed',
+                        'length', 'neighbours_indptr', 'neighbours_indices', 'geometry_coordinates',
+                        'geometry_parts')
+
+
+def get_file_hash(filename):
+    """ Get the SHA-256 hash of the content of a file
+    Args:
+        filename: The file to hash
+    Returns:
+        The hexadecimal digest of the file"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_compiled_zone_dir(zone_id, zones_dir="zonas"):
+    return f"{zones_dir}/{zone_id}/{zone_id}_compiled"
+
+
+def _get_source_hashes(zone_id, zones_dir):
+    return {
+        'graphml_hash': get_file_hash(f"{zones_dir}/{zone_id}/{zone_id}.graphml"),
+        'tiles_hash': get_file_hash(f"{zones_dir}/{zone_id}/{zone_id}_tiles.json")
+    }
+
+
+def compile_zone(zone_id, zones_dir="zonas"):
+    """ Compile a zone into '<zone>_compiled': the arrays of the edges (ids, bearings, flags, maxspeed and length),
+    the neighbours index and the projected geometries of the spatial index as .npy files, the graph as a pickle and a
+    manifest with the hashes of the GraphML and the tiles JSON it was compiled from (use ensure_compiled_zone when
+    other processes may compile the zone at the same time)
+    Args:
+        zone_id: The name of the zone (folder inside zones_dir)
+        zones_dir: The folder with the zones
+    Returns:
+        The folder of the compiled zone"""
+    graph = ox.load_graphml(f"{zones_dir}/{zone_id}/{zone_id}.graphml")
+    with open(f"{zones_dir}/{zone_id}/{zone_id}_tiles.json", encoding='utf8', mode='r') as file:
+        tiles = json.load(file)['tiles']
+
+    neighbours_dictionary = get_neighbours_edges_dictionary(graph)
+    edge_table = EdgeTable(graph)
+    edge_index = EdgeSpatialIndex(graph, edge_table=edge_table)
+
+    # Neighbours of every edge as positions of the edge table (the edge with key 0, as read by the interpolation)
+    neighbours = [[edge_table.index[(a, b, 0)] for a, b in neighbours_dictionary[(u, v)]]
+                  for u, v, key in edge_table.edges]
+
+    coordinates, parts = shapely.get_coordinates(edge_index.geometries, return_index=True)
+
+    arrays = {
+        'edge_u': np.array([u for u, v, key in edge_table.edges], dtype=np.int64),
+        'edge_v': np.array([v for u, v, key in edge_table.edges], dtype=np.int64),
+        'edge_key': np.array([key for u, v, key in edge_table.edges], dtype=np.int64),
+        'bearing': edge_table.bearing,
+        'oneway': edge_table.oneway,
+        'reversed': edge_table.reversed,
+        'junction': np.array(['' if x is None else str(x) for x in edge_table.junction]),
+        'maxspeed': edge_table.maxspeed,
+        'length': edge_table.length,
+        'neighbours_indptr': np.cumsum([0] + [len(x) for x in neighbours]).astype(np.int64),
+        'neighbours_indices': np.array([p for x in neighbours for p in x], dtype=np.int64),
+        'geometry_coordinates': coordinates,
+        'geometry_parts': parts.astype(np.int64)
+    }
+
+    manifest = {
+        'version': COMPILED_ZONE_VERSION,
+        **_get_source_hashes(zone_id, zones_dir),
+        'graph_signature': get_graph_signature(graph),
+        'graph_crs': pyproj.CRS(graph.graph['crs']).to_wkt(),
+        'crs': pyproj.CRS(edge_index.crs).to_wkt(),
+        'tiles': tiles
+    }
+
+    # Written next to the old one (in a folder of its own) and swapped at the end, so a failed compilation does not
+    # leave a broken zone
+    compiled_dir = get_compiled_zone_dir(zone_id, zones_dir)
+    temporary_dir = tempfile.mkdtemp(prefix=f"{zone_id}_compiled.", dir=f"{zones_dir}/{zone_id}")
+    try:
+        os.chmod(temporary_dir, 0o755)
+        for name, array in arrays.items():
+            np.save(f"{temporary_dir}/{name}.npy", array, allow_pickle=False)
+        # The attributes of the graph are not arrays, so the graph and the static links are pickled
+        with open(f"{temporary_dir}/graph.pickle", "wb") as file:
+            pickle.dump({'graph': graph, 'static_links': edge_table.static_links}, file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        with open(f"{temporary_dir}/manifest.json", "w") as file:
+            json.dump(manifest, file)
+
+        shutil.rmtree(compiled_dir, ignore_errors=True)
+        os.replace(temporary_dir, compiled_dir)
+    except BaseException:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        raise
+    logging.info(f"Zone {zone_id} compiled into {compiled_dir}")
+
+    return compiled_dir
+
+
+def _get_compiled_manifest(zone_id, zones_dir):
+    """ Get the manifest of a compiled zone (None if the zone is not compiled or it is stale)"""
+    compiled_dir = get_compiled_zone_dir(zone_id, zones_dir)
+    try:
+        with open(f"{compiled_dir}/manifest.json") as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return None
+    if manifest.get('version') != COMPILED_ZONE_VERSION:
+        return None
+    source_hashes = _get_source_hashes(zone_id, zones_dir)
+    if any(manifest.get(key) != value for key, value in source_hashes.items()):
+        logging.info(f"The compiled zone {zone_id} is stale")
+        return None
+    return manifest
+
+
+def ensure_compiled_zone(zone_id, zones_dir="zonas"):
+    """ Compile a zone if it is not compiled or it is stale. The check and the compilation hold a lock file
+    ('<zone>_compiled.lock'), so when several processes need the zone at once only one compiles it and the rest wait
+    for it and reuse it
+    Args:
+        zone_id: The name of the zone (folder inside zones_dir)
+        zones_dir: The folder with the zones
+    Returns:
+        A boolean indicating if the zone was compiled"""
+    if _get_compiled_manifest(zone_id, zones_dir) is not None:
+        return False
+
+    # The lock is released when the file is closed (also if the process dies)
+    with open(f"{get_compiled_zone_dir(zone_id, zones_dir)}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Compiled by another process while waiting for the lock
+        if _get_compiled_manifest(zone_id, zones_dir) is not None:
+            return False
+        compile_zone(zone_id, zones_dir=zones_dir)
+        return True
+
+
+def load_compiled_zone(zone_id, zones_dir="zonas"):
+    """ Load a compiled zone, if it is up to date with its GraphML and tiles JSON
+    Args:
+        zone_id: The name of the zone (folder inside zones_dir)
+        zones_dir: The folder with the zones
+    Returns:
+        The zone dictionary (as the one of load_zone) or None if the zone is not compiled or it is stale"""
+    compiled_dir = get_compiled_zone_dir(zone_id, zones_dir)
+    manifest = _get_compiled_manifest(zone_id, zones_dir)
+    if manifest is None:
+        return None
+
+    arrays = {name: np.load(f"{compiled_dir}/{name}.npy", mmap_mode='r', allow_pickle=False)
+              for name in COMPILED_ZONE_ARRAYS}
+    with open(f"{compiled_dir}/graph.pickle", "rb") as file:
+        pickled = pickle.load(file)
+    graph = pickled['graph']
+
+    edges = list(zip(arrays['edge_u'].tolist(), arrays['edge_v'].tolist(), arrays['edge_key'].tolist()))
+    edge_table = EdgeTable.from_arrays(
+        edges,
+        bearing=arrays['bearing'],
+        oneway=arrays['oneway'],
+        reversed=arrays['reversed'],
+        junction=np.array([x if x else None for x in arrays['junction'].tolist()], dtype=object),
+        maxspeed=arrays['maxspeed'],
+        length=arrays['length'],
+        static_links=pickled['static_links'])
+
+    # A neighbour that appears twice counts twice (the duplicated entries are summed)
+    indptr, indices = arrays['neighbours_indptr'], arrays['neighbours_indices']
+    adjacency = scipy.sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(edges), len(edges)))
+    adjacency.sum_duplicates()
+
+    neighbours_dictionary = {}
+    indices_list, indptr_list = indices.tolist(), indptr.tolist()
+    for i, (u, v, key) in enumerate(edges):
+        neighbours_dictionary[(u, v)] = [edges[p][:2] for p in indices_list[indptr_list[i]:indptr_list[i + 1]]]
+
+    geometries = shapely.linestrings(arrays['geometry_coordinates'], indices=arrays['geometry_parts'])
+
+    return {
+        'graph': graph,
+        'tiles': manifest['tiles'],
+        'neightbours': neighbours_dictionary,
+        'interpolator': TrafficInterpolator.from_adjacency(edges, adjacency),
+        'edge_table': edge_table,
+        'edge_index': EdgeSpatialIndex.from_geometries(edge_table, geometries, manifest['graph_crs'],
+                                                       manifest['crs']),
+        'graph_signature': manifest['graph_signature'],
+        'match_cache': MatchCache(),
+        'traffic_state': TrafficState.from_edge_table(edge_table)
+    }
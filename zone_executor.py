@@ -0,0 +1,239 @@
+import logging
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import wait
+from typing import NamedTuple, Optional
+
+
+class ZoneResult(NamedTuple):
+    zone_id: str
+    snapshot: Optional[dict]  # The document of the snapshot (None if the zone failed)
+    error: Optional[str]
+    elapsed: float
+    metrics: Optional[dict] = None  # The timings and values of the CycleMetrics of the zone
+
+
+def _zone_worker(zone_id, zones_dir, connection, keyframe_interval, threshold, debug_dir, splits, precision):
+    """ Process of a zone: loads the zone once and processes the snapshots it receives until it gets None
+    Args:
+        zone_id: The zone of the worker
+        zones_dir: The folder with the zones
+        connection: The connection with the executor
+        keyframe_interval: The amount of snapshots between keyframes
+        threshold: The minimum change of the traffic level written in a delta
+        debug_dir: The folder where the intermediate files are written (disabled if None)
+        splits: The length of the split parts
+        precision: The precision to check the traffic level of the interpolations"""
+    logging.basicConfig(encoding='utf-8', level=logging.INFO, format=f'%(asctime)s [{zone_id}] %(message)s')
+
+    from mongo.snapshot_delta import SnapshotEncoder
+    from pipeline import process_snapshot
+    from utils.utils_metrics import CycleMetrics
+    from utils.utils_profiling import profile_call
+    from utils.utils_zone import load_zone
+
+    zone = load_zone(zone_id, zones_dir=zones_dir, compiled_cache=True)
+    encoder = SnapshotEncoder(zone['edge_table'], zone['graph_signature'], keyframe_interval=keyframe_interval,
+                              threshold=threshold)
+    connection.send(('ready', zone['tiles']))
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        datetime_str, decoded_tiles, profile_dir = message
+        start = time.perf_counter()
+        metrics = CycleMetrics()
+
+        def process():
+            traffic_state = process_snapshot(datetime_str, zone, decoded_tiles=decoded_tiles, debug_dir=debug_dir,
+                                             splits=splits, precision=precision, metrics=metrics)
+            with metrics.stage('encode'):
+                return encoder.encode(traffic_state, datetime_str).get_dict()
+
+        try:
+            if profile_dir is None:
+                snapshot = process()
+            else:
+                snapshot = profile_call(process, f"zone_{zone_id}", profile_dir)
+            connection.send(('done', snapshot, time.perf_counter() - start, metrics.to_dict()))
+        except Exception:
+            # The next snapshot starts a new chain of deltas
+            encoder.reset()
+            connection.send(('error', traceback.format_exc(), time.perf_counter() - start, metrics.to_dict()))
+
+
+class _ZoneWorkerHandle:
+    """ The process of a zone and its connection"""
+
+    def __init__(self, zone_id, process, connection):
+        self.zone_id = zone_id
+        self.process = process
+        self.connection = connection
+        self.tiles = None
+
+    @property
+    def ready(self):
+        return self.tiles is not None
+
+
+class ZoneExecutor:
+    """ Process the snapshots of several zones at the same time, every zone in its own process
+
+    Every worker loads its zone (graph, neighbours, interpolator, spatial index and match cache) once and keeps it
+    between cycles. A cycle is sent to all the zones at once, and a zone that fails, dies or exceeds the timeout only
+    loses its own snapshot (the worker is restarted if it died or timed out).
+    Args:
+        zone_ids: The zones to process
+        zones_dir: The folder with the zones
+        timeout: The maximum seconds of a zone in a cycle
+        start_timeout: The maximum seconds to wait for the zones to be loaded
+        keyframe_interval: The amount of snapshots between keyframes
+        threshold: The minimum change of the traffic level written in a delta
+        debug_dir: The folder where the intermediate files are written (disabled if None)
+        splits: The length of the split parts
+        precision: The precision to check the traffic level of the interpolations"""
+
+    def __init__(self, zone_ids, zones_dir="zonas", timeout=600, start_timeout=600, keyframe_interval=96,
+                 threshold=0.01, debug_dir=None, splits=15, precision=3):
+        self.zone_ids = list(zone_ids)
+        self.zones_dir = zones_dir
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.worker_options = (keyframe_interval, threshold, debug_dir, splits, precision)
+
+        # Spawn, so the workers do not inherit the threads and sockets of the main process
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = {}
+        # The tiles of every zone loaded once, kept while its worker is restarted (they do not change)
+        self.zone_tiles = {}
+
+    @property
+    def zones(self):
+        """ The zones dictionary with the tiles of every zone (as used to fetch the tiles), a zone whose worker is
+        restarting keeps its tiles, so they are fetched for the cycle that finds it loaded"""
+        return {zone_id: {'tiles': self.zone_tiles[zone_id]} for zone_id in self.workers if zone_id in self.zone_tiles}
+
+    def _spawn(self, zone_id):
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(target=_zone_worker, name=f"zone-{zone_id}", daemon=True,
+                                       args=(zone_id, self.zones_dir, child_connection, *self.worker_options))
+        process.start()
+        child_connection.close()
+        self.workers[zone_id] = _ZoneWorkerHandle(zone_id, process, parent_connection)
+
+    def _restart(self, zone_id):
+        self._stop_worker(self.workers[zone_id], timeout=0)
+        self._spawn(zone_id)
+
+    def _receive_ready(self, timeout):
+        """ Wait for the workers that are loading their zones
+        Args:
+            timeout: The maximum seconds to wait"""
+        deadline = time.monotonic() + timeout
+        loading = {worker.connection: worker for worker in self.workers.values() if not worker.ready}
+        while loading:
+            connections = wait(list(loading), timeout=max(0.0, deadline - time.monotonic()))
+            if not connections:
+                break
+            for connection in connections:
+                worker = loading.pop(connection)
+                try:
+                    _, worker.tiles = connection.recv()
+                    self.zone_tiles[worker.zone_id] = worker.tiles
+                    logging.info(f"Zone {worker.zone_id} loaded in its worker")
+                except EOFError:
+                    logging.error(f"The worker of {worker.zone_id} died loading the zone, restarting it")
+                    self._restart(worker.zone_id)
+                    loading[self.workers[worker.zone_id].connection] = self.workers[worker.zone_id]
+
+    def start(self):
+        """ Start the workers and wait for them to load their zones"""
+        for zone_id in self.zone_ids:
+            self._spawn(zone_id)
+        self._receive_ready(self.start_timeout)
+        return self
+
+    def run_cycle(self, datetime_str, decoded_tiles, timeout=None, profile_dir=None):
+        """ Process a snapshot of every zone at the same time
+        Args:
+            datetime_str: The datetime string of the snapshot
+            decoded_tiles: The RawTiles or decoded tiles by tile name (the RawTiles are sent as raw bytes)
+            timeout: The maximum seconds of a zone (the timeout of the executor if None)
+            profile_dir: The folder where every worker writes the profile of the cycle (not profiled if None)
+        Returns:
+            A dictionary with the ZoneResult of every zone"""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        self._receive_ready(0)
+
+        results = {}
+        pending = {}
+        for zone_id, worker in self.workers.items():
+            if not worker.ready:
+                results[zone_id] = ZoneResult(zone_id, None, "The zone is still loading", 0.0)
+                continue
+            zone_tiles = {tile['name']: decoded_tiles[tile['name']] for tile in worker.tiles
+                          if tile['name'] in decoded_tiles}
+            if not zone_tiles:
+                # An empty snapshot would be stored as if no edge had traffic
+                results[zone_id] = ZoneResult(zone_id, None, "None of the tiles of the zone were fetched", 0.0)
+                continue
+            worker.connection.send((datetime_str, zone_tiles, profile_dir))
+            pending[worker.connection] = worker
+
+        deadline = start + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for connection in wait(list(pending), timeout=remaining):
+                worker = pending.pop(connection)
+                try:
+                    status, payload, elapsed, metrics = connection.recv()
+                except EOFError:
+                    results[worker.zone_id] = ZoneResult(worker.zone_id, None, "The worker died",
+                                                         time.monotonic() - start)
+                    self._restart(worker.zone_id)
+                    continue
+                if status == 'done':
+                    results[worker.zone_id] = ZoneResult(worker.zone_id, payload, None, elapsed, metrics)
+                else:
+                    results[worker.zone_id] = ZoneResult(worker.zone_id, None, payload, elapsed, metrics)
+
+        for worker in pending.values():
+            results[worker.zone_id] = ZoneResult(worker.zone_id, None, f"Timeout after {timeout} s", timeout)
+            self._restart(worker.zone_id)
+
+        return results
+
+    @staticmethod
+    def _stop_worker(worker, timeout=10):
+        try:
+            worker.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        worker.process.join(timeout=timeout)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        worker.connection.close()
+
+    def close(self, timeout=10):
+        """ Stop the workers
+        Args:
+            timeout: The seconds every worker has to finish before it is terminated"""
+        for worker in self.workers.values():
+            self._stop_worker(worker, timeout=timeout)
+        self.workers = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()